@@ -1,5 +1,7 @@
 from aif.aida_graph import AidaGraph
 from aif.json_interface import JsonInterface
+from aif.json_stream import StreamingJsonInterface
+from aif.json_incremental import IncrementalJsonInterface
 from aif.rdf_graph import RDFGraph, RDFNode
 from aif.coref_data import EREUnify
 
@@ -1,84 +1,183 @@
 # Data structure for managing coreference:
 # Basically a unification data structure
 # that keeps, for each groups of coreferent EREs,
-# a representative unifier
+# a representative unifier.
+# Implemented as a disjoint-set forest with path compression
+# and union by rank, so unifications take near-constant time.
+
+from array import array
 
 
 # data structure for managing coreference
 # by having a single representative "unifier" for each
 # coreference group.
+#
+# EREs and unifiers are nodes in a disjoint-set forest, identified by integer ids.
+# By default, labels can be any hashable (usually strings) and are mapped to ids by a dictionary.
+# With compact = True, labels must be non-negative integers and are used as ids directly,
+# and the forest is kept in typed arrays, which saves a lot of memory for millions of EREs.
 class EREUnify:
-    def __init__(self):
-        self.unifier = { }
+    def __init__(self, compact = False):
+        self.compact = compact
+
+        if compact:
+            self.parent = array('q')
+            self.rank = bytearray()
+            # representative unifier of each root
+            self.representative = array('q')
+            # is the node a cluster member, that is, added or unified as an ERE
+            self.is_member = bytearray()
+            # ids of cluster members, in the order in which they were first added
+            self.members = array('q')
+        else:
+            self.label_id = { }
+            self.labels = [ ]
+            self.parent = [ ]
+            self.rank = [ ]
+            self.representative = [ ]
+            self.is_member = [ ]
+            self.members = [ ]
 
     # ere: a string label for an ERE (entity, relation, event)
     # add to the data structure.
     def add(self, ere):
-        if ere not in self.unifier:
-            self.unifier[ere] = ere
+        self._add_member(self._id(ere))
 
     # ere: a string label for an ERE
     # coref: representative unifier
     # make it so that the unifier of ere is coref.
-    # any EREs that have 'ere' as their representative unifier
-    # will be made to point to 'coref' instead.
+    # any EREs that have the same representative unifier as 'ere'
+    # will be made to point to the representative unifier of 'coref' instead.
     def unify_ere_coref(self, ere, coref):
-        ereu = self.get_unifier(ere)
-        if ereu != coref:
-            # unification needed
-            self.unifier[ ere] = coref
-            # if any other variable points to 'ere', make it point to 'coref'
-            for var in self.unifier.keys():
-                if self.unifier[var] == ere:
-                    self.unifier[var] = coref
+        ere_id = self._id(ere)
+        coref_id = self._id(coref)
+        self._add_member(ere_id)
+
+        ere_root = self._find(ere_id)
+        coref_root = self._find(coref_id)
+        if ere_root == coref_root:
+            return
+
+        representative = self.representative[coref_root]
+
+        # union by rank
+        if self.rank[ere_root] < self.rank[coref_root]:
+            ere_root, coref_root = coref_root, ere_root
+        self.parent[coref_root] = ere_root
+        if self.rank[ere_root] == self.rank[coref_root]:
+            self.rank[ere_root] += 1
 
+        self.representative[ere_root] = representative
 
     # ell: string label for an ERE
     # returns the representative unifier for ell.
     # if ell is not in the data structure, it is assumed to point to itself.
     def get_unifier(self, ell):
-        return self.unifier.get(ell, ell)
+        ell_id = self._lookup(ell)
+        if ell_id is None:
+            return ell
+        return self._label(self.representative[self._find(ell_id)])
 
-    # make a new datastructure like self.unifier
+    # make a new datastructure
     # that maps all EREs to new unifiers.
     # the new data structure is a dictionary.
-    # its keys are the same EREs that are listed in self.unifier.
-    # the representative unifiers that are the values are all new. 
+    # its keys are the EREs that were added or unified.
+    # the representative unifiers that are the values are all new.
     def all_new_names(self):
         retv = { }
-        oldname_newname = { }
-        namecount = 0
+        root_newname = { }
 
-        for ere, ereu in self.unifier.items():
-            if ereu not in oldname_newname:
-                oldname_newname[ereu] = "ERE" + str(namecount)
-                namecount += 1
+        for ere_id in self.members:
+            root = self._find(ere_id)
+            if root not in root_newname:
+                root_newname[root] = "ERE" + str(len(root_newname))
 
-                
-            retv[ere] = oldname_newname[ereu]
+            retv[self._label(ere_id)] = root_newname[root]
 
         return retv
 
-    # make an inverted version of self.unifier
+    # make an inverted mapping
     # in which each representative unifier
     # is mapped to the set of its cluster member names
     def get_clusters(self):
         retv = { }
 
-        for ere, ereu in self.unifier.items():
+        for ere_id in self.members:
+            ereu = self._label(self.representative[self._find(ere_id)])
             if ereu not in retv:
                 retv[ ereu ] = set()
-                
-            retv[ereu].add(ere)
+
+            retv[ereu].add(self._label(ere_id))
 
         return retv
 
     # return a set of all cluster prototypes/
     # representative unifiers
     def get_prototypes(self):
-        return set(self.unifier.values())
+        return set(self._label(self.representative[self._find(ere_id)]) for ere_id in self.members)
 
     # return a list of all cluster members
-    # recorded in self.unifier
     def get_members(self):
-        return list(self.unifier.keys())
+        return [self._label(ere_id) for ere_id in self.members]
+
+    ###################################
+    # disjoint-set forest
+
+    # id of a label, adding a new node if needed
+    def _id(self, label):
+        if self.compact:
+            if not isinstance(label, int) or label < 0:
+                raise ValueError("EREUnify with compact = True needs non-negative integer labels, got " + repr(label))
+            if label >= len(self.parent):
+                self._grow(label + 1)
+            return label
+
+        label_id = self.label_id.get(label, None)
+        if label_id is None:
+            label_id = len(self.labels)
+            self.label_id[label] = label_id
+            self.labels.append(label)
+            self.parent.append(label_id)
+            self.rank.append(0)
+            self.representative.append(label_id)
+            self.is_member.append(False)
+        return label_id
+
+    # id of a label, or None if it is not in the data structure
+    def _lookup(self, label):
+        if self.compact:
+            if isinstance(label, int) and 0 <= label < len(self.parent):
+                return label
+            return None
+        return self.label_id.get(label, None)
+
+    def _label(self, label_id):
+        if self.compact:
+            return label_id
+        return self.labels[label_id]
+
+    # grow the arrays of the compact forest to num_ids nodes
+    def _grow(self, num_ids):
+        new_ids = range(len(self.parent), num_ids)
+        self.parent.extend(new_ids)
+        self.representative.extend(new_ids)
+        self.rank.extend(bytes(len(new_ids)))
+        self.is_member.extend(bytes(len(new_ids)))
+
+    def _add_member(self, ere_id):
+        if not self.is_member[ere_id]:
+            self.is_member[ere_id] = True
+            self.members.append(ere_id)
+
+    # root of the tree of ere_id, with path compression
+    def _find(self, ere_id):
+        parent = self.parent
+
+        root = ere_id
+        while parent[root] != root:
+            root = parent[root]
+
+        while parent[ere_id] != root:
+            parent[ere_id], ere_id = root, parent[ere_id]
+
+        return root
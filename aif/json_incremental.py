@@ -0,0 +1,225 @@
+################################
+# Incremental variant of JsonInterface:
+# keep a manifest recording, for each KB file, a hash of its content and
+# the labels of theGraph entries that the file contributed triples to.
+# When KB files change, are added or removed, only the affected entries
+# are re-transformed; the "adjacent" lists, indices, "ere" list and
+# generated cluster handles of the existing graph json are then patched.
+#
+# Blank nodes are relabeled deterministically per file (see json_stream._TripleStream),
+# so that blank node labels of unchanged files stay the same across runs.
+
+import hashlib
+import json
+import logging
+import os
+
+from .aida_graph import AidaGraph
+from .json_interface import JsonInterface
+from .json_stream import _TripleStream
+
+
+# hash of the content of a KB file
+def kb_file_hash(kb_filename):
+    hasher = hashlib.sha1()
+    with open(kb_filename, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(1 << 20), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+# all triples of a KB file, with blank node labels that only depend on
+# the file name and content
+def read_kb_triples(kb_filename):
+    triples = [ ]
+    prefix = 'f{}b'.format(hashlib.sha1(os.path.basename(kb_filename).encode()).hexdigest()[:10])
+    _TripleStream(lambda s, p, o: triples.append((s, p, o)), prefix).parse(kb_filename, format = "ttl")
+    return triples
+
+
+class IncrementalJsonInterface(JsonInterface):
+    # kb_filenames: current list of KB files
+    # json_obj, json_just_obj, manifest: the output of the previous run, or None for a full build
+    def __init__(self, kb_filenames, json_obj = None, json_just_obj = None, manifest = None):
+        if json_obj is None or json_just_obj is None or manifest is None:
+            json_obj = {"theGraph": { }, "ere": [ ], "statements": [ ]}
+            json_just_obj = { }
+            manifest = {"files": { }, "generated_handles": [ ]}
+
+        self.json_obj = json_obj
+        self.json_just_obj = json_just_obj
+        self.manifest = manifest
+
+        self.statement_counter = 0
+        self.ere_counter = 0
+        self.coref_counter = 0
+
+        self._update(kb_filenames)
+
+    def write_manifest(self, io):
+        json.dump(self.manifest, io, indent = 1)
+
+    ###################################
+    # functions that are actually doing the work
+
+    def _update(self, kb_filenames):
+        old_files = self.manifest["files"]
+        new_hashes = dict((kb_filename, kb_file_hash(kb_filename)) for kb_filename in kb_filenames)
+
+        changed_files = [f for f in kb_filenames if f not in old_files or old_files[f]["hash"] != new_hashes[f]]
+        removed_files = [f for f in old_files if f not in new_hashes]
+        logging.info('{} changed or added files, {} removed files, {} unchanged files'.format(
+            len(changed_files), len(removed_files), len(kb_filenames) - len(changed_files)))
+
+        if len(changed_files) == 0 and len(removed_files) == 0:
+            return
+
+        # nodes that changed or removed files contributed to in the previous run
+        affected = set()
+        for kb_filename in changed_files + removed_files:
+            if kb_filename in old_files:
+                affected.update(old_files[kb_filename]["nodes"])
+
+        # read changed files, and record the nodes they describe
+        file_triples = { }
+        file_subjects = { }
+        for kb_filename in changed_files:
+            logging.info('Reading kb from {}...'.format(kb_filename))
+            file_triples[kb_filename] = read_kb_triples(kb_filename)
+            file_subjects[kb_filename] = set(str(s) for s, p, o in file_triples[kb_filename])
+            affected.update(file_subjects[kb_filename])
+
+        # unchanged files that contribute to affected nodes need to be re-read,
+        # so that affected nodes are re-transformed from all their triples
+        for kb_filename in kb_filenames:
+            if kb_filename not in file_triples and not affected.isdisjoint(old_files[kb_filename]["nodes"]):
+                logging.info('Re-reading kb from {}...'.format(kb_filename))
+                file_triples[kb_filename] = read_kb_triples(kb_filename)
+
+        logging.info('Building AidaGraph from {} files...'.format(len(file_triples)))
+        self.mygraph = AidaGraph()
+        for triples in file_triples.values():
+            self.mygraph.add_graph(triples)
+        logging.info('Done.')
+
+        # remove the old entries of affected nodes, remembering old statements and ERE adjacency
+        old_statements = { }
+        old_adjacent = { }
+        for nodelabel in affected:
+            entry = self.json_obj["theGraph"].pop(nodelabel, None)
+            self.json_just_obj.pop(nodelabel, None)
+            if entry is None:
+                continue
+            if entry["type"] == "Statement":
+                old_statements[nodelabel] = entry
+            elif "adjacent" in entry:
+                old_adjacent[nodelabel] = entry["adjacent"]
+
+        # re-transform affected nodes
+        logging.info('Transforming {} affected nodes...'.format(len(affected)))
+        new_statements = { }
+        new_eres = [ ]
+        for node in self.mygraph.nodes():
+            nodelabel = str(node.name)
+            if nodelabel not in affected:
+                continue
+            entry, justification = self._transform_node(node)
+            if entry is None:
+                continue
+
+            self.json_obj["theGraph"][nodelabel] = entry
+            if justification is not None:
+                self.json_just_obj[nodelabel] = justification
+
+            if entry["type"] == "Statement":
+                new_statements[nodelabel] = entry
+            elif "adjacent" in entry:
+                # adjacent statements are rdflib terms, which do not compare equal to strings
+                entry["adjacent"] = [str(stmtlabel) for stmtlabel in entry["adjacent"]]
+                new_eres.append(nodelabel)
+
+        self._patch_adjacent(old_statements, new_statements, old_adjacent, new_eres)
+        self._patch_indices()
+        self._patch_handles(affected)
+
+        # update the manifest
+        contributed_nodes = set(self.json_obj["theGraph"].keys())
+        for kb_filename in removed_files:
+            del old_files[kb_filename]
+        for kb_filename in changed_files:
+            old_files[kb_filename] = {
+                "hash": new_hashes[kb_filename],
+                "nodes": sorted(file_subjects[kb_filename].intersection(contributed_nodes))}
+
+        logging.info('Done.')
+
+    # patch "adjacent" lists: statements that were removed or re-transformed
+    # are dropped from the lists of their old subject and object, and
+    # re-transformed statements are added to the lists of their new subject and object.
+    def _patch_adjacent(self, old_statements, new_statements, old_adjacent, new_eres):
+        theGraph = self.json_obj["theGraph"]
+        touched = set(old_statements.keys()).union(new_statements.keys())
+        retransformed_eres = set(new_eres)
+
+        # re-transformed EREs only see statements in the files that were read,
+        # so keep their old adjacent statements from untouched files
+        for nodelabel in new_eres:
+            if nodelabel in old_adjacent:
+                theGraph[nodelabel]["adjacent"] = list(
+                    set(theGraph[nodelabel]["adjacent"]).union(s for s in old_adjacent[nodelabel] if s not in touched))
+
+        for stmtlabel, entry in old_statements.items():
+            for label in ["subject", "object"]:
+                erelabel = entry.get(label, None)
+                if erelabel in theGraph and "adjacent" in theGraph[erelabel] and erelabel not in retransformed_eres:
+                    theGraph[erelabel]["adjacent"] = [s for s in theGraph[erelabel]["adjacent"] if s != stmtlabel]
+
+        for stmtlabel, entry in new_statements.items():
+            for label in ["subject", "object"]:
+                erelabel = entry.get(label, None)
+                if erelabel in theGraph and "adjacent" in theGraph[erelabel] and stmtlabel not in theGraph[erelabel]["adjacent"]:
+                    theGraph[erelabel]["adjacent"].append(stmtlabel)
+
+        # EREs that did not exist before may be mentioned by statements in untouched files
+        brand_new_eres = set(nodelabel for nodelabel in new_eres if nodelabel not in old_adjacent)
+        if len(brand_new_eres) > 0:
+            for stmtlabel, entry in theGraph.items():
+                if entry["type"] != "Statement" or stmtlabel in touched:
+                    continue
+                for label in ["subject", "object"]:
+                    erelabel = entry.get(label, None)
+                    if erelabel in brand_new_eres and stmtlabel not in theGraph[erelabel]["adjacent"]:
+                        theGraph[erelabel]["adjacent"].append(stmtlabel)
+
+    # renumber EREs, cluster memberships and statements in order of appearance,
+    # and recompute the list of EREs
+    def _patch_indices(self):
+        self.ere_counter = 0
+        self.coref_counter = 0
+        self.statement_counter = 0
+        self.json_obj["ere"] = [ ]
+
+        for nodelabel, entry in self.json_obj["theGraph"].items():
+            if entry["type"] in ["Entity", "Event", "Relation"]:
+                entry["index"] = self.ere_counter
+                self.ere_counter += 1
+                self.json_obj["ere"].append(nodelabel)
+            elif entry["type"] == "ClusterMembership":
+                entry["index"] = self.coref_counter
+                self.coref_counter += 1
+            elif entry["type"] == "Statement":
+                entry["index"] = self.statement_counter
+                self.statement_counter += 1
+
+    # handles that were generated from member names may change with any change to the graph,
+    # so drop them and generate them anew along with handles for affected clusters
+    def _patch_handles(self, affected):
+        theGraph = self.json_obj["theGraph"]
+        for cluster in self.manifest["generated_handles"]:
+            if cluster in theGraph and cluster not in affected:
+                theGraph[cluster].pop("handle", None)
+
+        generated_handles = [label for label, entry in theGraph.items()
+                             if entry["type"] == "SameAsCluster" and "handle" not in entry]
+        self._validate()
+        self.manifest["generated_handles"] = generated_handles
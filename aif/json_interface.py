@@ -11,6 +11,16 @@ from tqdm import tqdm
 from rdflib.namespace import split_uri
 
 
+###########
+# handle for a cluster that does not have one:
+# the shortest name of any of its members, or "[unknown]"
+def cluster_handle_from_names(names):
+    if len(names) > 0:
+        return min(names, key = lambda n:len(n))
+    else:
+        return "[unknown]"
+
+
 ###########
 # Given an AidaGraph, transform it into input for WebPPL analysis:
 # * re-encode the graph,
@@ -96,141 +106,15 @@ class JsonInterface:
         # we write out statements, events, entities, relations
         for node in tqdm(self.mygraph.nodes()):
             nodelabel = str(node.name)
-            # entities, events, relations: they  have a type. They also have a list of adjacent statements,
-            # and an index. They have optional names.
-            if node.is_ere():
-                self.json_obj["theGraph"][nodelabel] = {
-                    "adjacent": self._adjacent_statements(node),
-                    "index": self.ere_counter}
-
-                if node.is_event():
-                    self.json_obj["theGraph"][nodelabel]["type"] = "Event"
-                elif node.is_entity():
-                    self.json_obj["theGraph"][nodelabel]["type"] = "Entity"
-                else:
-                    self.json_obj["theGraph"][nodelabel]["type"] = "Relation"
-
-                enames = list(set(self.mygraph.names_of_ere(node.name)))
-                if len(enames) > 0:
-                    self.json_obj["theGraph"][nodelabel]["name"] = enames
-
-                # temporal information (for events)
-                temporal = list(self.mygraph.times_associated_with(node.name))
-                if len(temporal) > 0:
-                    self.json_obj["theGraph"][nodelabel]["ldcTime"] = temporal
-
-                self.ere_counter += 1
-                self.json_obj["ere"].append(nodelabel)
-
-                # record justification
-                this_justification = self.get_justification(node)
-                if len(this_justification) > 0:
-                    self.json_just_obj[nodelabel] = this_justification
-                
-            # node describing a cluster: has a prototypical member and a handle (preferred name)
-            elif node.is_sameas_cluster():
-                self.json_obj["theGraph"][nodelabel] = {"type": "SameAsCluster"}
-                
-                content = node.get("prototype", shorten=False)
-                if len(content) > 0:
-                    self.json_obj["theGraph"][nodelabel]["prototype"] = str(content.pop())
-
-                content = node.get("handle", shorten = True)
-                if len(content) > 0:
-                    self.json_obj["theGraph"][nodelabel]["handle"] = str(content.pop())
-                    
-                ## else:
-                ##     # record this node only if it has a prototype as required
-                ##     del self.json_obj["theGraph"][nodelabel]
-
-            # clusterMembership statements have a cluster, a clusterMember, and a maximal confidence level
-            elif node.is_cluster_membership():
-                self.json_obj["theGraph"][nodelabel] = {
-                    "type": "ClusterMembership",
-                    "index": self.coref_counter}
-
-                # cluster, clusterMember
-                for label in ["cluster", "clusterMember"]:
-                    content = node.get(label, shorten=False)
-                    if len(content) > 0:
-                        self.json_obj["theGraph"][nodelabel][label] = str(content.pop())
-                
+            entry, justification = self._transform_node(node)
+            if entry is None:
+                continue
 
-                # confidence
-                conflevels = self.mygraph.confidence_of(node.name)
-                if len(conflevels) > 0:
-                    self.json_obj["theGraph"][ nodelabel]["conf"] = max(conflevels)
-
-                self.coref_counter += 1
-                
-                ## # check that the node is well-formed
-                ## if all(label in self.json_obj["theGraph"][nodelabel] for label in ["cluster", "clusterMember", "conf"]):
-                ##     self.coref_counter += 1
-                ##     # self.json_obj["coref_statements"].append(nodelabel)
-                ## else:
-                ##     del self.json_obj["theGraph"][nodelabel]
-                  
-                    
-            # statements have a single subj, pred, obj, a maximal confidence level, and possibly mentions.
-            # they also have hypotheses that they support, partially support, and contradict.
-            # Statements also have justifications, which go in the justification object
-            elif node.is_statement():
-                # type
-                self.json_obj["theGraph"][nodelabel] = {
-                    "type": "Statement",
-                    "index": self.statement_counter}
-
-                # predicate, subject, object
-                for label in ["subject", "object"]:
-                    content = node.get(label, shorten=False)
-                    if len(content) > 0:
-                        self.json_obj["theGraph"][nodelabel][label] = str(content.pop())
-
-                predicates = node.get("predicate", shorten=True)
-                if len(predicates) > 0:
-                    self.json_obj["theGraph"][nodelabel]["predicate"] = str(predicates.pop())
-
-                # confidence
-                conflevels = self.mygraph.confidence_of(node.name)
-                if len(conflevels) > 0:
-                    self.json_obj["theGraph"][ nodelabel]["conf"] = max(conflevels)
-
-                ## # source document ids
-                ## sources = set(self.mygraph.sources_associated_with(node.name))
-                ## if len(sources) > 0:
-                ##     self.json_obj["theGraph"][nodelabel]["source"] = list(sources)
-
-                # hypotheses
-                hypotheses = set(self.mygraph.hypotheses_supported(node.name))
-                if len(hypotheses) > 0:
-                    self.json_obj["theGraph"][nodelabel]["hypotheses_supported"] = list(hypotheses)
-                hypotheses = set(self.mygraph.hypotheses_partially_supported(node.name))
-                if len(hypotheses) > 0:
-                    self.json_obj["theGraph"][nodelabel]["hypotheses_partially_supported"] = list(hypotheses)
-                hypotheses = set(self.mygraph.hypotheses_contradicted(node.name))
-                if len(hypotheses) > 0:
-                    self.json_obj["theGraph"][nodelabel]["hypotheses_contradicted"] = list(hypotheses)
-
-                self.statement_counter += 1
-                ## # well-formedness check
-                ## wellformed = False
-                ## if all(label in self.json_obj["theGraph"][node.name] for label in ["conf", "predicate", "subject", "object"]):
-                ##     wellformed = True
-                ##     self.statement_counter += 1
-                ##     self.json_obj["statements"].append(node.name)
-                ## else:
-                ##     del self.json_obj["theGraph"][node.name]
-
-                # record justification
-                ## if wellformed:
-                ##     this_justification = self.get_justification(node)
-                ##     if len(this_justification) > 0:
-                ##         self.json_just_obj[node.name] = this_justification
-                this_justification = self.get_justification(node)
-                if len(this_justification) > 0:
-                    self.json_just_obj[nodelabel] = this_justification
-                    
-                    
+            self.json_obj["theGraph"][nodelabel] = entry
+            if entry["type"] in ["Entity", "Event", "Relation"]:
+                self.json_obj["ere"].append(nodelabel)
+            if justification is not None:
+                self.json_just_obj[nodelabel] = justification
 
         ## # replace labels by label indices in adjacency statements
         ## for nodelabel in self.json_obj["theGraph"]:
@@ -239,6 +123,150 @@ class JsonInterface:
 
         logging.info('Done.')
 
+    # transform a single node of self.mygraph into its entry in theGraph.
+    # returns a pair (entry, justification), where entry is None for nodes that
+    # are not EREs, clusters, cluster memberships or statements, and justification
+    # is None for nodes without justifications.
+    # also used by StreamingJsonInterface, which writes out entries one at a time.
+    def _transform_node(self, node):
+        entry = None
+        justification = None
+
+        # entities, events, relations: they  have a type. They also have a list of adjacent statements,
+        # and an index. They have optional names.
+        if node.is_ere():
+            entry = {
+                "adjacent": self._adjacent_statements(node),
+                "index": self.ere_counter}
+
+            if node.is_event():
+                entry["type"] = "Event"
+            elif node.is_entity():
+                entry["type"] = "Entity"
+            else:
+                entry["type"] = "Relation"
+
+            enames = list(set(self.mygraph.names_of_ere(node.name)))
+            if len(enames) > 0:
+                entry["name"] = enames
+
+            # temporal information (for events)
+            temporal = list(self.mygraph.times_associated_with(node.name))
+            if len(temporal) > 0:
+                entry["ldcTime"] = temporal
+
+            self.ere_counter += 1
+
+            # record justification
+            this_justification = self.get_justification(node)
+            if len(this_justification) > 0:
+                justification = this_justification
+            
+        # node describing a cluster: has a prototypical member and a handle (preferred name)
+        elif node.is_sameas_cluster():
+            entry = {"type": "SameAsCluster"}
+            
+            content = node.get("prototype", shorten=False)
+            if len(content) > 0:
+                entry["prototype"] = str(content.pop())
+
+            content = node.get("handle", shorten = True)
+            if len(content) > 0:
+                entry["handle"] = str(content.pop())
+                
+            ## else:
+            ##     # record this node only if it has a prototype as required
+            ##     del entry
+
+        # clusterMembership statements have a cluster, a clusterMember, and a maximal confidence level
+        elif node.is_cluster_membership():
+            entry = {
+                "type": "ClusterMembership",
+                "index": self.coref_counter}
+
+            # cluster, clusterMember
+            for label in ["cluster", "clusterMember"]:
+                content = node.get(label, shorten=False)
+                if len(content) > 0:
+                    entry[label] = str(content.pop())
+            
+
+            # confidence
+            conflevels = self.mygraph.confidence_of(node.name)
+            if len(conflevels) > 0:
+                entry["conf"] = max(conflevels)
+
+            self.coref_counter += 1
+            
+            ## # check that the node is well-formed
+            ## if all(label in entry for label in ["cluster", "clusterMember", "conf"]):
+            ##     self.coref_counter += 1
+            ##     # self.json_obj["coref_statements"].append(nodelabel)
+            ## else:
+            ##     del entry
+              
+                
+        # statements have a single subj, pred, obj, a maximal confidence level, and possibly mentions.
+        # they also have hypotheses that they support, partially support, and contradict.
+        # Statements also have justifications, which go in the justification object
+        elif node.is_statement():
+            # type
+            entry = {
+                "type": "Statement",
+                "index": self.statement_counter}
+
+            # predicate, subject, object
+            for label in ["subject", "object"]:
+                content = node.get(label, shorten=False)
+                if len(content) > 0:
+                    entry[label] = str(content.pop())
+
+            predicates = node.get("predicate", shorten=True)
+            if len(predicates) > 0:
+                entry["predicate"] = str(predicates.pop())
+
+            # confidence
+            conflevels = self.mygraph.confidence_of(node.name)
+            if len(conflevels) > 0:
+                entry["conf"] = max(conflevels)
+
+            ## # source document ids
+            ## sources = set(self.mygraph.sources_associated_with(node.name))
+            ## if len(sources) > 0:
+            ##     entry["source"] = list(sources)
+
+            # hypotheses
+            hypotheses = set(self.mygraph.hypotheses_supported(node.name))
+            if len(hypotheses) > 0:
+                entry["hypotheses_supported"] = list(hypotheses)
+            hypotheses = set(self.mygraph.hypotheses_partially_supported(node.name))
+            if len(hypotheses) > 0:
+                entry["hypotheses_partially_supported"] = list(hypotheses)
+            hypotheses = set(self.mygraph.hypotheses_contradicted(node.name))
+            if len(hypotheses) > 0:
+                entry["hypotheses_contradicted"] = list(hypotheses)
+
+            self.statement_counter += 1
+            ## # well-formedness check
+            ## wellformed = False
+            ## if all(label in self.json_obj["theGraph"][node.name] for label in ["conf", "predicate", "subject", "object"]):
+            ##     wellformed = True
+            ##     self.statement_counter += 1
+            ##     self.json_obj["statements"].append(node.name)
+            ## else:
+            ##     del self.json_obj["theGraph"][node.name]
+
+            # record justification
+            ## if wellformed:
+            ##     this_justification = self.get_justification(node)
+            ##     if len(this_justification) > 0:
+            ##         self.json_just_obj[node.name] = this_justification
+            this_justification = self.get_justification(node)
+            if len(this_justification) > 0:
+                justification = this_justification
+
+        return entry, justification
+
 
     def _validate(self):
         logging.info('Validating the graph...')
@@ -268,14 +296,7 @@ class JsonInterface:
 
             # now add a handle for all clusters that are missing one
             for cluster in clusters_without_handles:
-                if cluster in cluster_names and len(cluster_names[cluster]) > 0:
-                    # grab the shortest name
-                    if len(cluster_names[cluster]) > 0:
-                        self.json_obj["theGraph"][cluster]["handle"] = min(cluster_names[cluster], key = lambda n:len(n))
-                    else:
-                        self.json_obj["theGraph"][cluster]["handle"] = "[unknown]"                        
-                else:
-                    self.json_obj["theGraph"][cluster]["handle"] = "[unknown]"
+                self.json_obj["theGraph"][cluster]["handle"] = cluster_handle_from_names(cluster_names.get(cluster, [ ]))
         
 
     # for an entity, relation, or event, determine all statements that mention it
@@ -0,0 +1,216 @@
+################################
+# Streaming variant of JsonInterface:
+# instead of parsing the whole KB into an rdflib.Graph, copying it into an AidaGraph
+# and building the whole json object in memory, make two streaming passes over the triples
+# of each KB file:
+# * pass 1 collects the skeleton of the graph: node types, statement / cluster / cluster membership
+#   fields, names, and links to justification, confidence, private data and time nodes
+# * pass 2 collects the values (offsets, confidence values, time components, ...) of only those
+#   justification, confidence, private data and time nodes reachable from an ERE, statement,
+#   cluster or cluster membership
+# The AidaGraph built from these is then transformed one node at a time,
+# and theGraph entries are written out as they are produced.
+
+import json
+import logging
+
+import rdflib
+from rdflib.term import BNode
+
+from .aida_graph import AidaGraph
+from .json_interface import JsonInterface, cluster_handle_from_names
+from .rdf_graph import RDFNode
+
+# node types that get an entry in theGraph
+CORE_TYPES = {"Entity", "Relation", "Event", "Statement", "SameAsCluster", "ClusterMembership"}
+
+# predicates linking a node to the auxiliary nodes that JsonInterface reads
+LINK_PREDICATES = {"justifiedBy", "containedJustification", "confidence", "privateData", "ldcTime",
+                   "boundingBox", "start", "end"}
+
+# predicates collected in pass 1
+SKELETON_PREDICATES = {"type", "subject", "predicate", "object", "cluster", "clusterMember",
+                       "prototype", "handle", "hasName"} | LINK_PREDICATES
+
+# predicates collected in pass 2, for auxiliary nodes only
+VALUE_PREDICATES = {"confidenceValue", "source", "sourceDocument", "startOffset", "endOffsetInclusive",
+                    "keyFrame", "boundingBoxLowerRightX", "boundingBoxLowerRightY",
+                    "boundingBoxUpperLeftX", "boundingBoxUpperLeftY", "prefLabel", "jsonContent",
+                    "timeType", "year", "month", "day", "hour", "minute"}
+
+
+# an rdflib.Graph that does not store triples, but hands each parsed triple to a callback.
+# Blank nodes are relabeled in the order in which they are first seen, so that
+# repeated passes over the same file agree on blank node labels.
+class _TripleStream(rdflib.Graph):
+    def __init__(self, callback, bnode_prefix):
+        rdflib.Graph.__init__(self)
+        self.callback = callback
+        self.bnode_prefix = bnode_prefix
+        self.bnode_labels = { }
+
+    def _relabel(self, term):
+        if not isinstance(term, BNode):
+            return term
+        if term not in self.bnode_labels:
+            self.bnode_labels[term] = BNode(self.bnode_prefix + str(len(self.bnode_labels)))
+        return self.bnode_labels[term]
+
+    def add(self, triple):
+        subj, pred, obj = triple
+        self.callback(self._relabel(subj), pred, self._relabel(obj))
+        return self
+
+
+class StreamingJsonInterface(JsonInterface):
+    def __init__(self, kb_filenames):
+        self.kb_filenames = list(kb_filenames)
+        self.mygraph = AidaGraph()
+
+        self.statement_counter = 0
+        self.ere_counter = 0
+        self.coref_counter = 0
+
+        # short labels of predicates and types, computed once per IRI
+        self.shortlabels = { }
+
+        # labels of all nodes with one of the CORE_TYPES, in order of appearance
+        self.core_nodes = [ ]
+
+        self._collect_skeleton()
+        self._collect_values()
+
+    # write theGraph and the justifications, one node at a time
+    def write(self, io, just_io):
+        logging.info('Writing the graph...')
+
+        # clusters without handles are written last,
+        # as their handles are computed from the names of their members
+        clusters_without_handles = [ ]
+        ere_labels = [ ]
+
+        io.write('{\n "theGraph": {')
+        just_io.write('{')
+        first_entry = True
+        first_just = True
+
+        for nodelabel in self.core_nodes:
+            node = self.mygraph.get_node(nodelabel)
+            if node.is_sameas_cluster() and len(node.get("handle")) == 0:
+                clusters_without_handles.append(nodelabel)
+                continue
+
+            entry, justification = self._transform_node(node)
+            if entry is None:
+                continue
+
+            if entry["type"] in ["Entity", "Event", "Relation"]:
+                ere_labels.append(str(nodelabel))
+
+            self._write_item(io, str(nodelabel), entry, first_entry, indent = 2)
+            first_entry = False
+
+            if justification is not None:
+                self._write_item(just_io, str(nodelabel), justification, first_just, indent = 1)
+                first_just = False
+
+        if len(clusters_without_handles) > 0:
+            cluster_members = self._cluster_members(set(clusters_without_handles))
+
+            for nodelabel in clusters_without_handles:
+                entry, _ = self._transform_node(self.mygraph.get_node(nodelabel))
+                names = [ ]
+                for member in cluster_members.get(nodelabel, [ ]):
+                    names += list(set(self.mygraph.names_of_ere(member)))
+                entry["handle"] = cluster_handle_from_names(names)
+
+                self._write_item(io, str(nodelabel), entry, first_entry, indent = 2)
+                first_entry = False
+
+        io.write("\n },\n \"ere\": " + json.dumps(ere_labels) + ",\n \"statements\": []\n}\n")
+        just_io.write('\n}\n')
+
+        logging.info('Done.')
+
+    ###################################
+    # functions that are actually doing the work
+
+    def _write_item(self, io, label, value, first, indent):
+        if not first:
+            io.write(',')
+        io.write('\n{}{}: {}'.format(' ' * indent, json.dumps(label), json.dumps(value)))
+
+    def _shortlabel(self, term):
+        if term not in self.shortlabels:
+            self.shortlabels[term] = RDFNode.shortlabel(str(term))
+        return self.shortlabels[term]
+
+    # one streaming pass over the triples of all KB files
+    def _stream_triples(self, callback):
+        for file_idx, kb_filename in enumerate(self.kb_filenames):
+            logging.info('Streaming triples from {}...'.format(kb_filename))
+            _TripleStream(callback, 'f{}b'.format(file_idx)).parse(kb_filename, format = "ttl")
+
+    def _collect_skeleton(self):
+        logging.info('Pass 1: collecting the graph skeleton...')
+
+        skeleton = { }
+        core_nodes = { }
+
+        def collect(subj, pred, obj):
+            predlabel = self._shortlabel(pred)
+            if predlabel not in SKELETON_PREDICATES:
+                return
+            if subj not in skeleton:
+                skeleton[subj] = [ ]
+            skeleton[subj].append((pred, obj))
+            if predlabel == "type" and self._shortlabel(obj) in CORE_TYPES:
+                core_nodes[subj] = True
+
+        self._stream_triples(collect)
+
+        # auxiliary nodes reachable from core nodes through LINK_PREDICATES
+        self.aux_nodes = set()
+        fringe = list(core_nodes.keys())
+        while len(fringe) > 0:
+            subj = fringe.pop()
+            for pred, obj in skeleton.get(subj, [ ]):
+                if self._shortlabel(pred) in LINK_PREDICATES and obj not in self.aux_nodes and obj not in core_nodes:
+                    self.aux_nodes.add(obj)
+                    fringe.append(obj)
+
+        self.core_nodes = list(core_nodes.keys())
+        self.mygraph.add_graph(
+            (subj, pred, obj) for subj in self.core_nodes + list(self.aux_nodes) for pred, obj in skeleton.get(subj, [ ]))
+
+        logging.info('Done, found {} nodes and {} auxiliary nodes.'.format(len(self.core_nodes), len(self.aux_nodes)))
+
+    def _collect_values(self):
+        logging.info('Pass 2: collecting values of auxiliary nodes...')
+
+        values = [ ]
+
+        def collect(subj, pred, obj):
+            if subj in self.aux_nodes and self._shortlabel(pred) in VALUE_PREDICATES:
+                values.append((subj, pred, obj))
+
+        self._stream_triples(collect)
+        self.mygraph.add_graph(values)
+
+        logging.info('Done, found {} values.'.format(len(values)))
+
+    # mapping from each cluster in clusters to its prototype and members
+    def _cluster_members(self, clusters):
+        cluster_members = { }
+
+        for nodelabel in clusters:
+            cluster_members[nodelabel] = list(self.mygraph.get_node(nodelabel).get("prototype"))
+
+        for nodelabel in self.core_nodes:
+            node = self.mygraph.get_node(nodelabel)
+            if node.is_cluster_membership():
+                for cluster in node.get("cluster"):
+                    if cluster in clusters:
+                        cluster_members[cluster] += list(node.get("clusterMember"))
+
+        return cluster_members
@@ -4,7 +4,7 @@
 
 import json
 from argparse import ArgumentParser
-from copy import deepcopy
+from pathlib import Path
 
 
 # Find all zero_hop neighbors of a set of starting_nodes (default to be EREs).
@@ -12,7 +12,18 @@ from copy import deepcopy
 # and a set of (ERE, SameAsCluster) pairs, representing corresponding
 # ClusterMembership nodes (since they can be BNodes, thus cannot be
 # identified by randomly generated node names).
-def find_coref_closure(starting_nodes, neighbors_mapping, start_from_ere=True):
+# Nodes in excluded_nodes (e.g., closures already computed in an earlier hop)
+# are not expanded again.
+# If closure_cache (a dict) is given, the closure of each starting node is
+# looked up from / stored into the cache, so that closures shared by several
+# queries are only searched once (see find_cached_coref_closure).
+def find_coref_closure(starting_nodes, neighbors_mapping, start_from_ere=True,
+                       excluded_nodes=None, closure_cache=None):
+    if closure_cache is not None:
+        return find_cached_coref_closure(
+            starting_nodes, neighbors_mapping, closure_cache,
+            start_from_ere=start_from_ere, excluded_nodes=excluded_nodes)
+
     # closure for all ERE nodes
     ere_closure = set([])
     # closure for all SameAsCluster nodes
@@ -21,7 +32,9 @@ def find_coref_closure(starting_nodes, neighbors_mapping, start_from_ere=True):
     cluster_memberships = set([])
 
     # set of nodes in current iteration
-    current_neighbors = starting_nodes
+    current_neighbors = set(starting_nodes)
+    if excluded_nodes:
+        current_neighbors -= excluded_nodes
     # set of neighbors of nodes in current iteration, for the next iteration
     new_neighbors = set([])
 
@@ -64,9 +77,12 @@ def find_coref_closure(starting_nodes, neighbors_mapping, start_from_ere=True):
         # process the same node more than once.
         new_neighbors -= ere_closure
         new_neighbors -= cluster_closure
+        if excluded_nodes:
+            new_neighbors -= excluded_nodes
 
-        # set current_neighbors = new_neighbors, then reset new_neighbors
-        current_neighbors = deepcopy(new_neighbors)
+        # the new frontier becomes the current one, no copy needed as
+        # new_neighbors is rebound to a fresh set
+        current_neighbors = new_neighbors
         new_neighbors = set([])
 
         # flip the boolean value, as the iterations would go like
@@ -76,6 +92,38 @@ def find_coref_closure(starting_nodes, neighbors_mapping, start_from_ere=True):
     return ere_closure, cluster_closure, cluster_memberships
 
 
+# Coref closures are connected components of ERE and SameAsCluster nodes, so
+# the closure of a set of nodes is the union of the closures of each node.
+# closure_cache maps each node to the (frozen) closure of its component, which
+# is shared by all nodes in the component. Components containing a node in
+# excluded_nodes are skipped, which is equivalent to find_coref_closure as
+# excluded_nodes always consists of complete closures.
+def find_cached_coref_closure(starting_nodes, neighbors_mapping, closure_cache,
+                              start_from_ere=True, excluded_nodes=None):
+    ere_closure = set([])
+    cluster_closure = set([])
+    cluster_memberships = set([])
+
+    for node in starting_nodes:
+        if node in ere_closure or node in cluster_closure:
+            continue
+        if excluded_nodes and node in excluded_nodes:
+            continue
+
+        closure = closure_cache.get(node, None)
+        if closure is None:
+            closure = tuple(frozenset(part) for part in find_coref_closure(
+                [node], neighbors_mapping, start_from_ere=start_from_ere))
+            for member in closure[0] | closure[1]:
+                closure_cache[member] = closure
+
+        ere_closure.update(closure[0])
+        cluster_closure.update(closure[1])
+        cluster_memberships.update(closure[2])
+
+    return ere_closure, cluster_closure, cluster_memberships
+
+
 # Find all typing statements for a closure of ERE nodes.
 # Each typing statement is represented by a pair of (ERE/subject, Type/object)
 # (again, we must use a pair to identify the typing statement as it can
@@ -99,17 +147,31 @@ def find_typing_statements(ere_closure, neighbors_mapping):
     return typing_statements
 
 
+# Number of general statements an ERE node participates in, either as the
+# subject or as the object.
+def ere_fan_out(ere, neighbors_mapping):
+    return len(neighbors_mapping['half-hop-subj'].get(ere, [])) + \
+        len(neighbors_mapping['half-hop-obj'].get(ere, []))
+
+
 # Find all half-hop neighbors for a closure of ERE nodes.
 # Return a set of (subj, obj) pairs representing corresponding statements
 # connecting the nodes and neighbors, as well as, a closure for all ERE
 # nodes, a closure for all SameAsCluster nodes, and a set of
 # (ERE, SameAsCluster) pairs for corresponding ClusterMembership nodes,
 # similar to the output of find_coref_closure.
-def find_half_hop_neighbors(ere_closure, neighbors_mapping):
+# If max_fan_out is not None, EREs with more than max_fan_out statements
+# (hub entities) are not expanded. Nodes in excluded_nodes are already
+# covered by a previous hop, so their coref closure is not searched again.
+def find_half_hop_neighbors(ere_closure, neighbors_mapping, max_fan_out=None,
+                            excluded_nodes=None, closure_cache=None):
     neighbors = set([])
     statements = set([])
 
     for ere in ere_closure:
+        if max_fan_out is not None and \
+                ere_fan_out(ere, neighbors_mapping) > max_fan_out:
+            continue
         for obj in neighbors_mapping['half-hop-subj'].get(ere, []):
             statements.add((ere, obj))
             neighbors.add(obj)
@@ -119,14 +181,66 @@ def find_half_hop_neighbors(ere_closure, neighbors_mapping):
 
     ere_closure_neighbors, cluster_closure_neighbors, \
         cluster_membership_neighbors = find_coref_closure(
-            neighbors, neighbors_mapping, start_from_ere=True)
+            neighbors, neighbors_mapping, start_from_ere=True,
+            excluded_nodes=excluded_nodes, closure_cache=closure_cache)
 
     return statements, ere_closure_neighbors, cluster_closure_neighbors, \
         cluster_membership_neighbors
 
 
+# Readable name of a hop distance given in half-hops, e.g., 0 -> zero-hop,
+# 1 -> half-hop, 2 -> one-hop, 3 -> 1.5-hop.
+def hop_name(num_half_hops):
+    if num_half_hops == 0:
+        return 'zero-hop'
+    if num_half_hops == 1:
+        return 'half-hop'
+    if num_half_hops == 2:
+        return 'one-hop'
+    return '{:g}-hop'.format(num_half_hops / 2)
+
+
+# Fan-out cap for the expansion starting from hop hop_idx. fan_out_caps can be
+# None (no cap), a single int (same cap for every hop), or a list with one cap
+# (or None) per hop, where the last entry applies to all further hops.
+def fan_out_cap_for_hop(fan_out_caps, hop_idx):
+    if fan_out_caps is None or isinstance(fan_out_caps, int):
+        return fan_out_caps
+    if not fan_out_caps:
+        return None
+    return fan_out_caps[min(hop_idx, len(fan_out_caps) - 1)]
+
+
+# Parse the --fan_out_caps command line argument, a comma-separated list of
+# ints, where "none" means no cap for that hop.
+def parse_fan_out_caps(caps_str):
+    if caps_str is None:
+        return None
+    return [None if cap.strip().lower() == 'none' else int(cap)
+            for cap in caps_str.split(',')]
+
+
+def print_hop_neighbors(hop_label, ere_closure, cluster_closure,
+                        cluster_memberships, typing_statements):
+    print('\nEREs {} from the entry point: \n{}'.format(
+        hop_label, '\n'.join(ere_closure)))
+    print('\nClusters {} from the entry point: \n{}'.format(
+        hop_label, '\n'.join(cluster_closure)))
+    print('\nClusterMemberships {} from the entry point: \n{}'.format(
+        hop_label, '\n'.join(map(str, cluster_memberships))))
+    print('\nTyping statements of {} ERE closure: \n{}'.format(
+        hop_label, '\n'.join(map(str, typing_statements))))
+
+
+# Expand a set of starting EREs by num_half_hops half-hops (the default of 2
+# gives the zero-hop, half-hop and one-hop neighborhood).
+# Each hop only expands the frontier of EREs that were newly reached in the
+# previous hop, as all statements of earlier EREs have already been collected.
+# fan_out_caps limits the expansion of hub EREs, see fan_out_cap_for_hop.
+# closure_cache can be shared between calls, see find_cached_coref_closure.
 def find_neighbors_for_entry_point(
-        starting_eres, neighbors_mapping, verbose=False):
+        starting_eres, neighbors_mapping, num_half_hops=2, fan_out_caps=None,
+        closure_cache=None, verbose=False):
     all_neighbors = {
         'eres': set([]),
         'clusters': set([]),
@@ -136,121 +250,133 @@ def find_neighbors_for_entry_point(
     }
 
     # search for all zero-hop neighbors
-    ere_closure_zero, cluster_closure_zero, cluster_memberships_zero = \
+    frontier_eres, frontier_clusters, frontier_memberships = \
         find_coref_closure(
-            starting_eres, neighbors_mapping, start_from_ere=True)
-
-    if verbose:
-        print('\nEREs zero-hop from the entry point: \n{}'.format(
-            '\n'.join(ere_closure_zero)))
-        print('\nClusters zero-hop from the entry point: \n{}'.format(
-            '\n'.join(cluster_closure_zero)))
-        print('\nClusterMemberships zero-hop from the entry point: \n{}'.format(
-            '\n'.join(map(str, cluster_memberships_zero))))
-
-    all_neighbors['eres'].update(ere_closure_zero)
-    all_neighbors['clusters'].update(cluster_closure_zero)
-    all_neighbors['cluster_memberships'].update(cluster_memberships_zero)
-
-    # search for typing statements of zero-hop EREs
-    # (considered as zero-hops neighbors)
-    typing_zero = find_typing_statements(ere_closure_zero, neighbors_mapping)
-
-    if verbose:
-        print('\nTyping statements of zero-hop ERE closure: \n{}'.format(
-            '\n'.join(map(str, typing_zero))))
-
-    all_neighbors['typing_statements'].update(typing_zero)
-
-    # search for half-hop neighbors, as well as corresponding statements
-    statements_half, ere_closure_half, cluster_closure_half, \
-        cluster_membership_half = find_half_hop_neighbors(
-            ere_closure_zero, neighbors_mapping)
+            starting_eres, neighbors_mapping, start_from_ere=True,
+            closure_cache=closure_cache)
+
+    for hop_idx in range(num_half_hops + 1):
+        # search for typing statements of EREs in the current hop
+        # (considered as neighbors of the same hop)
+        frontier_typing = find_typing_statements(
+            frontier_eres, neighbors_mapping)
+
+        if verbose:
+            print_hop_neighbors(
+                hop_name(hop_idx), frontier_eres, frontier_clusters,
+                frontier_memberships, frontier_typing)
+
+        all_neighbors['eres'].update(frontier_eres)
+        all_neighbors['clusters'].update(frontier_clusters)
+        all_neighbors['cluster_memberships'].update(frontier_memberships)
+        all_neighbors['typing_statements'].update(frontier_typing)
+
+        if hop_idx == num_half_hops or not frontier_eres:
+            break
+
+        # search for neighbors of the next hop, as well as corresponding
+        # statements. Nodes reached in earlier hops are excluded, as their
+        # coref closures are already part of the result.
+        statements, frontier_eres, frontier_clusters, frontier_memberships = \
+            find_half_hop_neighbors(
+                frontier_eres, neighbors_mapping,
+                max_fan_out=fan_out_cap_for_hop(fan_out_caps, hop_idx),
+                excluded_nodes=all_neighbors['eres'] |
+                all_neighbors['clusters'],
+                closure_cache=closure_cache)
+
+        if verbose:
+            print('\nStatements connecting {} and {} EREs: \n{}'.format(
+                hop_name(hop_idx), hop_name(hop_idx + 1),
+                '\n'.join(map(str, statements))))
+
+        all_neighbors['general_statements'].update(statements)
 
-    if verbose:
-        print('\nStatements connecting zero-hop and half-hop EREs: \n{}'.format(
-            '\n'.join(map(str, statements_half))))
-
-        print('\nEREs half-hop from the entry point: \n{}'.format(
-            '\n'.join(ere_closure_half)))
-        print('\nClusters half-hop from the entry point: \n{}'.format(
-            '\n'.join(cluster_closure_half)))
-        print('\nClusterMemberships half-hop from the entry point: \n{}'.format(
-            '\n'.join(map(str, cluster_membership_half))))
-
-    all_neighbors['general_statements'].update(statements_half)
-
-    all_neighbors['eres'].update(ere_closure_half)
-    all_neighbors['clusters'].update(cluster_closure_half)
-    all_neighbors['cluster_memberships'].update(cluster_membership_half)
+    return all_neighbors
 
-    # search for typing statements of half-hop EREs
-    # (considered as half-hops neighbors)
-    typing_half = find_typing_statements(ere_closure_half, neighbors_mapping)
 
-    if verbose:
-        print('\nTyping statements of half-hop ERE closure: \n{}'.format(
-            '\n'.join(map(str, typing_half))))
+# Find the neighbors for the entry points of every query in query_paths,
+# sharing the coref closures between queries, and write the result of each
+# query to output_dir, under the same file name as the query.
+def find_neighbors_for_query_batch(
+        query_paths, neighbors_mapping, output_dir, num_half_hops=2,
+        fan_out_caps=None, verbose=False):
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
 
-    all_neighbors['typing_statements'].update(typing_half)
+    closure_cache = {}
 
-    # search for one-hop neighbors, as well as corresponding statements
-    statements_one, ere_closure_one, cluster_closure_one, \
-        cluster_membership_one = find_half_hop_neighbors(
-            ere_closure_half, neighbors_mapping)
+    for query_idx, query_path in enumerate(query_paths):
+        print('Processing query {} of {}: {}'.format(
+            query_idx + 1, len(query_paths), query_path))
+        with open(str(query_path), 'r') as fin:
+            aida_query = json.load(fin)
 
-    if verbose:
-        print('\nStatements connecting half-hop and one-hop EREs: \n{}'.format(
-            '\n'.join(map(str, statements_one))))
+        all_neighbors = find_neighbors_for_entry_point(
+            get_starting_eres(aida_query), neighbors_mapping,
+            num_half_hops=num_half_hops, fan_out_caps=fan_out_caps,
+            closure_cache=closure_cache, verbose=verbose)
 
-        print('\nEREs one-hop from the entry point: \n{}'.format(
-            '\n'.join(ere_closure_one)))
-        print('\nClusters one-hop from the entry point: \n{}'.format(
-            '\n'.join(cluster_closure_one)))
-        print('\nClusterMemberships one-hop from the entry point: \n{}'.format(
-            '\n'.join(map(str, cluster_membership_one))))
+        write_all_neighbors(
+            all_neighbors, str(output_dir / Path(query_path).name))
 
-    all_neighbors['general_statements'].update(statements_one)
+    print('Computed {} distinct coref closures for {} queries'.format(
+        len(set(map(id, closure_cache.values()))), len(query_paths)))
 
-    all_neighbors['eres'].update(ere_closure_one)
-    all_neighbors['clusters'].update(cluster_closure_one)
-    all_neighbors['cluster_memberships'].update(cluster_membership_one)
 
-    # search for typing statements of one-hop EREs
-    # (considered as one-hops neighbors)
-    typing_one = find_typing_statements(ere_closure_one, neighbors_mapping)
+def get_starting_eres(aida_query):
+    starting_eres = set([])
+    for cluster, mentions in aida_query['coref'].items():
+        starting_eres.update(mentions)
+    # for entry_point in aida_query['entrypoints']:
+    #     starting_eres.update(entry_point['ere'])
+    return starting_eres
 
-    if verbose:
-        print('\nTyping statements of one-hop ERE closure: \n{}'.format(
-            '\n'.join(map(str, typing_one))))
 
-    all_neighbors['typing_statements'].update(typing_one)
+def write_all_neighbors(all_neighbors, output_path):
+    # convert sets to lists for json dump
+    all_neighbors = {key: list(val) for key, val in all_neighbors.items()}
 
-    return all_neighbors
+    with open(output_path, 'w') as fout:
+        json.dump(all_neighbors, fout, indent=2)
 
 
 def main():
     parser = ArgumentParser()
     parser.add_argument('query_path',
-                        help='path to aidaquery.json')
+                        help='path to aidaquery.json, or to a directory of '
+                             'query json files (batch mode)')
     parser.add_argument('neighbors_mapping_path',
                         help='path to neighbors_mapping.json file')
-    parser.add_argument('output_path', help='path to write output')
+    parser.add_argument('output_path',
+                        help='path to write output, or to an output directory '
+                             'in batch mode')
+    parser.add_argument('--num_half_hops', type=int, default=2,
+                        help='number of half-hops to expand from the entry '
+                             'points (default: 2, i.e., one-hop neighbors)')
+    parser.add_argument('--fan_out_caps', default=None,
+                        help='comma-separated list of fan-out caps per hop, '
+                             'EREs with more statements than the cap are not '
+                             'expanded; "none" means no cap, the last value '
+                             'applies to all further hops (e.g. "none,200")')
     parser.add_argument('--verbose', '-v', action='store_true')
 
     args = parser.parse_args()
 
-    with open(args.query_path, 'r') as fin:
-        aida_query = json.load(fin)
+    fan_out_caps = parse_fan_out_caps(args.fan_out_caps)
 
-    # entry_points = set(args.entry_points.split(','))
+    query_path = Path(args.query_path)
+    if query_path.is_dir():
+        query_paths = sorted(query_path.glob('*.json'))
+        print('Found {} query files in {}'.format(
+            len(query_paths), query_path))
+    else:
+        with open(args.query_path, 'r') as fin:
+            aida_query = json.load(fin)
 
-    starting_eres = set([])
-    for cluster, mentions in aida_query['coref'].items():
-        starting_eres.update(mentions)
-    # for entry_point in aida_query['entrypoints']:
-    #     starting_eres.update(entry_point['ere'])
-    print('Looking for neighbors of entry points: {}'.format(starting_eres))
+        starting_eres = get_starting_eres(aida_query)
+        print('Looking for neighbors of entry points: {}'.format(
+            starting_eres))
 
     neighbors_mapping_path = args.neighbors_mapping_path
     print('Loading neighbor information from {}...'.format(
@@ -258,15 +384,18 @@ def main():
     with open(neighbors_mapping_path, 'r') as fin:
         neighbors_mapping = json.load(fin)
 
-    all_neighbors = find_neighbors_for_entry_point(
-        starting_eres, neighbors_mapping, verbose=args.verbose)
+    if query_path.is_dir():
+        find_neighbors_for_query_batch(
+            query_paths, neighbors_mapping, args.output_path,
+            num_half_hops=args.num_half_hops, fan_out_caps=fan_out_caps,
+            verbose=args.verbose)
+        return
 
-    # convert sets to lists for json dump
-    for key in all_neighbors:
-        all_neighbors[key] = list(all_neighbors[key])
+    all_neighbors = find_neighbors_for_entry_point(
+        starting_eres, neighbors_mapping, num_half_hops=args.num_half_hops,
+        fan_out_caps=fan_out_caps, verbose=args.verbose)
 
-    with open(args.output_path, 'w') as fout:
-        json.dump(all_neighbors, fout, indent=2)
+    write_all_neighbors(all_neighbors, args.output_path)
 
 
 if __name__ == '__main__':
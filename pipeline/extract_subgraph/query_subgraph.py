@@ -2,11 +2,22 @@
 # pre- and postprocessing for the AIDA eval
 
 import json
+import sys
 from argparse import ArgumentParser
 from pathlib import Path
 
 from pipeline.sparql_helper import *
 
+HEADER_PREFIXES = \
+    '@prefix rdf:   <http://www.w3.org/1999/02/22-rdf-syntax-ns#> .\n' \
+    '@prefix aida:  <https://tac.nist.gov/tracks/SM-KBP/2018/ontologies/' \
+    'InterchangeOntology#> .\n'
+
+QUERY_PREFIXES = \
+    'PREFIX rdf:   <http://www.w3.org/1999/02/22-rdf-syntax-ns#>\n' \
+    'PREFIX aida:  <https://tac.nist.gov/tracks/SM-KBP/2018/ontologies/' \
+    'InterchangeOntology#>\n\n'
+
 parser = ArgumentParser()
 parser.add_argument('all_neighbors_path', help='path to all_neighbors.json')
 parser.add_argument('db_path_prefix', help='prefix of tdb database path')
@@ -14,6 +25,17 @@ parser.add_argument('output_dir', help='path to output directory')
 parser.add_argument('--dry_run', action='store_true',
                     help='if specified, only write the SPARQL queries to files,'
                          'without actually executing the queries')
+parser.add_argument('--local_index', default=None,
+                    help='path to a local KB index built by '
+                         'pipeline/preprocessing/build_local_kb_index.py; if '
+                         'specified, extract the subgraph in-process from the '
+                         'index instead of querying the tdb databases')
+parser.add_argument('--neighbors_mapping_path', default=None,
+                    help='path to neighbors_mapping.json, used to estimate '
+                         'the cost of each statement for balancing queries')
+parser.add_argument('--max_cost_per_query', type=int, default=3000,
+                    help='estimated cost (number of statements if no '
+                         'neighbors mapping is given) per statement query')
 
 args = parser.parse_args()
 
@@ -25,6 +47,33 @@ if not exists(output_dir):
 with open(args.all_neighbors_path, 'r') as fin:
     all_neighbors = json.load(fin)
 
+if args.local_index is not None:
+    from rdflib.term import URIRef
+    from pipeline.local_subgraph import LocalKBIndex, write_subgraph
+
+    print('Loading local KB index from {}'.format(args.local_index))
+    kb_index = LocalKBIndex.load(args.local_index)
+
+    node_list = [URIRef(node) for node in
+                 all_neighbors['eres'] + all_neighbors['clusters']]
+    stmt_pair_list = [(URIRef(subj), URIRef(obj)) for subj, obj in
+                      all_neighbors['typing_statements'] +
+                      all_neighbors['general_statements']]
+    cm_pair_list = [(URIRef(member), URIRef(cluster)) for member, cluster in
+                    all_neighbors['cluster_memberships']]
+
+    print('Extracting {} nodes, {} statements and {} cluster memberships'.format(
+        len(node_list), len(stmt_pair_list), len(cm_pair_list)))
+    subgraph_triples = kb_index.extract_subgraph(
+        node_list=node_list, stmt_pair_list=stmt_pair_list,
+        cm_pair_list=cm_pair_list)
+
+    subgraph_path = join(output_dir, 'subgraph-raw.ttl')
+    print('Writing {} triples to {}'.format(
+        len(subgraph_triples), subgraph_path))
+    write_subgraph(subgraph_triples, subgraph_path)
+    sys.exit(0)
+
 db_path_prefix = Path(args.db_path_prefix)
 db_path_list = [str(path) for path in sorted(db_path_prefix.glob('copy*'))]
 print('Using the following tdb databases to query: {}'.format(db_path_list))
@@ -36,41 +85,48 @@ for node in all_neighbors['eres'] + all_neighbors['clusters']:
 
 print('Found {} nodes to query'.format(len(node_query_element_list)))
 
-node_query_prefix = 'DESCRIBE '
 num_node_queries = len(db_path_list)
 
 node_query_list = produce_node_queries(
-    node_query_element_list, num_node_queries=num_node_queries,
-    node_query_prefix=node_query_prefix)
+    node_query_element_list, num_node_queries=num_node_queries)
 
 # queries for all general and typing Statements, and ClusterMemberships
-stmt_query_element_list = []
-for subj, obj in all_neighbors['typing_statements'] + \
-                 all_neighbors['general_statements']:
-    stmt_query_element_list.append(
-        '{{\n?x rdf:subject <{}> .\n?x rdf:object <{}> .\n}}'.format(
-            subj, obj))
-
-for member, cluster in all_neighbors['cluster_memberships']:
-    stmt_query_element_list.append(
-        '{{\n?x aida:cluster <{}> .\n?x aida:clusterMember <{}> .\n}}'.format(
-            cluster, member))
-
-print('Found {} statements to query'.format(len(stmt_query_element_list)))
-
-num_stmts_per_query = 3000
-
-stmt_query_prefix = \
-    'PREFIX rdf:   <http://www.w3.org/1999/02/22-rdf-syntax-ns#>\n' \
-    'PREFIX aida:  <https://tac.nist.gov/tracks/SM-KBP/2018/ontologies/' \
-    'InterchangeOntology#>\n\n' \
-    'DESCRIBE ?x\n' \
-    'WHERE {'
-
-stmt_query_list = produce_stmt_queries(
-    stmt_query_element_list, stmt_query_prefix=stmt_query_prefix,
-    num_stmts_per_query=num_stmts_per_query)
+stmt_pair_list = [
+    tuple(pair) for pair in
+    all_neighbors['typing_statements'] + all_neighbors['general_statements']]
+cm_pair_list = [tuple(pair) for pair in all_neighbors['cluster_memberships']]
+
+print('Found {} statements and {} cluster memberships to query'.format(
+    len(stmt_pair_list), len(cm_pair_list)))
+
+# estimate the cost of each statement / cluster membership from the number
+# of statements / clusters of its subject / member in the neighbor index,
+# so that queries are balanced by expected result size rather than by count
+stmt_cost_list = None
+cm_cost_list = None
+if args.neighbors_mapping_path is not None:
+    print('Loading neighbor information from {}...'.format(
+        args.neighbors_mapping_path))
+    with open(args.neighbors_mapping_path, 'r') as fin:
+        neighbors_mapping = json.load(fin)
+
+    stmt_cost_list = [
+        1 + len(neighbors_mapping['half-hop-subj'].get(subj, [])) +
+        len(neighbors_mapping['zero-hop-typing'].get(subj, []))
+        for subj, _ in stmt_pair_list]
+    cm_cost_list = [
+        1 + len(neighbors_mapping['zero-hop-ere'].get(member, []))
+        for member, _ in cm_pair_list]
+
+stmt_query_list = \
+    produce_stmt_values_queries(
+        stmt_pair_list, query_prefixes=QUERY_PREFIXES,
+        item_costs=stmt_cost_list, max_cost_per_query=args.max_cost_per_query) + \
+    produce_cm_values_queries(
+        cm_pair_list, query_prefixes=QUERY_PREFIXES,
+        item_costs=cm_cost_list, max_cost_per_query=args.max_cost_per_query)
 
 execute_sparql_queries(
-    node_query_list, stmt_query_list, db_path_list, output_dir,
-    filename_prefix='subgraph', num_header_lines=7, dry_run=args.dry_run)
+    node_query_list, stmt_query_list, [], [], db_path_list, output_dir,
+    filename_prefix='subgraph', header_prefixes=HEADER_PREFIXES,
+    dry_run=args.dry_run)
@@ -1,9 +1,19 @@
+import hashlib
+import json
+import os
+from array import array
 from collections import Counter, defaultdict
+from functools import lru_cache
 
 
-def build_cluster_member_mappings(graph_json, debug=False):
+def build_cluster_member_mappings(graph_json, debug=False, cluster_mappings=None):
     # Build mappings between clusters and members, and mappings between
-    # clusters and prototypes
+    # clusters and prototypes.
+    # cluster_mappings: optionally, the mappings from load_or_build_cluster_mappings,
+    # so that the ClusterMembership and SameAsCluster nodes of the graph do not need
+    # to be scanned. This needs the cluster_membership_key_mapping, which only the
+    # persisted mappings of a graph json have: with the mappings of a KB directory
+    # (as written by process_soin.py), the graph is scanned anyway.
     print('\nBuilding mappings among clusters, members and prototypes ...')
 
     cluster_to_members = defaultdict(set)
@@ -13,28 +23,41 @@ def build_cluster_member_mappings(graph_json, debug=False):
     cluster_to_prototype = {}
     prototype_to_clusters = defaultdict(set)
 
-    for node_label, node in graph_json['theGraph'].items():
-        if node['type'] == 'ClusterMembership':
-            cluster = node.get('cluster', None)
-            member = node.get('clusterMember', None)
-            assert cluster is not None and member is not None
+    if cluster_mappings is not None and \
+            cluster_mappings['cluster_membership_key_mapping'] is not None:
+        for member, clusters in cluster_mappings['member_to_clusters'].items():
+            for cluster in clusters:
+                cluster_to_members[cluster].add(member)
+                member_to_clusters[member].add(cluster)
+        for key, node_labels in cluster_mappings['cluster_membership_key_mapping'].items():
+            cluster_membership_key_mapping[key].update(node_labels)
+        for cluster, prototype in cluster_mappings['cluster_to_prototype'].items():
+            cluster_to_prototype[cluster] = prototype
+            prototype_to_clusters[prototype].add(cluster)
 
-            cluster_to_members[cluster].add(member)
-            member_to_clusters[member].add(cluster)
+    else:
+        for node_label, node in graph_json['theGraph'].items():
+            if node['type'] == 'ClusterMembership':
+                cluster = node.get('cluster', None)
+                member = node.get('clusterMember', None)
+                assert cluster is not None and member is not None
 
-            if debug and (cluster, member) in cluster_membership_key_mapping:
-                print('Warning: found duplicate ClusterMembership nodes for ({}, {})'.format(
-                    cluster, member))
-            cluster_membership_key_mapping[(cluster, member)].add(node_label)
+                cluster_to_members[cluster].add(member)
+                member_to_clusters[member].add(cluster)
 
-        elif node['type'] == 'SameAsCluster':
-            assert node_label not in cluster_to_prototype
+                if debug and (cluster, member) in cluster_membership_key_mapping:
+                    print('Warning: found duplicate ClusterMembership nodes for ({}, {})'.format(
+                        cluster, member))
+                cluster_membership_key_mapping[(cluster, member)].add(node_label)
+
+            elif node['type'] == 'SameAsCluster':
+                assert node_label not in cluster_to_prototype
 
-            prototype = node.get('prototype', None)
-            assert prototype is not None
+                prototype = node.get('prototype', None)
+                assert prototype is not None
 
-            cluster_to_prototype[node_label] = prototype
-            prototype_to_clusters[prototype].add(node_label)
+                cluster_to_prototype[node_label] = prototype
+                prototype_to_clusters[prototype].add(node_label)
 
     num_clusters = len(cluster_to_members)
     num_members = len(member_to_clusters)
@@ -131,3 +154,226 @@ def build_cluster_member_mappings(graph_json, debug=False):
     }
 
     return mappings
+
+
+###################################
+# Persisted cluster mappings:
+# cluster -> prototype, member -> clusters and entity -> roles, computed
+# once per graph and stored next to the graph snapshot (a graph json or a
+# directory of KB files), with a fingerprint of the snapshot, so that later
+# runs can load them instead of scanning the whole graph.
+#
+# On disk, all labels are kept once in a "labels" list and the mappings
+# refer to them by position:
+#   cluster_to_prototype: [cluster, prototype, cluster, prototype, ...]
+#   member_to_clusters: [[member, cluster, cluster, ...], ...]
+#   entity_to_roles: [[entity, role, role, ...], ...]
+#   cluster_membership_key_mapping (optional): [[cluster, member, node label, ...], ...]
+# ClusterMembership nodes are usually blank nodes, whose labels are only
+# stable in a graph json, so the last mapping is only stored for those.
+# Consequently only the persisted mappings of a graph json let
+# build_cluster_member_mappings skip its scan of the graph.
+
+
+def cluster_mappings_path(snapshot_path):
+    # the path of the persisted cluster mappings of a graph json or KB directory
+    return os.path.normpath(snapshot_path) + '.cluster_mappings.json'
+
+
+def snapshot_fingerprint(snapshot_paths):
+    # a fingerprint of the names, sizes and modification times of files
+    hasher = hashlib.sha1()
+    for path in sorted(snapshot_paths):
+        stat = os.stat(path)
+        hasher.update('{}\t{}\t{}\n'.format(os.path.basename(path), stat.st_size, stat.st_mtime_ns).encode())
+    return hasher.hexdigest()
+
+
+def cluster_mappings_from_graph_json(graph_json):
+    # compute the mappings to be persisted from a graph json
+    cluster_to_prototype = {}
+    member_to_clusters = defaultdict(set)
+    entity_to_roles = defaultdict(set)
+    cluster_membership_key_mapping = defaultdict(set)
+
+    for node_label, node in graph_json['theGraph'].items():
+        if node['type'] == 'ClusterMembership':
+            member_to_clusters[node['clusterMember']].add(node['cluster'])
+            cluster_membership_key_mapping[(node['cluster'], node['clusterMember'])].add(node_label)
+        elif node['type'] == 'SameAsCluster':
+            cluster_to_prototype[node_label] = node['prototype']
+        elif node['type'] == 'Statement' and node.get('predicate', 'type') != 'type':
+            if 'object' in node:
+                entity_to_roles[node['object']].add(node['predicate'].strip())
+
+    return {
+        'cluster_to_prototype': cluster_to_prototype,
+        'member_to_clusters': member_to_clusters,
+        'entity_to_roles': entity_to_roles,
+        'cluster_membership_key_mapping': cluster_membership_key_mapping,
+    }
+
+
+def save_cluster_mappings(path, fingerprint, cluster_mappings):
+    # write cluster mappings (as returned by cluster_mappings_from_graph_json)
+    # with the fingerprint of the snapshot they were computed from
+    label_ids = {}
+
+    def label_id(label):
+        if label not in label_ids:
+            label_ids[label] = len(label_ids)
+        return label_ids[label]
+
+    cluster_to_prototype = []
+    for cluster, prototype in cluster_mappings['cluster_to_prototype'].items():
+        cluster_to_prototype.extend([label_id(cluster), label_id(prototype)])
+    member_to_clusters = [
+        [label_id(member)] + sorted(label_id(cluster) for cluster in clusters)
+        for member, clusters in cluster_mappings['member_to_clusters'].items()]
+    entity_to_roles = [
+        [label_id(entity)] + sorted(label_id(role) for role in roles)
+        for entity, roles in cluster_mappings['entity_to_roles'].items()]
+
+    persisted = {
+        'fingerprint': fingerprint,
+        'cluster_to_prototype': cluster_to_prototype,
+        'member_to_clusters': member_to_clusters,
+        'entity_to_roles': entity_to_roles,
+    }
+    if cluster_mappings.get('cluster_membership_key_mapping', None) is not None:
+        persisted['cluster_membership_key_mapping'] = [
+            [label_id(cluster), label_id(member)] + sorted(label_id(node_label) for node_label in node_labels)
+            for (cluster, member), node_labels in cluster_mappings['cluster_membership_key_mapping'].items()]
+    persisted['labels'] = list(label_ids.keys())
+
+    with open(path, 'w') as fout:
+        json.dump(persisted, fout, separators=(',', ':'))
+
+
+def load_cluster_mappings(path, fingerprint=None):
+    # read persisted cluster mappings. Returns None if there are none, or if
+    # they were computed from a snapshot with another fingerprint
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as fin:
+        persisted = json.load(fin)
+    if fingerprint is not None and persisted['fingerprint'] != fingerprint:
+        return None
+
+    labels = persisted['labels']
+    flat = persisted['cluster_to_prototype']
+    cluster_mappings = {
+        'cluster_to_prototype': dict((labels[flat[i]], labels[flat[i + 1]]) for i in range(0, len(flat), 2)),
+        'member_to_clusters': dict(
+            (labels[row[0]], set(labels[c] for c in row[1:])) for row in persisted['member_to_clusters']),
+        'entity_to_roles': dict(
+            (labels[row[0]], set(labels[r] for r in row[1:])) for row in persisted['entity_to_roles']),
+        'cluster_membership_key_mapping': None,
+    }
+    if 'cluster_membership_key_mapping' in persisted:
+        cluster_mappings['cluster_membership_key_mapping'] = dict(
+            ((labels[row[0]], labels[row[1]]), set(labels[n] for n in row[2:]))
+            for row in persisted['cluster_membership_key_mapping'])
+    return cluster_mappings
+
+
+def load_or_build_cluster_mappings(graph_json, graph_json_path):
+    # persisted cluster mappings for a graph json file, computed and saved
+    # next to it if they are missing or out of date
+    path = cluster_mappings_path(graph_json_path)
+    fingerprint = snapshot_fingerprint([graph_json_path])
+    cluster_mappings = load_cluster_mappings(path, fingerprint)
+    if cluster_mappings is None:
+        cluster_mappings = cluster_mappings_from_graph_json(graph_json)
+        try:
+            save_cluster_mappings(path, fingerprint, cluster_mappings)
+        except OSError as e:
+            print('Warning: could not save cluster mappings to {}: {}'.format(path, e))
+    return cluster_mappings
+
+
+class HopLayerIndex:
+    # Index over a graph json for repeated k-hop subgraph extraction
+    # (see crop_subgraph_json.extract_subgraph). EREs and statements get
+    # integer ids, the adjacent statements of each ERE are kept as id
+    # tuples, and the k-hop expansions of single EREs are memoized in an
+    # LRU cache of cache_size entries. A subgraph around a set of
+    # statements is then the union of the memoized expansions of their
+    # EREs, so overlapping extractions share most of their work.
+    def __init__(self, graph_json, cache_size=100000):
+        the_graph = graph_json['theGraph']
+
+        self.ere_labels = [
+            label for label, node in the_graph.items()
+            if node['type'] in ['Entity', 'Relation', 'Event']]
+        self.ere_ids = {label: idx for idx, label in enumerate(self.ere_labels)}
+
+        self.stmt_labels = [
+            label for label, node in the_graph.items()
+            if node['type'] == 'Statement']
+        self.stmt_ids = {label: idx for idx, label in enumerate(self.stmt_labels)}
+
+        # subject and object ERE ids of each statement, -1 if not an ERE
+        self.stmt_subject = array('l', (
+            self.ere_ids.get(the_graph[label].get('subject', None), -1)
+            for label in self.stmt_labels))
+        self.stmt_object = array('l', (
+            self.ere_ids.get(the_graph[label].get('object', None), -1)
+            for label in self.stmt_labels))
+        self.stmt_is_typing = bytearray(
+            the_graph[label].get('predicate', None) == 'type'
+            for label in self.stmt_labels)
+
+        self.ere_adjacent = [
+            tuple(self.stmt_ids[stmt_label]
+                  for stmt_label in the_graph[label]['adjacent']
+                  if stmt_label in self.stmt_ids)
+            for label in self.ere_labels]
+
+        self.expansion = lru_cache(maxsize=cache_size)(self._expansion)
+
+    def _expansion(self, ere_id, num_hops):
+        # Map each ERE within num_hops hops of ere_id to its hop distance.
+        # Cached, so callers must not modify the result.
+        distance = {ere_id: 0}
+        frontier = [ere_id]
+        for hop_idx in range(1, num_hops + 1):
+            next_frontier = []
+            for this_ere in frontier:
+                for stmt_id in self.ere_adjacent[this_ere]:
+                    for other_ere in (self.stmt_subject[stmt_id], self.stmt_object[stmt_id]):
+                        if other_ere >= 0 and other_ere not in distance:
+                            distance[other_ere] = hop_idx
+                            next_frontier.append(other_ere)
+            frontier = next_frontier
+        return distance
+
+    def extract(self, statements, num_hops=2):
+        # Return the labels of EREs and statements in the subgraph around
+        # statements: EREs within num_hops hops of the EREs of statements,
+        # statements adjacent to EREs within num_hops - 1 hops, and typing
+        # statements of EREs at num_hops hops.
+        zero_hop_stmts = set(
+            self.stmt_ids[stmt_label] for stmt_label in statements)
+
+        distance = {}
+        for stmt_id in zero_hop_stmts:
+            for ere_id in (self.stmt_subject[stmt_id], self.stmt_object[stmt_id]):
+                if ere_id < 0 or distance.get(ere_id, None) == 0:
+                    continue
+                for other_ere, hops in self.expansion(ere_id, num_hops).items():
+                    if hops < distance.get(other_ere, num_hops + 1):
+                        distance[other_ere] = hops
+
+        stmt_ids = set(zero_hop_stmts)
+        for ere_id, hops in distance.items():
+            if hops < num_hops:
+                stmt_ids.update(self.ere_adjacent[ere_id])
+            else:
+                stmt_ids.update(
+                    stmt_id for stmt_id in self.ere_adjacent[ere_id]
+                    if self.stmt_is_typing[stmt_id] and
+                    self.stmt_subject[stmt_id] == ere_id)
+
+        return set(self.ere_labels[ere_id] for ere_id in distance), \
+            set(self.stmt_labels[stmt_id] for stmt_id in stmt_ids)
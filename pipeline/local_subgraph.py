@@ -0,0 +1,121 @@
+# pre- and postprocessing for the AIDA eval
+# in-process subgraph extraction from a pre-built local index of the KB,
+# answering the same requests as the DESCRIBE queries in sparql_helper
+# without running tdbquery on TDB copies.
+
+import pickle
+from collections import defaultdict
+
+from rdflib import Graph
+from rdflib.namespace import RDF
+from rdflib.term import BNode
+
+from pipeline.rdflib_helper import AIDA, LDC, LDC_ONT
+
+
+# in-memory index over all triples of a KB, grouped by subject, with
+# additional lookups for Statement nodes by (subject, object) and
+# ClusterMembership nodes by (cluster, member).
+# build it once with pipeline/preprocessing/build_local_kb_index.py,
+# then load it with LocalKBIndex.load.
+class LocalKBIndex:
+    def __init__(self):
+        # subject -> list of (predicate, object)
+        self.po_by_subject = defaultdict(list)
+        # (rdf:subject, rdf:object) -> set of Statement nodes
+        self.stmts_by_subj_obj = defaultdict(set)
+        # (aida:cluster, aida:clusterMember) -> set of ClusterMembership nodes
+        self.cms_by_cluster_member = defaultdict(set)
+
+    # build the index from a list of .ttl files
+    @classmethod
+    def from_ttl(cls, kb_paths, verbose=True):
+        index = cls()
+        for kb_path in kb_paths:
+            if verbose:
+                print('Reading triples from {}...'.format(kb_path))
+            kb_graph = Graph()
+            kb_graph.parse(str(kb_path), format='ttl')
+            index.add_graph(kb_graph)
+        return index
+
+    def add_graph(self, kb_graph):
+        for s, p, o in kb_graph:
+            self.po_by_subject[s].append((p, o))
+
+        for stmt in kb_graph.subjects(predicate=RDF.type, object=RDF.Statement):
+            for subj in kb_graph.objects(subject=stmt, predicate=RDF.subject):
+                for obj in kb_graph.objects(subject=stmt, predicate=RDF.object):
+                    self.stmts_by_subj_obj[(subj, obj)].add(stmt)
+
+        for cm in kb_graph.subjects(predicate=RDF.type, object=AIDA.ClusterMembership):
+            for cluster in kb_graph.objects(subject=cm, predicate=AIDA.cluster):
+                for member in kb_graph.objects(subject=cm, predicate=AIDA.clusterMember):
+                    self.cms_by_cluster_member[(cluster, member)].add(cm)
+
+    def save(self, index_path):
+        with open(str(index_path), 'wb') as fout:
+            pickle.dump(self.__dict__, fout, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, index_path):
+        index = cls()
+        with open(str(index_path), 'rb') as fin:
+            index.__dict__.update(pickle.load(fin))
+        return index
+
+    # triples describing a node, i.e., all triples with the node as the subject,
+    # plus recursively the triples of all blank nodes reached as objects
+    # (the default DESCRIBE behavior of Jena, a.k.a. concise bounded description)
+    def describe(self, node):
+        triples = set()
+        visited = {node}
+        stack = [node]
+
+        while stack:
+            subj = stack.pop()
+            for pred, obj in self.po_by_subject.get(subj, []):
+                triples.add((subj, pred, obj))
+                if isinstance(obj, BNode) and obj not in visited:
+                    visited.add(obj)
+                    stack.append(obj)
+
+        return triples
+
+    # Statement nodes with the given subject and object (for typing
+    # statements, the object is the type)
+    def statements_for(self, subj, obj):
+        return self.stmts_by_subj_obj.get((subj, obj), set())
+
+    # ClusterMembership nodes with the given cluster and member
+    def cluster_memberships_for(self, cluster, member):
+        return self.cms_by_cluster_member.get((cluster, member), set())
+
+    # triples describing all nodes in node_list, and all Statement and
+    # ClusterMembership nodes matching the (subject, object) pairs in
+    # stmt_pair_list and the (member, cluster) pairs in cm_pair_list
+    def extract_subgraph(self, node_list=(), stmt_pair_list=(), cm_pair_list=()):
+        described = set(node_list)
+        for subj, obj in stmt_pair_list:
+            described.update(self.statements_for(subj, obj))
+        for member, cluster in cm_pair_list:
+            described.update(self.cluster_memberships_for(cluster, member))
+
+        triples = set()
+        for node in described:
+            triples.update(self.describe(node))
+        return triples
+
+
+# write a set of triples to output_path in Turtle format
+def write_subgraph(triples, output_path):
+    subgraph = Graph()
+    subgraph.namespace_manager.bind('aida', AIDA)
+    subgraph.namespace_manager.bind('ldc', LDC)
+    subgraph.namespace_manager.bind('ldcOnt', LDC_ONT)
+    subgraph.namespace_manager.bind('rdf', RDF)
+
+    for triple in triples:
+        subgraph.add(triple)
+
+    subgraph.serialize(destination=str(output_path), format='turtle')
@@ -4,7 +4,7 @@ from argparse import ArgumentParser
 from operator import itemgetter
 from pathlib import Path
 
-from pipeline.json_graph_helper import build_cluster_member_mappings
+from pipeline.json_graph_helper import build_cluster_member_mappings, load_or_build_cluster_mappings
 
 update_prefix = \
     'PREFIX ldcOnt: <https://tac.nist.gov/tracks/SM-KBP/2019/ontologies/LDCOntology#>\n' \
@@ -61,6 +61,9 @@ def main():
     parser.add_argument('output_dir', help='Directory to write queries')
     parser.add_argument('--top', default=14, type=int,
                         help='number of top hypothesis to output')
+    parser.add_argument('--no_cluster_mappings_cache', action='store_true',
+                        help='always scan the graph for the cluster mappings instead of loading them '
+                             'from, and saving them to, <graph_json_path>.cluster_mappings.json')
 
     args = parser.parse_args()
 
@@ -70,7 +73,10 @@ def main():
     with open(graph_json_path, 'r') as fin:
         graph_json = json.load(fin)
 
-    member_to_clusters = build_cluster_member_mappings(graph_json)['member_to_clusters']
+    cluster_mappings = None
+    if not args.no_cluster_mappings_cache:
+        cluster_mappings = load_or_build_cluster_mappings(graph_json, graph_json_path)
+    member_to_clusters = build_cluster_member_mappings(graph_json, cluster_mappings=cluster_mappings)['member_to_clusters']
 
     hypotheses_json_path = Path(args.hypotheses_json_path)
     assert hypotheses_json_path.exists(), '{} does not exist'.format(hypotheses_json_path)
@@ -13,7 +13,7 @@ from rdflib.plugins.serializers.turtle import TurtleSerializer
 from rdflib.plugins.serializers.turtle import VERB
 from rdflib.term import BNode, Literal, URIRef
 
-from pipeline.json_graph_helper import build_cluster_member_mappings
+from pipeline.json_graph_helper import build_cluster_member_mappings, load_or_build_cluster_mappings
 from pipeline.rdflib_helper import AIDA, LDC, LDC_ONT
 from pipeline.rdflib_helper import catalogue_kb_nodes, triples_for_subject
 from pipeline.rdflib_helper import triples_for_edge_stmt, triples_for_type_stmt, triples_for_ere
@@ -469,6 +469,9 @@ def main():
     parser.add_argument('run_id', help='run ID')
     parser.add_argument('--top', default=14, type=int,
                         help='number of top hypothesis to output')
+    parser.add_argument('--no_cluster_mappings_cache', action='store_true',
+                        help='always scan the graph for the cluster mappings instead of loading them '
+                             'from, and saving them to, <graph_json_path>.cluster_mappings.json')
 
     args = parser.parse_args()
 
@@ -478,7 +481,10 @@ def main():
     with open(graph_json_path, 'r') as fin:
         graph_json = json.load(fin)
 
-    graph_mappings = build_cluster_member_mappings(graph_json)
+    cluster_mappings = None
+    if not args.no_cluster_mappings_cache:
+        cluster_mappings = load_or_build_cluster_mappings(graph_json, graph_json_path)
+    graph_mappings = build_cluster_member_mappings(graph_json, cluster_mappings=cluster_mappings)
 
     hypotheses_json_dir = Path(args.hypotheses_json_dir)
     assert hypotheses_json_dir.is_dir(), '{} does not exist'.format(hypotheses_json_dir)
@@ -9,7 +9,8 @@ src_path = dirname(dirname(dirname(realpath(__file__))))
 sys.path.insert(0, src_path)
 
 from pipeline.sparql_helper import *
-from pipeline.json_graph_helper import build_cluster_member_mappings
+from pipeline.query_cache import QueryResultCache
+from pipeline.json_graph_helper import build_cluster_member_mappings, load_or_build_cluster_mappings
 
 AIF_HEADER_PREFIXES = \
     '@prefix ldcOnt: <https://tac.nist.gov/tracks/SM-KBP/2019/ontologies/LDCOntology#> .\n' \
@@ -255,9 +256,12 @@ def queries_for_aida_result(
                     '?j aida:confidence ?c .\n'
                     '}}'.format(proto_stmt_constraint))
 
-    node_query_item_list = list(set(ere_query_item_list)) + list(set(cluster_query_item_list))
-    stmt_query_item_list = list(set(stmt_query_item_list))
-    just_query_item_list = list(set(just_query_item_list))
+    # deduplicate and sort the items, so that the same hypothesis always
+    # produces the same query text, and cached query results can be reused
+    node_query_item_list = sorted(set(ere_query_item_list)) + sorted(set(cluster_query_item_list))
+    stmt_query_item_list = sorted(set(stmt_query_item_list))
+    just_query_item_list = sorted(set(just_query_item_list))
+    conf_query_item_list = sorted(set(conf_query_item_list))
 
     node_query_list = produce_node_queries(
         node_query_item_list, num_node_queries=num_node_queries)
@@ -290,6 +294,28 @@ def main():
                              'files, without actually executing the queries')
     parser.add_argument('--query_just', action='store_true')
     parser.add_argument('--query_conf', action='store_true')
+    parser.add_argument('--max_concurrency', default=None, type=int,
+                        help='number of queries to run concurrently '
+                             '(default: one per tdb database copy)')
+    parser.add_argument('--max_retries', default=2, type=int,
+                        help='number of times to retry a failed query')
+    parser.add_argument('--query_timeout', default=None, type=float,
+                        help='timeout in seconds for a single query')
+    parser.add_argument('--sort_merged', action='store_true',
+                        help='if specified, group the triples in the merged '
+                             'query result by subject')
+    parser.add_argument('--cache_dir', default=None,
+                        help='if specified, reuse query results cached in '
+                             'this directory from previous runs')
+    parser.add_argument('--cache_size_mb', default=None, type=int,
+                        help='maximum size of the query result cache in MB')
+    parser.add_argument('--cache_key', default=None,
+                        help='a name for the KB version loaded into the tdb databases; '
+                             'if specified, it identifies cached results instead of the '
+                             'content of the databases, which then need not be read')
+    parser.add_argument('--no_cluster_mappings_cache', action='store_true',
+                        help='always scan the graph for the cluster mappings instead of loading them '
+                             'from, and saving them to, <graph_json_path>.cluster_mappings.json')
 
     args = parser.parse_args()
 
@@ -299,7 +325,10 @@ def main():
     with open(graph_json_path, 'r') as fin:
         graph_json = json.load(fin)
 
-    mappings = build_cluster_member_mappings(graph_json)
+    cluster_mappings = None
+    if not args.no_cluster_mappings_cache:
+        cluster_mappings = load_or_build_cluster_mappings(graph_json, graph_json_path)
+    mappings = build_cluster_member_mappings(graph_json, cluster_mappings=cluster_mappings)
     member_to_clusters = mappings['member_to_clusters']
     cluster_to_prototype = mappings['cluster_to_prototype']
     prototype_set = set(mappings['prototype_to_clusters'].keys())
@@ -324,6 +353,14 @@ def main():
 
     num_node_queries = len(db_path_list)
 
+    cache = None
+    if args.cache_dir is not None:
+        cache = QueryResultCache(
+            args.cache_dir,
+            max_size=args.cache_size_mb * 1024 * 1024
+            if args.cache_size_mb is not None else None,
+            kb_version=args.cache_key)
+
     top_count = 0
     for result_idx, prob in sorted(
             enumerate(hypotheses_json['probs']), key=itemgetter(1), reverse=True):
@@ -348,7 +385,10 @@ def main():
             node_query_list, stmt_query_list, just_query_list, conf_query_list,
             db_path_list, args.output_dir,
             filename_prefix='hypothesis-{:0>3d}'.format(top_count),
-            header_prefixes=AIF_HEADER_PREFIXES, dry_run=args.dry_run)
+            header_prefixes=AIF_HEADER_PREFIXES, dry_run=args.dry_run,
+            max_concurrency=args.max_concurrency, max_retries=args.max_retries,
+            query_timeout=args.query_timeout,
+            sort_merged_result=args.sort_merged, cache=cache)
 
         if top_count >= args.top:
             break
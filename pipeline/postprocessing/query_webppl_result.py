@@ -74,8 +74,8 @@ def queries_for_aida_result(
             '{{\n?x rdf:subject {} .\n'
             '?x rdf:predicate rdf:type .\n}}'.format(ere))
 
-    node_query_item_list = list(set(ere_query_item_list + cluster_query_item_list))
-    stmt_query_item_list = list(set(stmt_query_item_list))
+    node_query_item_list = sorted(set(ere_query_item_list + cluster_query_item_list))
+    stmt_query_item_list = sorted(set(stmt_query_item_list))
 
     node_query_list = produce_node_queries(
         node_query_item_list, num_node_queries=num_node_queries,
@@ -85,9 +85,11 @@ for compressed_hypothesis in input_hypotheses_json["support"]:
             original_stmt_entry = original_graph_json['theGraph'][original_stmt]
 
             # Add the cluster membership between the original subject and each subject cluster
+            # that it belongs to (a compressed ERE can stand for several clusters)
             stmt_subj = original_stmt_entry['subject']
             for stmt_subj_cluster in stmt_subj_clusters:
-                cluster_membership_set.add((stmt_subj, stmt_subj_cluster))
+                if stmt_subj_cluster in input_log_json['member_to_clusters'].get(stmt_subj, stmt_subj_clusters):
+                    cluster_membership_set.add((stmt_subj, stmt_subj_cluster))
 
             if is_type_stmt:
                 assert original_stmt_entry['predicate'] == 'type'
@@ -97,7 +99,8 @@ for compressed_hypothesis in input_hypotheses_json["support"]:
                 # Add the cluster membership between the original object and each object cluster
                 stmt_obj = original_stmt_entry['object']
                 for stmt_obj_cluster in stmt_obj_clusters:
-                    cluster_membership_set.add((stmt_obj, stmt_obj_cluster))
+                    if stmt_obj_cluster in input_log_json['member_to_clusters'].get(stmt_obj, stmt_obj_clusters):
+                        cluster_membership_set.add((stmt_obj, stmt_obj_cluster))
 
     for original_stmt, stmt_weight in original_stmt_weight_mapping.items():
         original_hypothesis['statements'].append(original_stmt)
@@ -1,11 +1,9 @@
-import itertools
 import json
 import sys
 from argparse import ArgumentParser
 from collections import defaultdict, Counter
 from os.path import dirname, realpath
 from pathlib import Path
-from pipeline.json_graph_helper import build_cluster_member_mappings
 
 src_path = dirname(dirname(dirname(realpath(__file__))))
 sys.path.insert(0, src_path)
@@ -13,129 +11,287 @@ sys.path.insert(0, src_path)
 from aif import AidaJson
 
 
-def make_stmt_keys(stmt_entry, member_to_prototypes):
-    subj = stmt_entry["subject"]
-    if subj in member_to_prototypes:
-        new_subj_set = member_to_prototypes[subj]
-    else:
-        print('Warning: statement subject {} not found in '
-              'any ClusterMembership node'.format(subj))
-        new_subj_set = {subj}
+class LabelIndex:
+    # Assigns consecutive integer ids to node labels
+    def __init__(self):
+        self.label_to_id = {}
+        self.id_to_label = []
 
-    pred = stmt_entry["predicate"]
+    def __len__(self):
+        return len(self.id_to_label)
 
-    obj = stmt_entry["object"]
-    if pred != 'type':
-        if obj in member_to_prototypes:
-            new_obj_set = member_to_prototypes[obj]
-        else:
-            print('Warning: statement object {} not found in '
-                  'any ClusterMembership node'.format(obj))
-            new_obj_set = {obj}
-    else:
-        new_obj_set = {obj}
+    def __contains__(self, label):
+        return label in self.label_to_id
 
-    return [(new_subj, pred, new_obj) for new_subj, new_obj
-            in itertools.product(new_subj_set, new_obj_set)]
+    def get(self, label):
+        return self.label_to_id.get(label, None)
 
+    def add(self, label):
+        label_id = self.label_to_id.get(label, None)
+        if label_id is None:
+            label_id = len(self.id_to_label)
+            self.label_to_id[label] = label_id
+            self.id_to_label.append(label)
+        return label_id
 
-def build_mappings(input_graph_json):
-    # Build mappings among clusters, members, and prototypes
-    mappings = build_cluster_member_mappings(input_graph_json)
+    def label(self, label_id):
+        return self.id_to_label[label_id]
+
+
+class UnionFind:
+    # Union-find over integer ids, with path halving and union by size
+    def __init__(self):
+        self.parent = []
+        self.size = []
+
+    def grow(self, num_ids):
+        while len(self.parent) < num_ids:
+            self.parent.append(len(self.parent))
+            self.size.append(1)
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, x, y):
+        x = self.find(x)
+        y = self.find(y)
+        if x == y:
+            return x
+        if self.size[x] < self.size[y]:
+            x, y = y, x
+        self.parent[y] = x
+        self.size[x] += self.size[y]
+        return x
 
-    # Build mappings from old statement labels to new statement labels
-    stmt_count = 0
 
+def build_mappings(input_graph_json):
+    # Build compact mappings among clusters, members and prototypes:
+    # EREs are interned as integer ids, and each member is unified with the
+    # prototypes of all clusters it belongs to. Each connected component is
+    # compressed into a single ERE, named after its prototype with the lowest
+    # ERE index. Statements then need a single key each, rather than the
+    # cartesian product of the prototype sets of their subject and object.
+    print('\nBuilding mappings among clusters, members and prototypes ...')
+
+    the_graph = input_graph_json['theGraph']
+
+    # The ERE nodes of the graph get ids below num_eres, cluster members and
+    # prototypes that are not ERE nodes get the ids after them
+    eres = LabelIndex()
+    for node_label, node in the_graph.items():
+        if node['type'] in ['Entity', 'Relation', 'Event']:
+            eres.add(node_label)
+    num_eres = len(eres)
+
+    cluster_to_prototype = {}
+    cluster_memberships = defaultdict(list)
+
+    for node_label, node in the_graph.items():
+        if node['type'] == 'ClusterMembership':
+            cluster = node.get('cluster', None)
+            member = node.get('clusterMember', None)
+            assert cluster is not None and member is not None
+            cluster_memberships[cluster].append((node_label, eres.add(member)))
+
+        elif node['type'] == 'SameAsCluster':
+            assert node_label not in cluster_to_prototype
+
+            prototype = node.get('prototype', None)
+            assert prototype is not None
+            cluster_to_prototype[node_label] = eres.add(prototype)
+
+    assert len(cluster_to_prototype) == len(cluster_memberships)
+
+    # Unify each member with the prototypes of its clusters
+    union_find = UnionFind()
+    union_find.grow(len(eres))
+    is_member = [False] * len(eres)
+
+    for cluster, memberships in cluster_memberships.items():
+        prototype = cluster_to_prototype[cluster]
+        for _, member in memberships:
+            union_find.union(member, prototype)
+            is_member[member] = True
+
+    # ERE nodes that are not connected to any ClusterMembership node
+    # are their own prototypes. This shouldn't happen, unless the TA2 output
+    # we get don't conform to the NIST-restricted formatting requirements.
+    is_prototype = [False] * len(eres)
+    for prototype in cluster_to_prototype.values():
+        is_prototype[prototype] = True
+
+    num_eres_not_in_clusters = sum(
+        1 for ere in range(num_eres) if not is_member[ere])
+    if num_eres_not_in_clusters > 0:
+        print('\nWarning: Found {} ERE nodes that are not connected to any '
+              'ClusterMembership node'.format(num_eres_not_in_clusters))
+        print('Adding them to the mappings between members and prototypes')
+
+    # The representative of each component is its prototype with the lowest ERE index
+    def ere_index(ere):
+        return the_graph[eres.label(ere)].get('index', ere)
+
+    representative = {}
+    for ere in range(len(eres)):
+        if is_prototype[ere] or not is_member[ere]:
+            root = union_find.find(ere)
+            if root not in representative or ere_index(ere) < ere_index(representative[root]):
+                representative[root] = ere
+
+    ere_to_new_ere = [representative[union_find.find(ere)] for ere in range(len(eres))]
+
+    num_members = sum(1 for ere in range(len(eres)) if is_member[ere] or ere < num_eres)
+    num_new_eres = len(representative)
+    print('\nConstructed mapping from {} members in {} clusters to {} compressed EREs'.format(
+        num_members, len(cluster_to_prototype), num_new_eres))
+
+    prototypes_per_new_ere_counter = Counter(
+        ere_to_new_ere[prototype] for prototype in set(cluster_to_prototype.values()))
+    num_merged = sum(1 for count in prototypes_per_new_ere_counter.values() if count > 1)
+    if num_merged > 0:
+        print('\tFor {} out of {} compressed EREs, multiple prototypes were merged '
+              'through shared members'.format(num_merged, num_new_eres))
+
+    # Build mappings from old statement labels to new statement ids,
+    # deduplicating statements by their (subject, predicate, object) key
     stmt_key_to_new_stmt = {}
-    new_stmt_to_stmt_key = {}
-    old_stmt_to_new_stmts = defaultdict(set)
-    new_stmt_to_old_stmts = defaultdict(set)
+    old_stmt_to_new_stmt = {}
+    new_stmt_to_old_stmts = []
+    new_stmt_keys = []
 
-    for node_label, node in input_graph_json['theGraph'].items():
+    for node_label, node in the_graph.items():
         if node['type'] == 'Statement':
-            stmt_keys = make_stmt_keys(
-                stmt_entry=node, member_to_prototypes=mappings['member_to_prototypes'])
-            for stmt_key in stmt_keys:
-                if stmt_key not in stmt_key_to_new_stmt:
-                    new_stmt_label = 'Statement-{}'.format(stmt_count)
-                    stmt_count += 1
-                    stmt_key_to_new_stmt[stmt_key] = new_stmt_label
-                    new_stmt_to_stmt_key[new_stmt_label] = stmt_key
-                else:
-                    new_stmt_label = stmt_key_to_new_stmt[stmt_key]
-
-                old_stmt_to_new_stmts[node_label].add(new_stmt_label)
-                new_stmt_to_old_stmts[new_stmt_label].add(node_label)
-
-    num_old_stmts = len(old_stmt_to_new_stmts)
-    num_new_stmts = len(new_stmt_to_old_stmts)
-
-    assert len(stmt_key_to_new_stmt) == num_new_stmts
-    assert len(new_stmt_to_stmt_key) == num_new_stmts
+            stmt_key = make_stmt_key(node, eres, ere_to_new_ere)
+            new_stmt = stmt_key_to_new_stmt.get(stmt_key, None)
+            if new_stmt is None:
+                new_stmt = len(new_stmt_keys)
+                stmt_key_to_new_stmt[stmt_key] = new_stmt
+                new_stmt_keys.append(stmt_key)
+                new_stmt_to_old_stmts.append([])
+
+            old_stmt_to_new_stmt[node_label] = new_stmt
+            new_stmt_to_old_stmts[new_stmt].append(node_label)
+
+    # The keys are only needed for deduplication
+    del stmt_key_to_new_stmt
 
     print(
         '\nConstructed mapping from {} old statements to {} new '
         'statements'.format(
-            num_old_stmts, num_new_stmts))
+            len(old_stmt_to_new_stmt), len(new_stmt_keys)))
+
+    return {
+        'eres': eres,
+        'num_eres': num_eres,
+        'ere_to_new_ere': ere_to_new_ere,
+        'is_member': is_member,
+        'is_prototype': is_prototype,
+        'cluster_to_prototype': cluster_to_prototype,
+        'cluster_memberships': cluster_memberships,
+        'old_stmt_to_new_stmt': old_stmt_to_new_stmt,
+        'new_stmt_to_old_stmts': new_stmt_to_old_stmts,
+        'new_stmt_keys': new_stmt_keys
+    }
+
+
+def make_stmt_key(stmt_entry, eres, ere_to_new_ere):
+    def new_ere_label(label, role):
+        ere = eres.get(label)
+        if ere is None:
+            print('Warning: statement {} {} not found in '
+                  'any ClusterMembership node'.format(role, label))
+            return label
+        return eres.label(ere_to_new_ere[ere])
+
+    subj = new_ere_label(stmt_entry['subject'], 'subject')
+    pred = stmt_entry['predicate']
+    if pred != 'type':
+        obj = new_ere_label(stmt_entry['object'], 'object')
+    else:
+        obj = stmt_entry['object']
 
-    new_stmts_per_old_stmt_counter = Counter(
-        [len(v) for v in old_stmt_to_new_stmts.values()])
-    for key in sorted(new_stmts_per_old_stmt_counter.keys()):
-        if key > 1:
-            print(
-                '\tFor {} out of {} old statements, each is mapped to {} new '
-                'statements'.format(
-                    new_stmts_per_old_stmt_counter[key], num_old_stmts, key))
+    return subj, pred, obj
 
-    mappings.update({
-        'stmt_key_to_new_stmt': stmt_key_to_new_stmt,
-        'new_stmt_to_stmt_key': new_stmt_to_stmt_key,
-        'old_stmt_to_new_stmts': old_stmt_to_new_stmts,
-        'new_stmt_to_old_stmts': new_stmt_to_old_stmts
-    })
 
-    return mappings
+def new_stmt_label(new_stmt):
+    return 'Statement-{}'.format(new_stmt)
 
 
-def compress_eres(input_graph_json, mappings, output_graph_json):
-    if 'theGraph' not in output_graph_json:
-        output_graph_json['theGraph'] = {}
+def each_new_ere(mappings):
+    # Yield (new ERE, members, clusters) for each compressed ERE. The members
+    # are all cluster members, and all ERE nodes of the graph that are not
+    # members of any cluster, including prototypes outside their own clusters,
+    # so that their statements, names and types are kept in the compressed ERE
+    eres = mappings['eres']
+    ere_to_new_ere = mappings['ere_to_new_ere']
+
+    new_ere_to_eres = defaultdict(list)
+    for ere, new_ere in enumerate(ere_to_new_ere):
+        new_ere_to_eres[new_ere].append(ere)
+
+    new_ere_to_clusters = defaultdict(list)
+    for cluster, prototype in mappings['cluster_to_prototype'].items():
+        new_ere_to_clusters[ere_to_new_ere[prototype]].append(cluster)
+
+    for new_ere in sorted(new_ere_to_eres.keys()):
+        members = [eres.label(ere) for ere in new_ere_to_eres[new_ere]
+                   if mappings['is_member'][ere] or ere < mappings['num_eres']]
+        yield eres.label(new_ere), members, new_ere_to_clusters[new_ere]
 
-    if 'ere' not in output_graph_json:
-        output_graph_json['ere'] = []
-    else:
-        assert len(output_graph_json['ere']) == 0
 
+class JsonObjectWriter:
+    # Writes a json object one (key, value) pair at a time
+    def __init__(self, fout, indent=0):
+        self.fout = fout
+        self.indent = indent
+        self.first = True
+        self.fout.write('{')
+
+    def write(self, key, value):
+        if not self.first:
+            self.fout.write(',')
+        self.first = False
+        self.fout.write('\n{}{}: {}'.format(
+            ' ' * (self.indent + 2), json.dumps(key), json.dumps(value)))
+
+    def close(self):
+        self.fout.write('\n{}}}'.format(' ' * self.indent))
+
+
+def compress_eres(input_graph_json, mappings, graph_writer):
     print('\nBuilding ERE / SameAsCluster / ClusterMembership entries '
           'for the compressed graph')
 
-    num_new_eres = 0
+    the_graph = input_graph_json['theGraph']
+    new_ere_list = []
 
-    for prototype, members in mappings['prototype_to_members'].items():
-        old_entry = input_graph_json['theGraph'][prototype]
+    for new_ere, members, clusters in each_new_ere(mappings):
+        old_entry = the_graph[new_ere]
 
         # Use the same ERE index from the original graph
         new_entry = {'index': old_entry['index']}
 
-        member_entry_list = [input_graph_json['theGraph'][member] for member in
-                             members]
+        member_entry_list = [the_graph[member] for member in members if member in the_graph]
 
         # Resolve the type of the compressed ERE node
         type_set = set(
             member_entry['type'] for member_entry in member_entry_list)
-        # if len(type_set) > 1:
-        #     type_set.remove('Entity')
         if len(type_set) > 1:
             print('Error: multiple types {} from the following EREs {}'.format(
                 type_set, members))
-        new_entry['type'] = type_set.pop()
+        new_entry['type'] = old_entry['type'] if old_entry['type'] in type_set else type_set.pop()
 
         # Resolve the adjacent statements of the compressed ERE node
         adjacency_set = set()
         for member_entry in member_entry_list:
             for old_stmt in member_entry['adjacent']:
-                adjacency_set.update(
-                    mappings['old_stmt_to_new_stmts'][old_stmt])
+                if old_stmt in mappings['old_stmt_to_new_stmt']:
+                    adjacency_set.add(
+                        new_stmt_label(mappings['old_stmt_to_new_stmt'][old_stmt]))
         new_entry['adjacent'] = list(adjacency_set)
 
         # Resolve the names of the compressed ERE node
@@ -143,9 +299,8 @@ def compress_eres(input_graph_json, mappings, output_graph_json):
         for member_entry in member_entry_list:
             if 'name' in member_entry:
                 name_set.update(member_entry['name'])
-        for cluster in mappings['prototype_to_clusters'][prototype]:
-            cluster_handle = input_graph_json['theGraph'][cluster].get('handle',
-                                                                       None)
+        for cluster in clusters:
+            cluster_handle = the_graph[cluster].get('handle', None)
             if cluster_handle is not None and cluster_handle != '[unknown]':
                 name_set.add(cluster_handle)
         if len(name_set) > 0:
@@ -159,54 +314,47 @@ def compress_eres(input_graph_json, mappings, output_graph_json):
         if len(ldc_time_list) > 0:
             new_entry['ldcTime'] = ldc_time_list
 
-        output_graph_json['theGraph'][prototype] = new_entry
-        output_graph_json['ere'].append(prototype)
-
-        # Add SameAsCluster nodes and ClusterMembership nodes
-        for cluster in mappings['prototype_to_clusters'][prototype]:
-            same_as_cluster_entry = input_graph_json['theGraph'][cluster]
-            output_graph_json['theGraph'][cluster] = same_as_cluster_entry
+        graph_writer.write(new_ere, new_entry)
+        new_ere_list.append(new_ere)
 
-            for cluster_membership_key in \
-                    mappings['cluster_membership_key_mapping'][(cluster, prototype)]:
-                cluster_membership_entry = input_graph_json['theGraph'][
-                    cluster_membership_key]
-                output_graph_json['theGraph'][
-                    cluster_membership_key] = cluster_membership_entry
+        # Add SameAsCluster nodes, and the ClusterMembership nodes of their
+        # prototypes. Prototypes merged into another compressed ERE are
+        # replaced by that ERE.
+        for cluster in clusters:
+            graph_writer.write(cluster, the_graph[cluster])
 
-        num_new_eres += 1
+            prototype = mappings['eres'].label(mappings['cluster_to_prototype'][cluster])
+            for cluster_membership_key, member in mappings['cluster_memberships'][cluster]:
+                if mappings['eres'].label(member) != prototype:
+                    continue
+                cluster_membership_entry = the_graph[cluster_membership_key]
+                if prototype != new_ere:
+                    cluster_membership_entry = dict(cluster_membership_entry, clusterMember=new_ere)
+                graph_writer.write(cluster_membership_key, cluster_membership_entry)
 
     print('\tDone')
 
-    return num_new_eres
+    return new_ere_list
 
 
-def compress_statements(input_graph_json, mappings, output_graph_json):
+def compress_statements(input_graph_json, mappings, graph_writer):
     print('\nBuilding statement entries for the compressed graph')
 
-    if 'theGraph' not in output_graph_json:
-        output_graph_json['theGraph'] = {}
+    the_graph = input_graph_json['theGraph']
+    new_stmt_list = []
 
-    if 'statements' not in output_graph_json:
-        output_graph_json['statements'] = []
-    else:
-        assert len(output_graph_json['statements']) == 0
-
-    num_new_stmts = 0
-
-    for new_stmt, stmt_key in mappings['new_stmt_to_stmt_key'].items():
-        stmt_idx = int(new_stmt.split('-')[1])
+    for new_stmt, stmt_key in enumerate(mappings['new_stmt_keys']):
         subj, pred, obj = stmt_key
         new_entry = {
             'type': 'Statement',
-            'index': stmt_idx,
+            'index': new_stmt,
             'subject': subj,
             'predicate': pred,
             'object': obj
         }
 
         old_stmt_entry_list = [
-            input_graph_json['theGraph'][old_stmt]
+            the_graph[old_stmt]
             for old_stmt in mappings['new_stmt_to_old_stmts'][new_stmt]]
 
         # Resolve the extra information (source and hypotheses) of the new
@@ -221,13 +369,64 @@ def compress_statements(input_graph_json, mappings, output_graph_json):
             if len(label_value_set) > 0:
                 new_entry[label] = list(label_value_set)
 
-        output_graph_json['theGraph'][new_stmt] = new_entry
-        output_graph_json['statements'].append(new_stmt)
-        num_new_stmts += 1
+        graph_writer.write(new_stmt_label(new_stmt), new_entry)
+        new_stmt_list.append(new_stmt_label(new_stmt))
 
     print('\tDone')
 
-    return num_new_stmts
+    return new_stmt_list
+
+
+def write_log(mappings, fout):
+    # Write the compression log one mapping at a time, in the format
+    # expected by recover_coref_new.py
+    eres = mappings['eres']
+    ere_to_new_ere = mappings['ere_to_new_ere']
+
+    member_to_clusters = defaultdict(list)
+    for cluster, memberships in mappings['cluster_memberships'].items():
+        for _, member in memberships:
+            member_to_clusters[member].append(cluster)
+
+    fout.write('{')
+    first_mapping = True
+
+    def write_mapping(mapping_key, items):
+        nonlocal first_mapping
+        fout.write('{}\n  {}: '.format('' if first_mapping else ',', json.dumps(mapping_key)))
+        first_mapping = False
+        mapping_writer = JsonObjectWriter(fout, indent=2)
+        for key, value in items:
+            mapping_writer.write(key, value)
+        mapping_writer.close()
+
+    write_mapping('cluster_to_members', (
+        (cluster, sorted(set(eres.label(member) for _, member in memberships)))
+        for cluster, memberships in mappings['cluster_memberships'].items()))
+    write_mapping('member_to_clusters', (
+        (eres.label(member), sorted(set(clusters)))
+        for member, clusters in member_to_clusters.items()))
+    write_mapping('cluster_to_prototype', (
+        (cluster, eres.label(ere_to_new_ere[prototype]))
+        for cluster, prototype in mappings['cluster_to_prototype'].items()))
+
+    new_ere_entries = list(each_new_ere(mappings))
+    write_mapping('prototype_to_clusters', (
+        (new_ere, clusters) for new_ere, _, clusters in new_ere_entries))
+    write_mapping('member_to_prototypes', (
+        (member, [new_ere]) for new_ere, members, _ in new_ere_entries for member in members))
+    write_mapping('prototype_to_members', (
+        (new_ere, members) for new_ere, members, _ in new_ere_entries))
+    del new_ere_entries
+
+    write_mapping('old_stmt_to_new_stmts', (
+        (old_stmt, [new_stmt_label(new_stmt)])
+        for old_stmt, new_stmt in mappings['old_stmt_to_new_stmt'].items()))
+    write_mapping('new_stmt_to_old_stmts', (
+        (new_stmt_label(new_stmt), old_stmts)
+        for new_stmt, old_stmts in enumerate(mappings['new_stmt_to_old_stmts'])))
+
+    fout.write('\n}\n')
 
 
 def main():
@@ -256,38 +455,30 @@ def main():
     num_old_stmts = len(list(aida_json.each_statement()))
     print('\nFound {} EREs and {} statements in the original graph'.format(
         num_old_eres, num_old_stmts))
+    del aida_json
 
     mappings = build_mappings(input_graph_json)
 
-    output_graph_json = {'theGraph': {}, 'ere': [], 'statements': []}
-
-    num_new_eres = compress_eres(input_graph_json, mappings, output_graph_json)
-    num_new_stmts = compress_statements(input_graph_json, mappings,
-                                        output_graph_json)
-
-    print(
-        '\nFinished coref-compressed graph with {} EREs and {} '
-        'statements'.format(
-            num_new_eres, num_new_stmts))
-
     output_graph_path = Path(args.output_graph_path)
     print('\nWriting compressed json graph to {}'.format(output_graph_path))
     with open(output_graph_path, 'w') as fout:
-        json.dump(output_graph_json, fout, indent=2)
+        fout.write('{\n  "theGraph": ')
+        graph_writer = JsonObjectWriter(fout, indent=2)
+        new_ere_list = compress_eres(input_graph_json, mappings, graph_writer)
+        new_stmt_list = compress_statements(input_graph_json, mappings, graph_writer)
+        graph_writer.close()
+        fout.write(',\n  "ere": {},\n  "statements": {}\n}}\n'.format(
+            json.dumps(new_ere_list), json.dumps(new_stmt_list)))
 
-    log_json = {}
-    for mapping_key, mapping in mappings.items():
-        if 'key' in mapping_key:
-            continue
-        if mapping_key.endswith('s'):
-            log_json[mapping_key] = {k: list(v) for k, v in mapping.items()}
-        else:
-            log_json[mapping_key] = mapping
+    print(
+        '\nFinished coref-compressed graph with {} EREs and {} '
+        'statements'.format(
+            len(new_ere_list), len(new_stmt_list)))
 
     output_log_path = Path(args.output_log_path)
     print('\nWriting compression log to {}'.format(output_log_path))
     with open(output_log_path, 'w') as fout:
-        json.dump(log_json, fout, indent=2)
+        write_log(mappings, fout)
 
 
 if __name__ == '__main__':
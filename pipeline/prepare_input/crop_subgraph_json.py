@@ -1,7 +1,23 @@
 import argparse
 import json
+import multiprocessing
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from os.path import dirname, realpath
 from pathlib import Path
-from copy import deepcopy
+
+src_path = dirname(dirname(dirname(realpath(__file__))))
+sys.path.insert(0, src_path)
+
+from pipeline.json_graph_helper import HopLayerIndex
+
+
+# the graph json and hop layer index shared by worker processes in batch
+# mode. They are loaded once before the workers are forked, so that they do
+# not need to load or unpickle them.
+_shared_graph_json = None
+_shared_hop_index = None
 
 
 def stmts_to_eres(graph, hop_idx, this_hop_stmts, nodes_so_far, verbose=False):
@@ -82,8 +98,10 @@ def nodes_to_subgraph(graph, nodes_dict):
         'statements': []
     }
 
+    # Entries are shared with the full graph rather than copied, only
+    # the adjacent lists of EREs are filtered into new entries
     for ere_label in nodes_dict['eres']:
-        ere_entry = deepcopy(graph['theGraph'][ere_label])
+        ere_entry = graph['theGraph'][ere_label]
 
         assert ere_entry['type'] in ['Entity', 'Relation', 'Event']
 
@@ -91,13 +109,13 @@ def nodes_to_subgraph(graph, nodes_dict):
             stmt_label for stmt_label in ere_entry['adjacent']
             if stmt_label in nodes_dict['stmts']
         ]
-        ere_entry['adjacent'] = adjacent_stmts
+        ere_entry = dict(ere_entry, adjacent=adjacent_stmts)
 
         subgraph['theGraph'][ere_label] = ere_entry
         subgraph['ere'].append(ere_label)
 
     for stmt_label in nodes_dict['stmts']:
-        stmt_entry = deepcopy(graph['theGraph'][stmt_label])
+        stmt_entry = graph['theGraph'][stmt_label]
 
         assert stmt_entry['type'] == 'Statement'
         assert stmt_entry['subject'] in subgraph['theGraph']
@@ -110,7 +128,59 @@ def nodes_to_subgraph(graph, nodes_dict):
     return subgraph
 
 
-def extract_subgraph(graph, statements, num_hops=2, verbose=False):
+def print_hop_layers(graph, statements, subgraph_stmts, num_hops=2):
+    # Print the details of each hop for a subgraph extracted by a
+    # HopLayerIndex, the same as extract_subgraph does without the index.
+    # The hop layers are recovered by walking the statements of the
+    # subgraph only, which are all the statements the walk can reach.
+    nodes_so_far = {
+        'stmts': set(),
+        'general_stmts': set(),
+        'typing_stmts': set(),
+        'eres': set(),
+        'entities': set(),
+        'relations': set(),
+        'events': set()
+    }
+
+    last_hop_eres = stmts_to_eres(
+        graph=graph, hop_idx=0, this_hop_stmts=set(statements),
+        nodes_so_far=nodes_so_far, verbose=True)
+
+    for hop_idx in range(1, num_hops + 1):
+        this_hop_stmts = set()
+
+        for ere_label in last_hop_eres:
+            for stmt_label in graph['theGraph'][ere_label]['adjacent']:
+                if stmt_label not in nodes_so_far['stmts'] and \
+                        stmt_label in subgraph_stmts:
+                    this_hop_stmts.add(stmt_label)
+
+        last_hop_eres = stmts_to_eres(
+            graph=graph, hop_idx=hop_idx, this_hop_stmts=this_hop_stmts,
+            nodes_so_far=nodes_so_far, verbose=True)
+
+    # the remaining statements are typing statements of the last hop EREs
+    extra_typing_stmts = subgraph_stmts - nodes_so_far['stmts']
+
+    print('\n\tAfter hop-{}'.format(num_hops))
+    print('\tFound {} extra typing statements (cumulative = {})'.format(
+        len(extra_typing_stmts),
+        len(nodes_so_far['typing_stmts']) + len(extra_typing_stmts)))
+
+
+def extract_subgraph(graph, statements, num_hops=2, verbose=False,
+                     hop_index=None):
+    # With a HopLayerIndex over graph, the hop layers are computed from
+    # the memoized expansions of the index instead
+    if hop_index is not None:
+        eres, stmts = hop_index.extract(statements, num_hops=num_hops)
+        if verbose:
+            print_hop_layers(graph, statements, stmts, num_hops)
+        print('\tFound {} EREs and {} statements after {} hops'.format(
+            len(eres), len(stmts), num_hops))
+        return nodes_to_subgraph(graph, {'eres': eres, 'stmts': stmts})
+
     nodes_so_far = {
         'stmts': set(),
         'general_stmts': set(),
@@ -169,13 +239,98 @@ def extract_subgraph(graph, statements, num_hops=2, verbose=False):
     return subgraph
 
 
+def crop_hypothesis(graph, statements, output_path, num_hops=2,
+                    verbose=False, hop_index=None):
+    start_time = time.time()
+    subgraph = extract_subgraph(
+        graph=graph,
+        statements=statements,
+        num_hops=num_hops,
+        verbose=verbose,
+        hop_index=hop_index
+    )
+    print('Writing subgraph json to {}'.format(output_path))
+    with open(output_path, 'w') as fout:
+        json.dump(subgraph, fout, indent=2)
+
+    return len(subgraph['ere']), len(subgraph['statements']), \
+        time.time() - start_time
+
+
+def _crop_hypothesis_in_worker(statements, output_path, num_hops, verbose):
+    return crop_hypothesis(
+        _shared_graph_json, statements, output_path, num_hops=num_hops,
+        verbose=verbose, hop_index=_shared_hop_index)
+
+
+def each_crop_task(seed_file_list, output_dir):
+    # Yield (statements, output path) for each hypothesis in each seed file.
+    # With more than one seed file, the subgraphs of each seed file are
+    # written to a subdirectory named after it.
+    for seed_file in seed_file_list:
+        print('\nLoading cluster seeds from {}'.format(seed_file))
+        with open(seed_file, 'r') as fin:
+            seed_json = json.load(fin)
+        print('\tDone.')
+
+        seed_output_dir = output_dir
+        if len(seed_file_list) > 1:
+            seed_output_dir = output_dir / seed_file.stem
+            if not seed_output_dir.exists():
+                seed_output_dir.mkdir()
+
+        for hypothesis_idx, (prob, hypothesis) in enumerate(
+                zip(seed_json['probs'], seed_json['support'])):
+            print('\nExtracting subgraph for hypothesis # {} with prob = {}'.format(
+                hypothesis_idx, prob))
+            yield hypothesis['statements'], \
+                seed_output_dir / f'subgraph_{hypothesis_idx}.json'
+
+
+def crop_batch(graph_json, seed_file_list, output_dir, num_hops=2,
+               num_workers=1, verbose=False, hop_index=None):
+    # Crop subgraphs for all hypotheses in all seed files, in a pool of
+    # num_workers processes sharing the loaded graph and hop layer index.
+    # Returns a list of (output path, #EREs, #statements, seconds) per crop.
+    global _shared_graph_json, _shared_hop_index
+
+    crop_tasks = each_crop_task(seed_file_list, output_dir)
+
+    if num_workers <= 1:
+        return [(output_path,) + crop_hypothesis(
+                    graph_json, statements, output_path, num_hops=num_hops,
+                    verbose=verbose, hop_index=hop_index)
+                for statements, output_path in crop_tasks]
+
+    _shared_graph_json = graph_json
+    _shared_hop_index = hop_index
+    with ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = [(output_path, executor.submit(
+                        _crop_hypothesis_in_worker, statements, output_path,
+                        num_hops, verbose))
+                   for statements, output_path in crop_tasks]
+        return [(output_path,) + future.result()
+                for output_path, future in futures]
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('graph_file', help='path to the graph json file')
-    parser.add_argument('seed_file', help='path to the cluster seed file')
+    parser.add_argument('seed_file',
+                        help='path to the cluster seed file, or to a directory '
+                             'of cluster seed files')
     parser.add_argument('output_dir', help='path to the output directory')
     parser.add_argument('--num_hops', '-n', type=int, default=2,
                         help='number of hops to extend from')
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                        help='number of worker processes to crop subgraphs in')
+    parser.add_argument('--no_hop_index', action='store_true',
+                        help='compute hop layers from scratch for each hypothesis '
+                             'instead of using a shared hop layer index')
+    parser.add_argument('--hop_cache_size', type=int, default=100000,
+                        help='number of ERE expansions to keep in the hop layer index')
     parser.add_argument('--verbose', '-v', action='store_true',
                         help='print more details in each hop of extraction')
 
@@ -189,30 +344,33 @@ def main():
     print('\tDone.')
 
     seed_file = Path(args.seed_file)
-    assert seed_file.is_file(), '{} does not exist!'.format(seed_file)
-    print('\nLoading cluster seeds from {}'.format(seed_file))
-    with open(seed_file, 'r') as fin:
-        seed_json = json.load(fin)
-    print('\tDone.')
+    assert seed_file.exists(), '{} does not exist!'.format(seed_file)
+    if seed_file.is_dir():
+        seed_file_list = sorted(seed_file.glob('*.json'))
+    else:
+        seed_file_list = [seed_file]
 
     output_dir = Path(args.output_dir)
     if not output_dir.exists():
         output_dir.mkdir()
 
-    for hypothesis_idx, (prob, hypothesis) in enumerate(
-            zip(seed_json['probs'], seed_json['support'])):
-        print('\nExtracting subgraph for hypothesis # {} with prob = {}'.format(
-            hypothesis_idx, prob))
-        subgraph = extract_subgraph(
-            graph=graph_json,
-            statements=hypothesis['statements'],
-            num_hops=args.num_hops,
-            verbose=args.verbose
-        )
-        output_path = output_dir / f'subgraph_{hypothesis_idx}.json'
-        print('Writing subgraph json to {}'.format(output_path))
-        with open(output_path, 'w') as fout:
-            json.dump(subgraph, fout, indent=2)
+    hop_index = None
+    if not args.no_hop_index:
+        print('\nBuilding hop layer index')
+        hop_index = HopLayerIndex(graph_json, cache_size=args.hop_cache_size)
+        print('\tDone.')
+
+    start_time = time.time()
+    crop_results = crop_batch(
+        graph_json, seed_file_list, output_dir, num_hops=args.num_hops,
+        num_workers=args.workers, verbose=args.verbose, hop_index=hop_index)
+    total_time = time.time() - start_time
+
+    print('\nCropped {} subgraphs from {} seed files in {:.2f} seconds'.format(
+        len(crop_results), len(seed_file_list), total_time))
+    for output_path, num_eres, num_stmts, crop_time in crop_results:
+        print('\t{}: {} EREs, {} statements, {:.3f} seconds'.format(
+            output_path, num_eres, num_stmts, crop_time))
 
 
 if __name__ == '__main__':
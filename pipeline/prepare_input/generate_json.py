@@ -3,13 +3,20 @@
 #  for cluster distances.
 #
 # usage:
-# python3 generate_json.py <kbfilename> <jsonfilename> <jsonjustfilename>
+# python3 generate_json.py [--streaming | --incremental] <kbfilename> <jsonfilename> <jsonjustfilename>
 #
 # where
 # kbfilename is the name of an AIF file in .ttl format, or of a directory in which all files are .ttl files.
 #     In the latter case, all the files in the directory are combined into a single json file
 # jsonfilename is the name of the output file, in json format
 # jsonjustfilename is the name of a file in json format listing justifications for all nodes
+#
+# With --streaming, the kb files are streamed twice instead of being loaded into an rdflib.Graph,
+# and the output is written one node at a time (see aif/json_stream.py). Use this for large KBs.
+#
+# With --incremental, a manifest <jsonfilename>.manifest is kept that records a hash of each kb file
+# and the nodes it contributed. On later runs, only nodes affected by changed, added or removed
+# kb files are re-transformed, and the existing json files are patched (see aif/json_incremental.py).
 
 import logging
 import sys
@@ -22,7 +29,7 @@ sys.path.insert(0, src_path)
 
 import rdflib
 
-from aif import AidaGraph, JsonInterface
+from aif import AidaGraph, JsonInterface, StreamingJsonInterface, IncrementalJsonInterface
 
 
 #########################
@@ -43,21 +50,63 @@ def work(kb_filename, mygraph):
 logging.basicConfig(
     level=logging.DEBUG, format='%(asctime)s - %(message)s')
 
-kb_name = sys.argv[1]
-output_filename = sys.argv[2]
-output_just_filename = sys.argv[3]
-
-mygraph = AidaGraph()
+args = sys.argv[1:]
+streaming = "--streaming" in args
+if streaming:
+    args.remove("--streaming")
+incremental = "--incremental" in args
+if incremental:
+    args.remove("--incremental")
 
+kb_name = args[0]
+output_filename = args[1]
+output_just_filename = args[2]
 
 if os.path.isdir(kb_name):
-    for kb_basename in os.listdir(kb_name):
-        if kb_basename.endswith(".ttl") or kb_basename.endswith("turtle"):
-            kb_filename = os.path.join(kb_name, kb_basename)
-            work(kb_filename, mygraph)
+    kb_filenames = [os.path.join(kb_name, kb_basename) for kb_basename in os.listdir(kb_name)
+                    if kb_basename.endswith(".ttl") or kb_basename.endswith("turtle")]
 else:
-    work(kb_name, mygraph)
-        
+    kb_filenames = [kb_name]
+
+if streaming:
+    json_obj = StreamingJsonInterface(kb_filenames)
+
+    logging.info('Writing output to {}...'.format(output_filename))
+    logging.info('and justifications to {}...'.format(output_just_filename))
+    with open(output_filename, 'w') as outf, open(output_just_filename, 'w') as just_outf:
+        json_obj.write(outf, just_outf)
+    sys.exit(0)
+
+if incremental:
+    manifest_filename = output_filename + ".manifest"
+    if all(os.path.exists(f) for f in [output_filename, output_just_filename, manifest_filename]):
+        logging.info('Reading previous output from {}...'.format(output_filename))
+        with open(output_filename) as fin:
+            prev_json_obj = json.load(fin)
+        with open(output_just_filename) as fin:
+            prev_json_just_obj = json.load(fin)
+        with open(manifest_filename) as fin:
+            prev_manifest = json.load(fin)
+        json_obj = IncrementalJsonInterface(kb_filenames, prev_json_obj, prev_json_just_obj, prev_manifest)
+    else:
+        logging.info('No previous output found, doing a full build')
+        json_obj = IncrementalJsonInterface(kb_filenames)
+
+    logging.info('Writing output to {}...'.format(output_filename))
+    logging.info('and justifications to {}...'.format(output_just_filename))
+    with open(output_filename, 'w') as outf:
+        json_obj.write(outf)
+    with open(output_just_filename, 'w') as outf:
+        json_obj.write_just(outf)
+    with open(manifest_filename, 'w') as outf:
+        json_obj.write_manifest(outf)
+    sys.exit(0)
+
+mygraph = AidaGraph()
+
+for kb_filename in kb_filenames:
+    work(kb_filename, mygraph)
+
 
 logging.info('Building json representation of the AIF graph...')
 json_obj = JsonInterface(mygraph, simplification_level=0)
@@ -0,0 +1,26 @@
+# pre- and postprocessing for AIDA eval
+# build the local KB index used by query_subgraph.py --local_index
+
+import sys
+from os.path import dirname, realpath
+from pathlib import Path
+
+src_path = dirname(dirname(dirname(realpath(__file__))))
+sys.path.insert(0, src_path)
+
+from pipeline.local_subgraph import LocalKBIndex
+
+kb_path = Path(sys.argv[1])
+fout_path = sys.argv[2]
+
+if kb_path.is_dir():
+    kb_path_list = sorted(kb_path.glob('*.ttl'))
+else:
+    kb_path_list = [kb_path]
+
+print('Building local index from {} KB files...'.format(len(kb_path_list)))
+kb_index = LocalKBIndex.from_ttl(kb_path_list)
+print('Done.')
+
+print('Writing local index to {}...'.format(fout_path))
+kb_index.save(fout_path)
@@ -0,0 +1,171 @@
+# pre- and postprocessing for the AIDA eval
+# content-addressed cache for the results of SPARQL queries, so that
+# reruns and hypotheses sharing the same queries do not re-query the KB
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+
+# fingerprint of a TDB database directory, computed from the names and sizes
+# of its files and the content of its node table (nodes.dat), which holds all
+# IRIs and literals of the KB, so that identical copies of a database share a
+# fingerprint. Index files grow in fixed blocks, so their sizes alone do not
+# change when a KB is reloaded with different values of the same length.
+# If kb_version is given (e.g. a name for the loaded KB), it is used instead
+# of the content of nodes.dat, which then does not need to be read.
+def tdb_fingerprint(db_path, kb_version=None):
+    hasher = hashlib.sha1()
+    db_path = Path(db_path)
+    for file_path in sorted(db_path.rglob('*')):
+        if file_path.is_file():
+            hasher.update('{} {}\n'.format(
+                file_path.relative_to(db_path), file_path.stat().st_size).encode())
+
+    if kb_version is not None:
+        hasher.update('version {}\n'.format(kb_version).encode())
+    else:
+        for nodes_path in sorted(db_path.rglob('nodes.dat')):
+            with open(str(nodes_path), 'rb') as fin:
+                for chunk in iter(lambda: fin.read(1 << 20), b''):
+                    hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+# cache directory with one result file per (query text, database fingerprint),
+# evicting the least recently used results once the total size exceeds
+# max_size bytes (no limit if max_size is None).
+# The sizes of cached results are kept in an LRU index with a running total,
+# which is read from the directory once; the directory is only rescanned
+# (to pick up results written by other processes) when the total exceeds max_size.
+# Result files are copied outside of the lock, and written to a temporary
+# file first, so that readers never see a partially written result.
+# kb_version is passed on to tdb_fingerprint.
+class QueryResultCache:
+    def __init__(self, cache_dir, max_size=None, kb_version=None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.kb_version = kb_version
+        # database path -> fingerprint
+        self.db_fingerprints = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # the cache is shared by the worker threads of schedule_sparql_queries
+        self.lock = threading.Lock()
+
+        # key -> size of the cached result, least recently used first
+        self.lru_index = OrderedDict()
+        self.total_size = 0
+        self._scan()
+
+    # fingerprint of a database, computed once per database path
+    def db_fingerprint(self, db_path):
+        with self.lock:
+            fingerprint = self.db_fingerprints.get(db_path, None)
+            if fingerprint is None:
+                fingerprint = tdb_fingerprint(db_path, kb_version=self.kb_version)
+                self.db_fingerprints[db_path] = fingerprint
+        return fingerprint
+
+    def key(self, query_text, db_fingerprint):
+        return hashlib.sha256(
+            '{}\n{}'.format(db_fingerprint, query_text).encode()).hexdigest()
+
+    def _cache_path(self, key):
+        return self.cache_dir / '{}.ttl'.format(key)
+
+    # copy the cached result for key to result_path.
+    # return True on a cache hit, False otherwise.
+    def get(self, key, result_path):
+        cache_path = self._cache_path(key)
+        try:
+            # mark as recently used for eviction, also for later runs
+            os.utime(str(cache_path))
+            shutil.copyfile(str(cache_path), str(result_path))
+            size = os.path.getsize(str(result_path))
+        except FileNotFoundError:
+            # not cached, or evicted meanwhile
+            with self.lock:
+                self.misses += 1
+            return False
+
+        with self.lock:
+            self.hits += 1
+            if key in self.lru_index:
+                self.lru_index.move_to_end(key)
+            else:
+                # written by another process
+                self._add_to_index(key, size)
+        return True
+
+    # store the result file at result_path under key
+    def put(self, key, result_path):
+        cache_path = self._cache_path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=str(self.cache_dir), suffix='.tmp')
+        os.close(fd)
+        try:
+            shutil.copyfile(str(result_path), tmp_path)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, str(cache_path))
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        evicted_keys = []
+        with self.lock:
+            self._add_to_index(key, size)
+
+            if self.max_size is not None and self.total_size > self.max_size:
+                # other processes may have added or evicted results meanwhile
+                self._scan()
+                evicted_keys = self._evict()
+
+        for evicted_key in evicted_keys:
+            try:
+                self._cache_path(evicted_key).unlink()
+            except FileNotFoundError:
+                # evicted by another process
+                pass
+
+    def _add_to_index(self, key, size):
+        self.total_size += size - self.lru_index.pop(key, 0)
+        self.lru_index[key] = size
+
+    # rebuild the LRU index from the cache directory, ordered by modification time
+    def _scan(self):
+        cached_files = []
+        for path in self.cache_dir.glob('*.ttl'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # evicted by another process
+                continue
+            cached_files.append((stat.st_mtime, path.stem, stat.st_size))
+
+        self.lru_index = OrderedDict(
+            (key, size) for _, key, size in sorted(cached_files))
+        self.total_size = sum(self.lru_index.values())
+
+    # remove least recently used results from the index until the total size
+    # is within max_size, and return their keys, for the caller to delete
+    def _evict(self):
+        evicted_keys = []
+        while self.total_size > self.max_size and self.lru_index:
+            key, size = self.lru_index.popitem(last=False)
+            evicted_keys.append(key)
+            self.total_size -= size
+            self.evictions += 1
+        return evicted_keys
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
@@ -0,0 +1,522 @@
+"""
+    An index over the typing statements of an AidaGraph, used to resolve entrypoints without scanning the whole graph.
+
+    For every typing statement, the index records its position in graph order and its subject, and it maps
+        - each type, subtype and subsubtype (stripped and lowercased) to the typing statements with that type,
+        - each justification source (document id) to the typing statements justified in that document,
+        - each ERE to its typing statements, with a NameIndex from normalized names to EREs,
+        - each KB id that an ERE is linked to to the typing statements of that ERE.
+
+    A typing statement can only get a type, name or descriptor score above zero for an entrypoint if it is found
+    under one of these keys for one of the entrypoint's TypedDescriptors, so only those candidates need to be scored.
+
+    The index also keeps a TextSpanIndex over all TextJustification spans of the graph, and a BoundingBoxIndex over
+    the bounding boxes of all image and keyframe justifications, so that text, image and video descriptors are
+    scored against the justifications they overlap instead of against one justification at a time.
+"""
+import unicodedata
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+from pipeline.soin_processing.TypedDescriptor import compute_string_overlap
+
+
+class TextSpanIndex:
+    """
+    A sorted-endpoint index over TextJustification spans, per document.
+    The spans of a document are sorted by start offset. As no span is longer than the longest span of its document,
+    the spans overlapping a query span start in a window that is found by binary search.
+    """
+    def __init__(self):
+        # justification label -> stripped source
+        self.source = {}
+        # source -> sorted list of (start, end, justification label)
+        self.spans = defaultdict(list)
+        # source -> list of start offsets, and longest span
+        self.starts = {}
+        self.max_length = {}
+        # (doceid, start, end) -> {justification label: score}
+        self.overlap_scores = {}
+
+    def add(self, justification_node):
+        source_set = justification_node.get('source')
+        if not source_set:
+            return
+        source = next(iter(source_set)).value.strip()
+        self.source[justification_node.name] = source
+
+        start_set = justification_node.get('startOffset')
+        end_set = justification_node.get('endOffsetInclusive')
+        if start_set and end_set:
+            start = int(next(iter(start_set)).value)
+            end = int(next(iter(end_set)).value)
+            self.spans[source].append((start, end, justification_node.name))
+
+    def finalize(self):
+        for source, spans in self.spans.items():
+            spans.sort()
+            self.starts[source] = [span[0] for span in spans]
+            self.max_length[source] = max(0, max(end - start for start, end, label in spans))
+
+    def overlapping(self, doceid, start, end):
+        """
+        A function to find the spans in document doceid that overlap the span from start to end.
+        :param doceid: str
+        :param start: int
+        :param end: int
+        :return: [(start, end, justification label)]
+        """
+        if doceid not in self.starts:
+            return []
+        spans = self.spans[doceid]
+        starts = self.starts[doceid]
+        first = bisect_left(starts, start - self.max_length[doceid])
+        last = bisect_right(starts, end)
+        return [span for span in spans[first:last] if span[1] >= start]
+
+    def evaluate(self, text_descriptor):
+        """
+        A function to compute the overlap scores of a TextDescriptor with all overlapping justifications in its document.
+        :param text_descriptor: TextDescriptor
+        :return: {justification label: score}
+        """
+        key = (text_descriptor.doceid, text_descriptor.start, text_descriptor.end)
+        if key not in self.overlap_scores:
+            target = [int(text_descriptor.start), int(text_descriptor.end)]
+            self.overlap_scores[key] = dict(
+                (label, compute_string_overlap([start, end], target) * .9)
+                for start, end, label in self.overlapping(text_descriptor.doceid, target[0], target[1]))
+        return self.overlap_scores[key]
+
+    def evaluate_all(self, text_descriptors):
+        """
+        A function to evaluate a batch of TextDescriptors, e.g. all text descriptors of a SOIN.
+        :param text_descriptors: [TextDescriptor]
+        :return: [{justification label: score}]
+        """
+        return [self.evaluate(text_descriptor) for text_descriptor in text_descriptors]
+
+    def score(self, text_descriptor, justification_label):
+        """
+        A function to score a TextDescriptor against a TextJustification, as TextDescriptor.evaluate_node does.
+        :param text_descriptor: TextDescriptor
+        :param justification_label: label of a TextJustification node
+        :return: float
+        """
+        source = self.source.get(justification_label)
+        if not source or source != text_descriptor.doceid:
+            return 0
+        return 10 + self.evaluate(text_descriptor).get(justification_label, 0)
+
+
+class BoundingBoxIndex:
+    """
+    A uniform grid over the bounding boxes of ImageJustification and KeyFrameVideoJustification nodes,
+    with one grid per (document, keyframe). Image justifications have keyframe None.
+    Box coordinates are parsed once into integer arrays, indexed by box id.
+    """
+    def __init__(self):
+        # justification label -> (stripped source, stripped keyframe or None)
+        self.source = {}
+        # box coordinates and justification labels, by box id
+        self.upper_left_x = array('l')
+        self.upper_left_y = array('l')
+        self.lower_right_x = array('l')
+        self.lower_right_y = array('l')
+        self.labels = []
+        # (source, keyframe) -> box ids, and after finalize, (source, keyframe) -> (cell size, cell -> box ids)
+        self.boxes = defaultdict(list)
+        self.grids = {}
+        # source -> keyframes with a grid
+        self.keyframes = defaultdict(set)
+        # descriptor key -> {justification label: window score}
+        self.window_scores = {}
+
+    def add(self, graph, justification_node):
+        source_set = justification_node.get('source')
+        if not source_set:
+            return
+        source = next(iter(source_set)).strip()
+        keyframe_set = justification_node.get('keyFrame')
+        keyframe = next(iter(keyframe_set)).strip() if keyframe_set else None
+        self.source[justification_node.name] = (source, keyframe)
+
+        bounding_box_id_set = justification_node.get('boundingBox')
+        if not bounding_box_id_set:
+            return
+        bounding_box_node = graph.get_node(next(iter(bounding_box_id_set)))
+        if not bounding_box_node:
+            return
+        coordinates = []
+        for label in ['boundingBoxUpperLeftX', 'boundingBoxUpperLeftY', 'boundingBoxLowerRightX', 'boundingBoxLowerRightY']:
+            value_set = bounding_box_node.get(label)
+            if not value_set:
+                return
+            coordinates.append(int(str(next(iter(value_set)).value).strip()))
+
+        box = len(self.labels)
+        self.upper_left_x.append(coordinates[0])
+        self.upper_left_y.append(coordinates[1])
+        self.lower_right_x.append(coordinates[2])
+        self.lower_right_y.append(coordinates[3])
+        self.labels.append(justification_node.name)
+        self.boxes[(source, keyframe)].append(box)
+
+    def finalize(self):
+        for key, boxes in self.boxes.items():
+            # cells about as large as an average box, so that a box covers few cells
+            extent = sum(max(abs(self.lower_right_x[box] - self.upper_left_x[box]),
+                             abs(self.lower_right_y[box] - self.upper_left_y[box]))
+                         for box in boxes)
+            cell_size = max(1, extent // len(boxes))
+            cells = defaultdict(list)
+            for box in boxes:
+                for cell in self._cells(cell_size, self.upper_left_x[box], self.upper_left_y[box],
+                                        self.lower_right_x[box], self.lower_right_y[box]):
+                    cells[cell].append(box)
+            self.grids[key] = (cell_size, cells)
+            self.keyframes[key[0]].add(key[1])
+        self.boxes = None
+
+    @staticmethod
+    def _cells(cell_size, upper_left_x, upper_left_y, lower_right_x, lower_right_y):
+        # min and max, in case a box has its corners swapped
+        for cell_x in range(min(upper_left_x, lower_right_x) // cell_size, max(upper_left_x, lower_right_x) // cell_size + 1):
+            for cell_y in range(min(upper_left_y, lower_right_y) // cell_size, max(upper_left_y, lower_right_y) // cell_size + 1):
+                yield cell_x, cell_y
+
+    def overlapping(self, source, keyframe, upper_left_x, upper_left_y, lower_right_x, lower_right_y):
+        """
+        A function to find the boxes in the grid of (source, keyframe) that overlap a query box.
+        :return: [box id]
+        """
+        if (source, keyframe) not in self.grids:
+            return []
+        cell_size, cells = self.grids[(source, keyframe)]
+        candidates = set()
+        for cell in self._cells(cell_size, upper_left_x, upper_left_y, lower_right_x, lower_right_y):
+            candidates.update(cells.get(cell, []))
+        # same overlap test as compute_bounding_box_overlap
+        return [box for box in candidates
+                if lower_right_y > self.upper_left_y[box] and lower_right_x > self.upper_left_x[box]
+                and upper_left_y < self.lower_right_y[box] and upper_left_x < self.lower_right_x[box]]
+
+    def window_score_batch(self, boxes, upper_left_x, upper_left_y, lower_right_x, lower_right_y):
+        """
+        A function to compute the window scores of compute_bounding_box_overlap for a list of overlapping boxes
+        against one target box, over the coordinate arrays.
+        :return: [float]
+        """
+        area_target = (lower_right_x - upper_left_x) * (lower_right_y - upper_left_y)
+        observed = zip([self.upper_left_x[box] for box in boxes], [self.upper_left_y[box] for box in boxes],
+                       [self.lower_right_x[box] for box in boxes], [self.lower_right_y[box] for box in boxes])
+        scores = []
+        for observed_ulx, observed_uly, observed_lrx, observed_lry in observed:
+            area_observed = (observed_lrx - observed_ulx) * (observed_lry - observed_uly)
+            area_overlap = ((min(observed_lrx, lower_right_x) - max(observed_ulx, upper_left_x)) *
+                            (min(observed_lry, lower_right_y) - max(observed_uly, upper_left_y)))
+            scores.append(((area_overlap / area_target + area_overlap / area_observed) / 2) * 100)
+        return scores
+
+    def evaluate(self, descriptor):
+        """
+        A function to compute the window scores of an ImageDescriptor or VideoDescriptor with all overlapping
+        bounding boxes in its document. The box of a video descriptor is compared to the boxes of all keyframes,
+        as in VideoDescriptor.evaluate_node.
+        :param descriptor: ImageDescriptor or VideoDescriptor
+        :return: {justification label: window score}
+        """
+        key = (descriptor.descriptor_type, descriptor.doceid, descriptor.top_left, descriptor.bottom_right)
+        if key not in self.window_scores:
+            upper_left_x, upper_left_y = [int(c) for c in descriptor.top_left.strip().split(',')]
+            lower_right_x, lower_right_y = [int(c) for c in descriptor.bottom_right.strip().split(',')]
+            if descriptor.descriptor_type == 'Image':
+                source = descriptor.doceid.strip()
+                keyframes = [None]
+            else:
+                source = descriptor.doceid
+                keyframes = [keyframe for keyframe in self.keyframes.get(source, []) if keyframe is not None]
+
+            boxes = []
+            for keyframe in keyframes:
+                boxes.extend(self.overlapping(source, keyframe, upper_left_x, upper_left_y, lower_right_x, lower_right_y))
+            scores = self.window_score_batch(boxes, upper_left_x, upper_left_y, lower_right_x, lower_right_y)
+            self.window_scores[key] = dict((self.labels[box], score) for box, score in zip(boxes, scores))
+        return self.window_scores[key]
+
+    def evaluate_all(self, descriptors):
+        """
+        A function to evaluate a batch of ImageDescriptors and VideoDescriptors.
+        :param descriptors: [ImageDescriptor or VideoDescriptor]
+        :return: [{justification label: window score}]
+        """
+        return [self.evaluate(descriptor) for descriptor in descriptors]
+
+    def score(self, descriptor, justification_label):
+        """
+        A function to score an ImageDescriptor or VideoDescriptor against a justification with a bounding box,
+        as ImageDescriptor.evaluate_node and VideoDescriptor.evaluate_node do.
+        :param descriptor: ImageDescriptor or VideoDescriptor
+        :param justification_label: label of an ImageJustification or KeyFrameVideoJustification node
+        :return: float
+        """
+        if justification_label not in self.source:
+            return 0
+        source, keyframe = self.source[justification_label]
+
+        if descriptor.descriptor_type == 'Image':
+            if source != descriptor.doceid.strip():
+                return 0
+            return 10 + self.evaluate(descriptor).get(justification_label, 0) * .9
+
+        if source != descriptor.doceid:
+            return 0
+        if keyframe is None:
+            return 10
+        score = 10
+        if keyframe == descriptor.keyframe_id:
+            score += 10
+        return score + self.evaluate(descriptor).get(justification_label, 0) * .8
+
+
+def normalize_name(name):
+    """
+    A function to normalize a name for matching: diacritics are removed, case is folded, and runs of whitespace are
+    collapsed to a single space.
+    :param name: str
+    :return: str
+    """
+    decomposed = unicodedata.normalize('NFKD', name)
+    without_diacritics = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(without_diacritics.casefold().split())
+
+
+class NameIndex:
+    """
+    An inverted index from normalized names to the EREs that have them as hasName.
+    Name matching can be
+        - 'exact': a name matches if it is one of the ERE's names, as in StringDescriptor.evaluate_node,
+        - 'normalized': a name matches if its normalized form is one of the normalized names of the ERE,
+        - 'fuzzy': as 'normalized', and in addition, names whose character n-grams overlap with a Dice coefficient
+          of at least fuzzy_threshold match with a score of 100 times the Dice coefficient.
+    For fuzzy matching, an inverted index from character n-grams to normalized names gives the candidate names.
+    """
+    def __init__(self, name_matching='exact', ngram_size=3, fuzzy_threshold=0.7):
+        self.name_matching = name_matching
+        self.ngram_size = ngram_size
+        self.fuzzy_threshold = fuzzy_threshold
+
+        # normalized name -> ERE labels, and ERE label -> stripped names
+        self.by_normalized = defaultdict(set)
+        self.names = defaultdict(set)
+        # n-gram -> normalized names, for fuzzy matching only
+        self.by_ngram = defaultdict(set)
+        # name string -> {ERE label: score}
+        self.matches = {}
+
+    def add(self, ere_label, name):
+        name = name.strip()
+        self.names[ere_label].add(name)
+        normalized = normalize_name(name)
+        if self.name_matching == 'fuzzy' and normalized not in self.by_normalized:
+            for ngram in self.ngrams(normalized):
+                self.by_ngram[ngram].add(normalized)
+        self.by_normalized[normalized].add(ere_label)
+
+    def ngrams(self, normalized):
+        padded = ' ' + normalized + ' '
+        return set(padded[i:i + self.ngram_size] for i in range(max(1, len(padded) - self.ngram_size + 1)))
+
+    def fuzzy_candidates(self, normalized):
+        """
+        A function to find the indexed normalized names that share enough n-grams with a normalized name.
+        :param normalized: str
+        :return: {normalized name: Dice coefficient}
+        """
+        ngrams = self.ngrams(normalized)
+        shared = defaultdict(int)
+        for ngram in ngrams:
+            for candidate in self.by_ngram.get(ngram, []):
+                shared[candidate] += 1
+
+        candidates = {}
+        for candidate, num_shared in shared.items():
+            dice = 2 * num_shared / (len(ngrams) + len(self.ngrams(candidate)))
+            if dice >= self.fuzzy_threshold:
+                candidates[candidate] = dice
+        return candidates
+
+    def match(self, name_string):
+        """
+        A function to find the EREs that a name matches, with their scores.
+        :param name_string: str
+        :return: {ERE label: score}
+        """
+        if name_string not in self.matches:
+            normalized = normalize_name(name_string)
+            ere_scores = {}
+            if self.name_matching == 'fuzzy':
+                for candidate, dice in self.fuzzy_candidates(normalized).items():
+                    for ere_label in self.by_normalized[candidate]:
+                        ere_scores[ere_label] = max(ere_scores.get(ere_label, 0), 100 * dice)
+            for ere_label in self.by_normalized.get(normalized, []):
+                if self.name_matching != 'exact' or name_string in self.names[ere_label]:
+                    ere_scores[ere_label] = 100
+            self.matches[name_string] = ere_scores
+        return self.matches[name_string]
+
+    def score(self, string_descriptor, ere_label):
+        """
+        A function to score a StringDescriptor against an ERE.
+        :param string_descriptor: StringDescriptor
+        :param ere_label: label of an ERE node
+        :return: float
+        """
+        return self.match(string_descriptor.name_string).get(ere_label, 0)
+
+
+class EntrypointIndex:
+    def __init__(self, graph, name_matching='exact', fuzzy_threshold=0.7):
+        # typing statement nodes and their subject labels, in graph order
+        self.typing_statements = []
+        self.subjects = []
+
+        self.by_type = [defaultdict(list), defaultdict(list), defaultdict(list)]
+        self.by_source = defaultdict(list)
+        self.by_subject = defaultdict(list)
+        self.by_kbid = defaultdict(list)
+
+        self.names = NameIndex(name_matching=name_matching, fuzzy_threshold=fuzzy_threshold)
+
+        self.text_spans = TextSpanIndex()
+        self.bounding_boxes = BoundingBoxIndex()
+
+        for node in graph.nodes():
+            if node.is_type_statement():
+                self._add_typing_statement(graph, node)
+                continue
+            jtype = next(iter(node.get('type', shorten=True)), None)
+            if jtype == "TextJustification":
+                self.text_spans.add(node)
+            elif jtype in ["ImageJustification", "KeyFrameVideoJustification"]:
+                self.bounding_boxes.add(graph, node)
+
+        self.text_spans.finalize()
+        self.bounding_boxes.finalize()
+
+    def _add_typing_statement(self, graph, node):
+        position = len(self.typing_statements)
+        self.typing_statements.append(node)
+
+        subject_set = node.get('subject')
+        subject_address = next(iter(subject_set)) if subject_set else None
+        self.subjects.append(subject_address)
+
+        object_set = node.get('object', shorten=True)
+        if object_set:
+            types = next(iter(object_set)).strip().split('.')
+            for level, typ in enumerate(types[:3]):
+                typ = typ.strip().lower()
+                if typ:
+                    self.by_type[level][typ].append(position)
+
+        for justification_id in node.get('justifiedBy'):
+            justification_node = graph.get_node(justification_id)
+            if justification_node:
+                for source in justification_node.get('source'):
+                    self.by_source[str(source).strip()].append(position)
+            # check_descriptor only looks at the first justification
+            break
+
+        # names are indexed once per ERE, links once per typing statement
+        subject_node = graph.get_node(subject_address) if subject_address is not None else None
+        if subject_node:
+            if subject_address not in self.by_subject:
+                for name in subject_node.get('hasName'):
+                    self.names.add(subject_address, str(name))
+            self.by_subject[subject_address].append(position)
+            for link_id in subject_node.get('link'):
+                link_node = graph.get_node(link_id)
+                if link_node:
+                    for link_target in link_node.get('linkTarget'):
+                        self.by_kbid[str(link_target).strip()].append(position)
+
+    def enttype_positions(self, enttype):
+        """
+        A function to find the positions of all typing statements that match an EntType on at least one type level.
+        :param enttype: EntType
+        :return: set of positions in self.typing_statements
+        """
+        positions = set()
+        for level, typ in enumerate([enttype.type, enttype.subtype, enttype.subsubtype]):
+            if typ:
+                positions.update(self.by_type[level].get(typ.strip().lower(), []))
+        return positions
+
+    def descriptor_positions(self, descriptor):
+        """
+        A function to find the positions of all typing statements that a descriptor can give a score above zero.
+        :param descriptor: TextDescriptor, StringDescriptor, ImageDescriptor, VideoDescriptor or KBDescriptor
+        :return: set of positions in self.typing_statements
+        """
+        if descriptor.descriptor_type in ['Text', 'Image', 'Video']:
+            return set(self.by_source.get(descriptor.doceid.strip(), []))
+        elif descriptor.descriptor_type == 'String':
+            positions = set()
+            for ere_label in self.names.match(descriptor.name_string):
+                positions.update(self.by_subject.get(ere_label, []))
+            return positions
+        elif descriptor.descriptor_type == 'KB':
+            positions = set()
+            for kbid in descriptor.kbid:
+                positions.update(self.by_kbid.get(kbid, []))
+            return positions
+        return set()
+
+    def candidate_positions(self, entrypoint):
+        """
+        A function to find the positions of all typing statements that can score above zero for an entrypoint.
+        :param entrypoint: Entrypoint
+        :return: sorted list of positions in self.typing_statements
+        """
+        positions = set()
+        for filler in entrypoint.typed_descriptor_list:
+            for typed_descriptor in filler:
+                if typed_descriptor.enttype:
+                    positions.update(self.enttype_positions(typed_descriptor.enttype))
+                if typed_descriptor.descriptor:
+                    positions.update(self.descriptor_positions(typed_descriptor.descriptor))
+
+        return sorted(positions)
+
+    def evaluate_descriptors(self, entrypoints):
+        """
+        A function to evaluate all text, image and video descriptors of a list of entrypoints in one batch.
+        The overlap scores are cached in self.text_spans and self.bounding_boxes, to be looked up when typing
+        statements are scored.
+        :param entrypoints: [Entrypoint]
+        :return: None
+        """
+        text_descriptors = []
+        box_descriptors = []
+        for entrypoint in entrypoints:
+            for filler in entrypoint.typed_descriptor_list:
+                for typed_descriptor in filler:
+                    if not typed_descriptor.descriptor:
+                        continue
+                    if typed_descriptor.descriptor.descriptor_type == 'Text':
+                        text_descriptors.append(typed_descriptor.descriptor)
+                    elif typed_descriptor.descriptor.descriptor_type in ['Image', 'Video']:
+                        box_descriptors.append(typed_descriptor.descriptor)
+        self.text_spans.evaluate_all(text_descriptors)
+        self.bounding_boxes.evaluate_all(box_descriptors)
+
+    def candidates(self, entrypoint):
+        """
+        A function to return all typing statement nodes that can score above zero for an entrypoint, in graph order.
+        :param entrypoint: Entrypoint
+        :return: [AidaNode]
+        """
+        return [self.typing_statements[position] for position in self.candidate_positions(entrypoint)]
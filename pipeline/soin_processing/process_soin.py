@@ -13,17 +13,22 @@
     Author: Eric Holgate
             holgate@utexas.edu
 """
+from array import array
 from collections import defaultdict
 
-from templates_and_constants import DEBUG, SCORE_WEIGHTS, DEBUG_SCORE_FLOOR, ROLE_PENALTY_DEBUG
+from templates_and_constants import DEBUG, SCORE_WEIGHTS, DEBUG_SCORE_FLOOR, ROLE_PENALTY_DEBUG, MAX_DESCRIPTOR_SCORE
 
 import sys
 import json
 import os
 import argparse
+import heapq
+import multiprocessing
+import time
 import rdflib
 import itertools
 
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
 from os.path import dirname, realpath
 src_path = dirname(dirname(dirname(realpath(__file__))))
@@ -32,12 +37,28 @@ sys.path.insert(0, src_path)
 from aif import AidaGraph
 from pipeline.soin_processing import SOIN
 from pipeline.soin_processing.TypedDescriptor import *
+from pipeline.soin_processing.entrypoint_index import EntrypointIndex
+from pipeline.json_graph_helper import cluster_mappings_path, snapshot_fingerprint, load_cluster_mappings, \
+    save_cluster_mappings
 from pipeline.soin_processing.templates_and_constants import DEBUG, SCORE_WEIGHTS, DEBUG_SCORE_FLOOR
 
 
 graph_path = '/Users/eholgate/Desktop/SOIN/Annotation_Generated_V4/Annotation_Generated_V4_Valid/R103'
 graph_path = '/Users/eholgate/Downloads/GAIA_1-OPERA_3_Colorado_1/NIST/'
 
+# the graph, cluster mappings and entrypoint index shared by worker processes with --workers.
+# They are set before the workers are forked, so that the workers do not need to load or unpickle them.
+_shared_resolution_data = None
+
+
+def get_kb_files(in_dir):
+    """
+    A function to list the TTL files of a KB directory.
+    :param in_dir:
+    :return: [str]
+    """
+    return [os.path.join(in_dir, file) for file in os.listdir(in_dir) if file.endswith(".ttl")]
+
 
 def load_graph(in_dir):
     """
@@ -45,11 +66,8 @@ def load_graph(in_dir):
     :param in_dir:
     :return:
     """
-    turtles = []
-    for file in os.listdir(in_dir):
-        if file.endswith(".ttl"):
-            turtles.append(os.path.join(in_dir, file))
-        # Create an empty AidaGraph, then add the contents of each TTL to it.
+    turtles = get_kb_files(in_dir)
+    # Create an empty AidaGraph, then add the contents of each TTL to it.
     graph = AidaGraph()
     for file in turtles:
         subgraph = rdflib.Graph()
@@ -89,6 +107,50 @@ def get_cluster_mappings(graph):
     return cluster_to_prototype, entities_to_clusters, entities_to_roles
 
 
+def load_cluster_mappings_for_kb(graph, in_dir):
+    """
+    A function to load the cluster mappings persisted next to a KB directory, or to compute them with
+    get_cluster_mappings and persist them if they are missing or the KB files have changed.
+    Mappings are only persisted if all clusters, prototypes and members are URIs, as blank node labels change every
+    time the KB is read.
+    :param graph: AidaGraph
+    :param in_dir: the KB directory that graph was loaded from
+    :return: cluster_to_prototype, entities_to_clusters, entities_to_roles
+    """
+    path = cluster_mappings_path(in_dir)
+    fingerprint = snapshot_fingerprint(get_kb_files(in_dir))
+
+    persisted = load_cluster_mappings(path, fingerprint)
+    if persisted is not None:
+        print("\tLoaded from " + path)
+        cluster_to_prototype = dict((rdflib.URIRef(cluster), rdflib.URIRef(prototype))
+                                    for cluster, prototype in persisted['cluster_to_prototype'].items())
+        entities_to_clusters = defaultdict(set)
+        for member, clusters in persisted['member_to_clusters'].items():
+            entities_to_clusters[rdflib.URIRef(member)] = set(rdflib.URIRef(cluster) for cluster in clusters)
+        entities_to_roles = dict((rdflib.URIRef(entity), roles) for entity, roles in persisted['entity_to_roles'].items())
+        return cluster_to_prototype, entities_to_clusters, entities_to_roles
+
+    cluster_to_prototype, entities_to_clusters, entities_to_roles = get_cluster_mappings(graph)
+
+    labels = itertools.chain(cluster_to_prototype.keys(), cluster_to_prototype.values(), entities_to_clusters.keys(),
+                             *entities_to_clusters.values())
+    if all(isinstance(label, rdflib.URIRef) for label in labels):
+        cluster_mappings = {
+            'cluster_to_prototype': cluster_to_prototype,
+            'member_to_clusters': entities_to_clusters,
+            'entity_to_roles': dict((entity, roles) for entity, roles in entities_to_roles.items()
+                                    if isinstance(entity, rdflib.URIRef)),
+        }
+        try:
+            save_cluster_mappings(path, fingerprint, cluster_mappings)
+            print("\tSaved to " + path)
+        except OSError as e:
+            print("\tCould not save cluster mappings to " + path + ": " + str(e))
+
+    return cluster_to_prototype, entities_to_clusters, entities_to_roles
+
+
 def check_type(node, typed_descriptor):
     """
     A function which determines the extent to which a given AidaGraph node and Entrypoint definition contain matching
@@ -180,7 +242,7 @@ def get_bounding_box_node(graph, justification_node):
     return bounding_box_node
 
 
-def check_descriptor(graph, typing_statement, typed_descriptor):
+def check_descriptor(graph, typing_statement, typed_descriptor, ep_index=None):
     if typed_descriptor.descriptor.descriptor_type == "Text":
         justification_node = get_justification_node(graph, typing_statement)
         if not justification_node:
@@ -192,12 +254,16 @@ def check_descriptor(graph, typing_statement, typed_descriptor):
         if jtype != "TextJustification":
             return False
 
+        if ep_index is not None:
+            return ep_index.text_spans.score(typed_descriptor.descriptor, justification_node.name)
         return typed_descriptor.descriptor.evaluate_node(justification_node)
 
     elif typed_descriptor.descriptor.descriptor_type == "String":
         subject_node = get_subject_node(graph, typing_statement)
         if not subject_node:
             return False
+        if ep_index is not None:
+            return ep_index.names.score(typed_descriptor.descriptor, subject_node.name)
         return typed_descriptor.descriptor.evaluate_node(subject_node)
 
     elif typed_descriptor.descriptor.descriptor_type == "Image":
@@ -217,6 +283,8 @@ def check_descriptor(graph, typing_statement, typed_descriptor):
         if not (justification_node and bounding_box_node):
             return False
 
+        if ep_index is not None:
+            return ep_index.bounding_boxes.score(typed_descriptor.descriptor, justification_node.name)
         return typed_descriptor.descriptor.evaluate_node(justification_node, bounding_box_node)
 
     elif typed_descriptor.descriptor.descriptor_type == "Video":
@@ -236,6 +304,8 @@ def check_descriptor(graph, typing_statement, typed_descriptor):
         if not bounding_box_node:
             return False
 
+        if ep_index is not None:
+            return ep_index.bounding_boxes.score(typed_descriptor.descriptor, justification_node.name)
         return typed_descriptor.descriptor.evaluate_node(justification_node, bounding_box_node)
 
     elif typed_descriptor.descriptor.descriptor_type == "KB":
@@ -251,140 +321,292 @@ def check_descriptor(graph, typing_statement, typed_descriptor):
     return False
 
 
-def find_entrypoint(graph, entrypoint, cluster_to_prototype, entity_to_cluster, entities_to_roles, role_vars, ep_cap, role_flag):
+def role_penalty(entrypoint, subject_address, entities_to_roles, role_vars):
+    """
+    A function to compute the penalty for the roles of an entrypoint variable that the subject does not fill.
+    :param entrypoint: Entrypoint
+    :param subject_address: the subject of a typing statement
+    :param entities_to_roles: dict
+    :param role_vars: dict
+    :return: int
+    """
+    penalty = 0
+    for role in role_vars[entrypoint.variable[0]]:  # [0] for senseless tuple wrapper
+        if role not in entities_to_roles.get(subject_address, {}):
+            if ROLE_PENALTY_DEBUG:
+                print("PENALTY APPLIED!")
+                print("Looking for: " + str(role))
+                print("Observed roles: " + str(entities_to_roles.get(subject_address, {})))
+                input()
+            penalty += 30
+    return penalty
+
+
+def split_typed_descriptors(entrypoint):
+    """
+    A function to split the TypedDescriptors of an entrypoint by what they are scored on.
+    :param entrypoint: Entrypoint
+    :return: (TypedDescriptors with an enttype, TypedDescriptors with a String descriptor,
+              TypedDescriptors with any other descriptor)
+    """
+    enttype_descriptors = []
+    name_descriptors = []
+    other_descriptors = []
+
+    # TODO: Why is this wrapped in a useless tuple??
+    for filler in entrypoint.typed_descriptor_list:
+        for typed_descriptor in filler:
+            if typed_descriptor.enttype:
+                enttype_descriptors.append(typed_descriptor)
+            if typed_descriptor.descriptor:
+                if typed_descriptor.descriptor.descriptor_type == 'String':
+                    name_descriptors.append(typed_descriptor)
+                else:
+                    other_descriptors.append(typed_descriptor)
+
+    return enttype_descriptors, name_descriptors, other_descriptors
+
+
+def normalize_scores(typed_scores, num_enttypes, name_scores, num_names, descriptor_scores, num_descriptors, penalties):
+    """
+    A function to combine the typed scores (how many matches between enttypes), name scores and descriptor scores
+    (how many complete TypedDescriptor matches) of a batch of typing statements into scores between 0 and 100,
+    weighed with SCORE_WEIGHTS, and subtract their role penalties.
+    The denominator only includes the components that the entrypoint has information for, so it is the same for all
+    typing statements, and each component is computed in one pass over its column of scores.
+    :param typed_scores: array of typed scores, one per typing statement
+    :param num_enttypes: int
+    :param name_scores: array of name scores
+    :param num_names: int
+    :param descriptor_scores: array of descriptor scores
+    :param num_descriptors: int
+    :param penalties: array of role penalties
+    :return: array of normalized scores
+    """
+    score_numerators = array('d', bytes(8 * len(penalties)))
+    score_denominator = 0
+
+    if num_enttypes:
+        score_numerators = array('d', [numerator + ((typed_score/num_enttypes)/100) * SCORE_WEIGHTS['type']
+                                       for numerator, typed_score in zip(score_numerators, typed_scores)])
+        score_denominator += SCORE_WEIGHTS['type']
+    if num_names:
+        score_numerators = array('d', [numerator + (name_score/100) * SCORE_WEIGHTS['name']
+                                       for numerator, name_score in zip(score_numerators, name_scores)])
+        score_denominator += SCORE_WEIGHTS['name']
+    if num_descriptors:
+        score_numerators = array('d', [numerator + ((descriptor_score/num_descriptors)/100) * SCORE_WEIGHTS['descriptor']
+                                       for numerator, descriptor_score in zip(score_numerators, descriptor_scores)])
+        score_denominator += SCORE_WEIGHTS['descriptor']
+
+    total_scores = array('d', [(numerator/score_denominator) * 100 - penalty
+                               for numerator, penalty in zip(score_numerators, penalties)])
+
+    if DEBUG:
+        for row, total_score in enumerate(total_scores):
+            print("Raw Score: " + str((typed_scores[row]/100) + (name_scores[row]/100) + (descriptor_scores[row]/100)))
+            print("Score Numerator: " + str(score_numerators[row]))
+            print("Score Denominator: " + str(score_denominator))
+            print("Normalized Score: " + str(total_score))
+            print()
+            print("##############################################")
+            print()
+            if (total_score >= DEBUG_SCORE_FLOOR):
+                input()
+
+    return total_scores
+
+
+class TopKScores:
+    """
+    A bounded min-heap of the ep_cap best prototype scores seen so far, used as a threshold: a typing statement whose
+    score cannot reach the ep_cap-th best score cannot put any prototype into the result.
+    Prototype scores only increase, so entries that were superseded are left in the heap and skipped lazily.
+    """
+    def __init__(self, k):
+        self.k = k
+        self.heap = []
+        # prototype -> score, for the prototypes currently among the k best
+        self.members = {}
+
+    def update(self, prototype, score):
+        if self.members.get(prototype) == score:
+            return
+        if prototype in self.members:
+            self.members[prototype] = score
+        elif len(self.members) < self.k:
+            self.members[prototype] = score
+        elif score > self.threshold():
+            del self.members[heapq.heappop(self.heap)[1]]
+            self.members[prototype] = score
+        else:
+            return
+        heapq.heappush(self.heap, (score, prototype))
+
+    def threshold(self):
+        if len(self.members) < self.k:
+            return float('-inf')
+        while self.members.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0]
+
+
+def add_result(results, prototypes, total_score):
+    """
+    A function to record a score for the prototypes of a typing statement's subject, keeping the maximum per prototype.
+    :param results: dict
+    :param prototypes: list
+    :param total_score: float
+    :return: None
+    """
+    for prototype in prototypes:
+        if prototype in results:
+            prev_score = results[prototype]
+            if total_score > prev_score:
+                results[prototype] = total_score
+        else:
+            results[prototype] = total_score
+
+
+def find_entrypoint(graph, entrypoint, cluster_to_prototype, entity_to_cluster, entities_to_roles, role_vars, ep_cap, role_flag, ep_index=None):
     """
     A function to resolve an entrypoint to the set of entity nodes that satisfy it.
-    This function iterates through every node in the graph. If that node is a typing statement, it computes a
-    typed score (how many matches between enttypes) and descriptor score (how many complete TypedDescriptor matches)
-    across all TypedDescriptors. These scores are mapped typed_score -> descriptor_score -> {Nodes}.
+    Without an index, this function iterates through every node in the graph. If that node is a typing statement,
+    it is a candidate; its score is mapped to the prototypes of the statement's subject, keeping the maximum score
+    per prototype.
+
+    Scores are computed column by column with normalize_scores. First, the cheap columns are computed for all
+    candidates: the typed score and the role penalty. Together with the maximum name and descriptor scores they give
+    an upper bound for the score of each candidate. Candidates are then scored in chunks, in order of decreasing
+    upper bound, and scoring stops as soon as no upper bound reaches the ep_cap-th best score so far.
+
+    With an EntrypointIndex, only the typing statements that can score above zero are candidates. All other typing
+    statements score zero (minus their role penalty), so they are only looked at if the candidates do not yield
+    ep_cap prototypes with a non-negative score.
 
-    The function returns the set of nodes mapped to the highest scores (i.e.,
-     highest typed_score -> highest descriptor_score).
+    The function returns the ep_cap prototypes with the highest scores.
     :param graph: AidaGraph
     :param entrypoint: Entrypoint
     :param cluster_to_prototype: dict
     :param entity_to_cluster: dict
     :param ep_cap: int
+    :param ep_index: EntrypointIndex or None
     :return: {Nodes}
     """
     results = {}
-    for node in graph.nodes():
+    top_k = TopKScores(ep_cap)
+
+    enttype_descriptors, name_descriptors, other_descriptors = split_typed_descriptors(entrypoint)
+    num_enttypes = len(enttype_descriptors)
+    num_names = len(name_descriptors)
+    num_descriptors = len(other_descriptors)
+
+    if ep_index is None:
+        candidates = ((None, node) for node in graph.nodes() if node.is_type_statement())
+    else:
+        candidate_positions = ep_index.candidate_positions(entrypoint)
+        candidates = ((position, ep_index.typing_statements[position]) for position in candidate_positions)
+        # typing statements that each name or descriptor check can give a score above zero
+        name_positions = [ep_index.descriptor_positions(td.descriptor) for td in name_descriptors]
+        descriptor_positions = [ep_index.descriptor_positions(td.descriptor) for td in other_descriptors]
+
+    # The cheap columns, and the name and descriptor checks to run, per candidate
+    nodes = []
+    node_prototypes = []
+    node_name_checks = []
+    node_descriptor_checks = []
+    typed_scores = array('d')
+    penalties = array('d')
+    for position, node in candidates:
+        subject_address = next(iter(node.get('subject')))
+        try:
+            prototypes = [cluster_to_prototype[cluster] for cluster in entity_to_cluster[subject_address]]
+        except KeyError:
+            if DEBUG:
+                print("KEY ERROR IN PROTOTYPE MAPPINGS!!")
+            continue
 
-        if node.is_type_statement():
-            typed_score = 0
+        # With an index, checks that cannot score above zero are known, and are neither counted in the bound nor run
+        if ep_index is None:
+            node_name_checks.append(name_descriptors)
+            node_descriptor_checks.append(other_descriptors)
+        else:
+            node_name_checks.append([td for td, positions in zip(name_descriptors, name_positions)
+                                     if position in positions])
+            node_descriptor_checks.append([td for td, positions in zip(other_descriptors, descriptor_positions)
+                                           if position in positions])
+
+        typed_score = 0
+        for typed_descriptor in enttype_descriptors:
+            typed_score += check_type(node, typed_descriptor)
+
+        nodes.append(node)
+        node_prototypes.append(prototypes)
+        typed_scores.append(typed_score)
+        penalties.append(role_penalty(entrypoint, subject_address, entities_to_roles, role_vars) if role_flag else 0)
+
+    upper_bounds = normalize_scores(typed_scores, num_enttypes,
+                                    array('d', [MAX_DESCRIPTOR_SCORE * len(checks) for checks in node_name_checks]), num_names,
+                                    array('d', [MAX_DESCRIPTOR_SCORE * len(checks) for checks in node_descriptor_checks]), num_descriptors,
+                                    penalties)
+
+    order = sorted(range(len(nodes)), key=lambda row: -upper_bounds[row])
+    chunk_size = max(ep_cap, 64)
+    for chunk_start in range(0, len(order), chunk_size):
+        threshold = top_k.threshold()
+        chunk = [row for row in order[chunk_start:chunk_start + chunk_size] if upper_bounds[row] >= threshold]
+        if not chunk:
+            # the remaining candidates have even lower upper bounds
+            break
+
+        name_scores = array('d')
+        descriptor_scores = array('d')
+        for row in chunk:
             name_score = 0
-            descriptor_score = 0
+            for typed_descriptor in node_name_checks[row]:
+                name_score += check_descriptor(graph, nodes[row], typed_descriptor, ep_index=ep_index)
+            name_scores.append(name_score)
 
-            has_type = 0
-            has_name = 0
-            has_descriptor = 0
-
-            num_enttypes = 0
-            num_descriptors = 0
-
-            # TODO: Why is this wrapped in a useless tuple??
-            for filler in entrypoint.typed_descriptor_list:
-                for typed_descriptor in filler:
-                    if typed_descriptor.enttype:
-                        has_type = 1
-                        num_enttypes += 1
-                        typed_score += check_type(node, typed_descriptor)
-                    if typed_descriptor.descriptor:
-                        if typed_descriptor.descriptor.descriptor_type == 'String':
-                            has_name = 1
-                            name_score += check_descriptor(graph, node, typed_descriptor)
-                        else:
-                            has_descriptor = 1
-                            num_descriptors += 1
-                            descriptor_score += check_descriptor(graph, node, typed_descriptor)
-
-            subject_address = next(iter(node.get('subject')))
+            descriptor_score = 0
+            for typed_descriptor in node_descriptor_checks[row]:
+                descriptor_score += check_descriptor(graph, nodes[row], typed_descriptor, ep_index=ep_index)
+            descriptor_scores.append(descriptor_score)
+
+        total_scores = normalize_scores(array('d', [typed_scores[row] for row in chunk]), num_enttypes,
+                                        name_scores, num_names,
+                                        descriptor_scores, num_descriptors,
+                                        array('d', [penalties[row] for row in chunk]))
+
+        for row, total_score in zip(chunk, total_scores):
+            add_result(results, node_prototypes[row], total_score)
+            for prototype in node_prototypes[row]:
+                top_k.update(prototype, results[prototype])
+
+    # Fill up with the typing statements that were not candidates. Their score is zero minus the role penalty,
+    # so they can only make it into the top ep_cap if there are fewer than ep_cap positive results.
+    # All of them are added, as ties with a score of zero are broken by prototype below, the same as in the full scan.
+    if ep_index is not None and len([score for score in results.values() if score > 0]) < ep_cap:
+        candidate_positions = set(candidate_positions)
+        for position, subject_address in enumerate(ep_index.subjects):
+            if position in candidate_positions:
+                continue
             try:
                 prototypes = [cluster_to_prototype[cluster] for cluster in entity_to_cluster[subject_address]]
             except KeyError:
-                if DEBUG:
-                    print("KEY ERROR IN PROTOTYPE MAPPINGS!!")
                 continue
-
-            # Compute the total score, pull the prototype, and add the prototype node to the results dict
-            # Compute the denominator for the score based on what information was present
-            raw_score = (typed_score/100) + (name_score/100) + (descriptor_score/100)
-            score_numerator = 0
-            score_denominator = 0
-
-            if has_type:
-                score_numerator += ((typed_score/num_enttypes)/100) * SCORE_WEIGHTS['type']
-                score_denominator += SCORE_WEIGHTS['type']
-            if has_name:
-                score_numerator += (name_score/100) * SCORE_WEIGHTS['name']
-                score_denominator += SCORE_WEIGHTS['name']
-            if has_descriptor:
-                score_numerator += ((descriptor_score/num_descriptors)/100) * SCORE_WEIGHTS['descriptor']
-                score_denominator += SCORE_WEIGHTS['descriptor']
-
-            total_score = (score_numerator/score_denominator) * 100
+            total_score = 0.0
             if role_flag:
-                penalty = 0
-                for role in role_vars[entrypoint.variable[0]]:  # [0] for senseless tuple wrapper
-                    if role not in entities_to_roles.get(subject_address, {}):
-                        if ROLE_PENALTY_DEBUG:
-                            print("PENALTY APPLIED!")
-                            print("Looking for: " + str(role))
-                            print("Observed roles: " + str(entities_to_roles.get(subject_address, {})))
-                            input()
-                        penalty += 30
-                total_score = total_score - penalty
+                total_score -= role_penalty(entrypoint, subject_address, entities_to_roles, role_vars)
+            add_result(results, prototypes, total_score)
 
-            if DEBUG:
-                print("Raw Score: " + str(raw_score))
-                print("Score Numerator: " + str(score_numerator))
-                print("Score Denominator: " + str(score_denominator))
+    # Break ties by prototype, as the order of the graph's nodes differs between runs
+    top_results = heapq.nsmallest(ep_cap, results.items(), key=lambda x: (-x[1], x[0]))
+    ep_list, ep_weight_list = zip(*top_results)
 
-
-            if DEBUG:
-                print("Normalized Score: " + str(total_score))
-                print()
-                print("##############################################")
-                print()
-                if (total_score >= DEBUG_SCORE_FLOOR):
-                    input()
-
-            for prototype in prototypes:
-                if prototype in results:
-                    prev_score = results[prototype]
-                    if total_score > prev_score:
-                        results[prototype] = total_score
-                else:
-                    results[prototype] = total_score
-            # if total_score in results:
-            #     results[total_score].update([(total_score, prototype) for prototype in prototypes])
-            # else:
-            #     results[total_score] = set([(total_score, prototype) for prototype in prototypes])
-
-    sorted_results = sorted(results.items(), key=lambda x: x[1], reverse=True)
-    ep_list, ep_weight_list = zip(*sorted_results[:ep_cap])
-
-    # set_of_nodes = set()
-    # return_count = 0
-    # scores_sorted = sorted(results.keys(), reverse=True)
-    # for score in scores_sorted:
-    #     for node in results[score]:
-    #         if return_count >= ep_cap:
-    #             break
-    #         elif node not in set_of_nodes:
-    #             return_count += 1
-    #             set_of_nodes.add(node)
-
-    # ordered_list = sorted(list(set_of_nodes), key=lambda x: x[0], reverse=True)
-    # ep_list = []
-    # ep_weight_list = []
-    # for elem in ordered_list:
-    #     ep_list.append(elem[1])
-    #     ep_weight_list.append(elem[0])
     return ep_list, ep_weight_list
 
 
-def resolve_all_entrypoints(graph, entrypoints, cluster_to_prototype, entity_to_cluster, entities_to_roles, var_roles, ep_cap, roles_flag):
+def resolve_all_entrypoints(graph, entrypoints, cluster_to_prototype, entity_to_cluster, entities_to_roles, var_roles, ep_cap, roles_flag, ep_index=None):
     ep_dict = {}
     ep_weight_dict = {}
     for entrypoint in entrypoints:
@@ -396,13 +618,99 @@ def resolve_all_entrypoints(graph, entrypoints, cluster_to_prototype, entity_to_
                                                   entities_to_roles,
                                                   var_roles,
                                                   ep_cap,
-                                                  roles_flag)
+                                                  roles_flag,
+                                                  ep_index=ep_index)
         ep_dict[entrypoint.variable[0]] = ep_list
         ep_weight_dict[entrypoint.variable[0]] = ep_weight_list
 
     return ep_dict, ep_weight_dict
 
 
+def get_var_roles(soin):
+    """
+    A function to gather, for each entrypoint variable of a SOIN, the roles it fills in the SOIN's frames.
+    :param soin: SOIN
+    :return: dict
+    """
+    ep_variables = set()
+    for ep in soin.entrypoints:
+        ep_variables.add(ep.variable[0])  # [0] is for senseless tuple wrapper
+
+    var_roles = {}
+    for frame in soin.frames:
+        for edge in frame.edge_list:
+            if edge.obj in ep_variables:
+                if edge.obj in var_roles:
+                    var_roles[edge.obj].add(edge.predicate)
+                else:
+                    var_roles[edge.obj] = {edge.predicate}
+    return var_roles
+
+
+def resolve_entrypoint_timed(graph, entrypoint, cluster_to_prototype, entity_to_cluster, entities_to_roles, var_roles, ep_cap, roles_flag, ep_index=None):
+    """
+    A function to resolve a single entrypoint with find_entrypoint, and time it.
+    :return: (ep_list, ep_weight_list, seconds)
+    """
+    start_time = time.time()
+    ep_list, ep_weight_list = find_entrypoint(graph,
+                                              entrypoint,
+                                              cluster_to_prototype,
+                                              entity_to_cluster,
+                                              entities_to_roles,
+                                              var_roles,
+                                              ep_cap,
+                                              roles_flag,
+                                              ep_index=ep_index)
+    return ep_list, ep_weight_list, time.time() - start_time
+
+
+def _resolve_entrypoint_in_worker(entrypoint, var_roles, ep_cap, roles_flag):
+    graph, cluster_to_prototype, entity_to_cluster, entities_to_roles, ep_index = _shared_resolution_data
+    return resolve_entrypoint_timed(graph, entrypoint, cluster_to_prototype, entity_to_cluster, entities_to_roles,
+                                    var_roles, ep_cap, roles_flag, ep_index=ep_index)
+
+
+def resolve_all_soins(graph, parsed_soins, cluster_to_prototype, entity_to_cluster, entities_to_roles, ep_cap, roles_flag, ep_index=None, num_workers=1):
+    """
+    A function to resolve the entrypoints of several SOINs. With num_workers > 1, the entrypoints of all SOINs are
+    distributed across a pool of worker processes that are forked from this one, so they share the graph, the cluster
+    mappings and the entrypoint index copy-on-write. Results are collected in order, so the output does not depend
+    on the number of workers.
+    :param parsed_soins: [(SOIN, var_roles)]
+    :return: [(ep_dict, ep_weight_dict, [seconds per entrypoint])], one per SOIN
+    """
+    global _shared_resolution_data
+
+    tasks = [(entrypoint, var_roles) for soin, var_roles in parsed_soins for entrypoint in soin.entrypoints]
+
+    if num_workers <= 1:
+        results = [resolve_entrypoint_timed(graph, entrypoint, cluster_to_prototype, entity_to_cluster,
+                                            entities_to_roles, var_roles, ep_cap, roles_flag, ep_index=ep_index)
+                   for entrypoint, var_roles in tasks]
+    else:
+        _shared_resolution_data = (graph, cluster_to_prototype, entity_to_cluster, entities_to_roles, ep_index)
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = [executor.submit(_resolve_entrypoint_in_worker, entrypoint, var_roles, ep_cap, roles_flag)
+                       for entrypoint, var_roles in tasks]
+            results = [future.result() for future in futures]
+
+    resolved_soins = []
+    results = iter(results)
+    for soin, var_roles in parsed_soins:
+        ep_dict = {}
+        ep_weight_dict = {}
+        ep_times = []
+        for entrypoint in soin.entrypoints:
+            ep_list, ep_weight_list, seconds = next(results)
+            ep_dict[entrypoint.variable[0]] = ep_list
+            ep_weight_dict[entrypoint.variable[0]] = ep_weight_list
+            ep_times.append(seconds)
+        resolved_soins.append((ep_dict, ep_weight_dict, ep_times))
+
+    return resolved_soins
+
+
 def main():
     parser = argparse.ArgumentParser(description="Convert an XML-based Statement of Information Need definition to "
                                                  "the JSON-compliant UT Austin internal representation, "
@@ -422,9 +730,39 @@ def main():
                         default=False,
                         help='This flag tells the program to consider role information')
     parser.add_argument('--dup_kb', default=None, help='path to the json file with duplicate KB ID mappings')
+    parser.add_argument('--no_ep_index',
+                        action='store_true',
+                        default=False,
+                        help='Scan all typing statements for each entrypoint instead of using an entrypoint index')
+    parser.add_argument('--no_cluster_mappings_cache',
+                        action='store_true',
+                        default=False,
+                        help='Always compute the cluster mappings instead of loading them from, and saving them to, '
+                             '<graph_in>.cluster_mappings.json')
+    parser.add_argument('-w',
+                        '--workers',
+                        action='store',
+                        type=int,
+                        default=1,
+                        help='The number of worker processes to resolve entrypoints in')
+    parser.add_argument('--name_matching',
+                        action='store',
+                        choices=['exact', 'normalized', 'fuzzy'],
+                        default='exact',
+                        help='How string descriptors are matched against names: exactly, after normalizing case, '
+                             'whitespace and diacritics, or also approximately by character n-grams '
+                             '(requires the entrypoint index)')
+    parser.add_argument('--fuzzy_threshold',
+                        action='store',
+                        type=float,
+                        default=0.7,
+                        help='The minimum n-gram Dice coefficient for approximate name matches')
 
     args = parser.parse_args()
 
+    if args.no_ep_index and args.name_matching != 'exact':
+        parser.error('--name_matching {} requires the entrypoint index'.format(args.name_matching))
+
     if not(os.path.exists(args.out_path)):
         os.mkdir(args.out_path)
 
@@ -439,49 +777,49 @@ def main():
     print("\tDone.\n")
 
     print("Getting Cluster Mappings...")
-    cluster_to_prototype, entity_to_cluster, entities_to_roles = get_cluster_mappings(graph)
+    if args.no_cluster_mappings_cache:
+        cluster_to_prototype, entity_to_cluster, entities_to_roles = get_cluster_mappings(graph)
+    else:
+        cluster_to_prototype, entity_to_cluster, entities_to_roles = load_cluster_mappings_for_kb(graph, args.graph_in)
     print("\tDone.\n")
 
-    soins = []
-    for f in os.listdir(args.soin_in):
-        if f.endswith('.xml'):
-            soins.append(f)
+    ep_index = None
+    if not args.no_ep_index:
+        print("Building Entrypoint Index...")
+        ep_index = EntrypointIndex(graph, name_matching=args.name_matching, fuzzy_threshold=args.fuzzy_threshold)
+        print("\tDone.\n")
+
+    soins = sorted(f for f in os.listdir(args.soin_in) if f.endswith('.xml'))
+    parsed_soins = []
     s_count = 0
     for s in soins:
         s_count += 1
-        print("Processing SOIN " + str(s_count) + " of " + str(len(soins)))
-        print("\tParsing SOIN XML...")
+        print("Parsing SOIN " + str(s_count) + " of " + str(len(soins)))
         soin = SOIN.process_xml(os.path.join(args.soin_in, s), dup_kbid_mapping=dup_kbid_mapping)
-        print("\t\tDone.\n")
-
-
-        print('\tGathering role information...')
-        ep_variables = set()
-        for ep in soin.entrypoints:
-            ep_variables.add(ep.variable[0])  # [0] is for senseless tuple wrapper
+        parsed_soins.append((soin, get_var_roles(soin)))
+    print("\tDone.\n")
 
-        var_roles = {}
-        for frame in soin.frames:
-            for edge in frame.edge_list:
-                if edge.obj in ep_variables:
-                    if edge.obj in var_roles:
-                        var_roles[edge.obj].add(edge.predicate)
-                    else:
-                        var_roles[edge.obj] = {edge.predicate}
-        print("\t\tDone.\n")
-
-        print("\tResolving all entrypoints...")
-        ep_dict, ep_weights_dict = resolve_all_entrypoints(graph,
-                                                           soin.entrypoints,
-                                                           cluster_to_prototype,
-                                                           entity_to_cluster,
-                                                           entities_to_roles,
-                                                           var_roles,
-                                                           args.ep_cap,
-                                                           args.roles)
-
-        print("\t\tDone.\n")
+    # Evaluate descriptors before the workers are forked, so that they share the cached scores
+    if ep_index is not None:
+        print("Evaluating descriptors...")
+        ep_index.evaluate_descriptors([ep for soin, var_roles in parsed_soins for ep in soin.entrypoints])
+        print("\tDone.\n")
+
+    print("Resolving all entrypoints with " + str(args.workers) + " worker(s)...")
+    start_time = time.time()
+    resolved_soins = resolve_all_soins(graph,
+                                       parsed_soins,
+                                       cluster_to_prototype,
+                                       entity_to_cluster,
+                                       entities_to_roles,
+                                       args.ep_cap,
+                                       args.roles,
+                                       ep_index=ep_index,
+                                       num_workers=args.workers)
+    total_time = time.time() - start_time
+    print("\tDone.\n")
 
+    for s, (soin, var_roles), (ep_dict, ep_weights_dict, ep_times) in zip(soins, parsed_soins, resolved_soins):
         write_me = {
             'graph': '',
             'entrypoints': ep_dict,
@@ -490,19 +828,21 @@ def main():
             'facets': [],
         }
 
-        print("\tSerializing data structures...")
         temporal_info = soin.temporal_info_to_dict()
         for frame in soin.frames:
             frame_rep = frame.frame_to_dict(temporal_info)
             write_me['facets'].append(frame_rep)
-        print("\t\tDone.\n")
 
-        print("\tWriting output...")
+        print("Writing output for " + s + "...")
         with open(os.path.join(args.out_path, s.strip('.xml') + '_query.json'), 'w') as out:
             json.dump(write_me, out, indent=1)
-        print("\t\tDone.\n")
+    print("\tDone.\n")
+
+    print("Resolved entrypoints of {} SOINs in {:.2f} seconds".format(len(soins), total_time))
+    for s, (ep_dict, ep_weights_dict, ep_times) in zip(soins, resolved_soins):
+        print("\t{}: {} entrypoints, {:.2f} seconds (slowest {:.2f})".format(
+            s, len(ep_times), sum(ep_times), max(ep_times, default=0)))
 
 
 if __name__ == "__main__":
     main()
-
@@ -13,6 +13,9 @@ SCORE_WEIGHTS = {
     'type': 1,
 }
 
+#  The highest score a single name or descriptor check can give (e.g. 10 for the document, plus 90 for the overlap)
+MAX_DESCRIPTOR_SCORE = 100
+
 
 EP_REP_TEMPLATE = {
     "variable": None,
@@ -1,9 +1,20 @@
 # Pengxiang Cheng Fall 2018
 # pre- and postprocessing for the AIDA eval
 
-from os.path import exists, join
-from os import makedirs
+import hashlib
+import heapq
+import json
+import math
+import queue
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import exists, getsize, join
+from os import makedirs, remove, rename
+
+from rdflib import Graph
+from rdflib.plugins.parsers.notation3 import BadSyntax
+from rdflib.term import BNode
 
 
 # split node_query_item_list evenly into num_node_queries partitions,
@@ -11,7 +22,9 @@ import subprocess
 def produce_node_queries(node_query_item_list, num_node_queries):
     node_query_prefix = 'DESCRIBE '
 
-    node_query_item_list = list(set(node_query_item_list))
+    # sorted, so that the query text does not depend on string hashing,
+    # which varies between runs (see QueryResultCache)
+    node_query_item_list = sorted(set(node_query_item_list))
 
     node_query_list = []
 
@@ -130,113 +143,350 @@ def produce_conf_queries(
     return stmt_query_list
 
 
+# split items into partitions of roughly equal total cost, using the longest
+# processing time first heuristic: items are taken in descending order of
+# cost and each is added to the currently cheapest partition. The number of
+# partitions is chosen so that each has a total cost of about
+# max_cost_per_partition. item_costs defaults to a cost of 1 per item.
+def partition_by_cost(items, item_costs=None, max_cost_per_partition=3000):
+    if not items:
+        return []
+    if item_costs is None:
+        item_costs = [1] * len(items)
+
+    total_cost = sum(item_costs)
+    num_partitions = max(1, int(math.ceil(total_cost / max_cost_per_partition)))
+    num_partitions = min(num_partitions, len(items))
+
+    partitions = [[] for _ in range(num_partitions)]
+    partition_heap = [(0, partition_idx) for partition_idx in range(num_partitions)]
+
+    for item_idx in sorted(range(len(items)), key=lambda idx: item_costs[idx],
+                           reverse=True):
+        partition_cost, partition_idx = heapq.heappop(partition_heap)
+        partitions[partition_idx].append(items[item_idx])
+        heapq.heappush(
+            partition_heap, (partition_cost + item_costs[item_idx], partition_idx))
+
+    return partitions
+
+
+# generate DESCRIBE queries that bind the variables in value_vars to the tuples
+# of IRIs in value_tuple_list through a VALUES block, joined with
+# where_pattern, instead of one UNION branch per tuple. For example, with
+# value_vars = ['?s', '?o'] and where_pattern =
+# '?x rdf:subject ?s .\n?x rdf:object ?o .', this describes all statements
+# with the given (subject, object) pairs.
+# Tuples are partitioned by cost, see partition_by_cost.
+def produce_values_queries(
+        value_tuple_list, value_vars, where_pattern, query_prefixes,
+        describe_var='?x', item_costs=None, max_cost_per_query=3000):
+    query_list = []
+
+    for partition in partition_by_cost(
+            value_tuple_list, item_costs=item_costs,
+            max_cost_per_partition=max_cost_per_query):
+        values_rows = '\n'.join(
+            '({})'.format(' '.join('<{}>'.format(value) for value in value_tuple))
+            for value_tuple in partition)
+
+        query_list.append(
+            '{}DESCRIBE {}\nWHERE {{\nVALUES ({}) {{\n{}\n}}\n{}\n}}'.format(
+                query_prefixes, describe_var, ' '.join(value_vars), values_rows,
+                where_pattern))
+
+    return query_list
+
+
+# VALUES queries for Statement nodes by (subject, object) pairs
+def produce_stmt_values_queries(
+        stmt_pair_list, query_prefixes, item_costs=None, max_cost_per_query=3000):
+    return produce_values_queries(
+        stmt_pair_list, ['?s', '?o'], '?x rdf:subject ?s .\n?x rdf:object ?o .',
+        query_prefixes, item_costs=item_costs,
+        max_cost_per_query=max_cost_per_query)
+
+
+# VALUES queries for ClusterMembership nodes by (member, cluster) pairs
+def produce_cm_values_queries(
+        cm_pair_list, query_prefixes, item_costs=None, max_cost_per_query=3000):
+    return produce_values_queries(
+        cm_pair_list, ['?m', '?c'],
+        '?x aida:clusterMember ?m .\n?x aida:cluster ?c .',
+        query_prefixes, item_costs=item_costs,
+        max_cost_per_query=max_cost_per_query)
+
+
+# run a single query file with tdbquery on db_path, writing the result to
+# result_path. Return True if tdbquery exits successfully.
+# The result is written to a temporary file that is only renamed to
+# result_path on success, so a failed or timed-out query leaves no
+# (partial) result behind.
+def run_tdbquery(query_path, db_path, result_path, timeout=None):
+    tmp_result_path = result_path + '.tmp'
+    success = False
+    try:
+        with open(tmp_result_path, 'w') as fout:
+            process = subprocess.run(
+                ['tdbquery', '--loc', db_path, '--query', query_path],
+                stdout=fout, timeout=timeout)
+        success = process.returncode == 0
+    except subprocess.TimeoutExpired:
+        pass
+    finally:
+        if success:
+            rename(tmp_result_path, result_path)
+        else:
+            if exists(tmp_result_path):
+                remove(tmp_result_path)
+            # a result from a previous attempt or run is not valid either
+            if exists(result_path):
+                remove(result_path)
+    return success
+
+
+# execute a list of query tasks, each being a (query_path, result_path) pair,
+# on a bunch of TDB database copies. Every task is pulled from a shared queue
+# by one of max_concurrency workers (default to one per DB copy), which
+# borrows a free DB copy for the duration of the query, so a slow query only
+# blocks one worker. Failed queries are retried up to max_retries times.
+# If cache (a QueryResultCache) is given, results of queries that were
+# already run on the same database are copied from the cache instead.
+# Return a list of per-query reports with the wall time and result size.
+def schedule_sparql_queries(query_task_list, db_path_list, max_concurrency=None,
+                            max_retries=2, timeout=None, cache=None):
+    if max_concurrency is None:
+        max_concurrency = len(db_path_list)
+
+    # all copies hold the same KB, so the first one identifies the database
+    db_fingerprint = cache.db_fingerprint(db_path_list[0]) if cache else None
+
+    # DB copies are handed out round-robin, so with more workers than
+    # copies, several queries can run on the same copy concurrently
+    db_slots = queue.Queue()
+    for slot_idx in range(max_concurrency):
+        db_slots.put(db_path_list[slot_idx % len(db_path_list)])
+
+    def run_task(task):
+        query_path, result_path = task
+        report = {'query': query_path, 'result': result_path, 'attempts': [],
+                  'cached': False}
+
+        cache_key = None
+        if cache is not None:
+            with open(query_path, 'r') as fin:
+                cache_key = cache.key(fin.read(), db_fingerprint)
+            start_time = time.time()
+            if cache.get(cache_key, result_path):
+                report['cached'] = True
+                report['success'] = True
+                report['wall_time'] = time.time() - start_time
+                report['result_size'] = getsize(result_path)
+                return report
+
+        for attempt_idx in range(max_retries + 1):
+            db_path = db_slots.get()
+            try:
+                print('query {} on {}'.format(query_path, db_path))
+                start_time = time.time()
+                success = run_tdbquery(
+                    query_path, db_path, result_path, timeout=timeout)
+                wall_time = time.time() - start_time
+            finally:
+                db_slots.put(db_path)
+
+            report['attempts'].append(
+                {'db': db_path, 'success': success, 'wall_time': wall_time})
+            if success:
+                break
+            print('Warning! query {} failed on {} (attempt {} of {})'.format(
+                query_path, db_path, attempt_idx + 1, max_retries + 1))
+
+        report['success'] = success
+        if success and cache is not None:
+            cache.put(cache_key, result_path)
+        report['wall_time'] = sum(
+            attempt['wall_time'] for attempt in report['attempts'])
+        report['result_size'] = \
+            getsize(result_path) if exists(result_path) else 0
+        return report
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        return list(executor.map(run_task, query_task_list))
+
+
+# map every blank node in graph g to a label derived from the content of
+# its subgraph (its outgoing triples, recursively) and from the node and
+# predicate pointing to it, so that the same blank node returned by different
+# DESCRIBE queries gets the same label, while identical blank nodes in
+# different places (e.g., two confidence values of 1.0) are kept apart.
+def canonical_bnode_labels(g):
+    content_keys = {}
+    bnode_labels = {}
+
+    def content_key(term, visiting):
+        if not isinstance(term, BNode):
+            return term.n3()
+        if term in content_keys:
+            return content_keys[term]
+        # guard against cycles of blank nodes
+        if term in visiting:
+            return '_:cycle'
+
+        visiting.add(term)
+        po_keys = sorted('{} {}'.format(pred.n3(), content_key(obj, visiting))
+                         for pred, obj in g.predicate_objects(subject=term))
+        visiting.discard(term)
+
+        key = hashlib.sha1('\n'.join(po_keys).encode()).hexdigest()
+        content_keys[term] = key
+        return key
+
+    def label(term, visiting):
+        if not isinstance(term, BNode):
+            return term.n3()
+        if term in bnode_labels:
+            return bnode_labels[term]
+        if term in visiting:
+            return '_:cycle'
+
+        visiting.add(term)
+        parent_keys = sorted('{} {}'.format(label(subj, visiting), pred.n3())
+                             for subj, pred in g.subject_predicates(object=term))
+        visiting.discard(term)
+
+        parent_key = parent_keys[0] if parent_keys else ''
+        bnode_labels[term] = 'b' + hashlib.sha1('{}\n{}'.format(
+            parent_key, content_key(term, set())).encode()).hexdigest()
+        return bnode_labels[term]
+
+    for term in set(g.subjects()) | set(g.objects()):
+        if isinstance(term, BNode):
+            label(term, set())
+
+    return bnode_labels
+
+
+# merge the result files of SPARQL queries into merged_result_path, one
+# result file at a time. Triples are deduplicated across files, with blank
+# nodes identified by the content of their subgraphs (see
+# canonical_bnode_labels), and written one triple per line (N-Triples style,
+# which is also valid Turtle). If sort_by_subject is True, triples are
+# grouped by subject in the output, which makes later parsing faster.
+# Result files that cannot be parsed are skipped with a warning.
+def merge_sparql_results(query_result_path_list, merged_result_path,
+                         header_prefixes, sort_by_subject=False):
+    seen_triples = set()
+    sorted_lines = []
+
+    num_triples = 0
+
+    with open(merged_result_path, 'w') as fout:
+        fout.write(header_prefixes + '\n')
+
+        for query_result_path in query_result_path_list:
+            if not exists(query_result_path):
+                continue
+
+            g = Graph()
+            try:
+                g.parse(query_result_path, format='ttl')
+            except BadSyntax as e:
+                print('Warning! skipping result {} that cannot be parsed: {}'.format(
+                    query_result_path, e))
+                continue
+            bnode_labels = canonical_bnode_labels(g)
+
+            for triple in g:
+                subj_str, pred_str, obj_str = [
+                    '_:' + bnode_labels[term] if isinstance(term, BNode)
+                    else term.n3() for term in triple]
+
+                line = '{} {} {} .\n'.format(subj_str, pred_str, obj_str)
+                line_hash = hashlib.sha1(line.encode()).digest()
+                if line_hash in seen_triples:
+                    continue
+                seen_triples.add(line_hash)
+                num_triples += 1
+
+                if sort_by_subject:
+                    sorted_lines.append((subj_str, line))
+                else:
+                    fout.write(line)
+
+        if sort_by_subject:
+            sorted_lines.sort()
+            for _, line in sorted_lines:
+                fout.write(line)
+
+    return num_triples
+
+
 # execute a list of node queries and a list of statement queries in parallel
-# on a bunch of TDB database copies. The number of node queries should be
-# equal to the number of DB copies.
+# on a bunch of TDB database copies, see schedule_sparql_queries.
+# a json report of per-query wall time and result size is written to
+# {output_dir}/{filename_prefix}-report.json, see schedule_sparql_queries for
+# the optional result cache.
+# query results are merged into {output_dir}/{filename_prefix}-raw.ttl, see
+# merge_sparql_results.
 # set dry_run = True to only write the query files without executing them.
 def execute_sparql_queries(node_query_list, stmt_query_list, just_query_list, conf_query_list,
                            db_path_list, output_dir, filename_prefix, header_prefixes,
-                           dry_run=False):
-    assert len(node_query_list) == len(db_path_list)
-
+                           dry_run=False, max_concurrency=None, max_retries=2,
+                           query_timeout=None, sort_merged_result=False,
+                           cache=None):
     if not exists(output_dir):
         makedirs(output_dir)
 
-    query_cmd_list = []
-
-    query_result_path_list = []
+    query_task_list = []
 
     print('Writing queries to files ...')
-    for node_query_idx, node_query in enumerate(node_query_list):
-        node_query_path = join(output_dir, '{}-node-query-{}.rq'.format(
-            filename_prefix, node_query_idx))
-        with open(node_query_path, 'w') as fout:
-            fout.write(node_query + '\n')
-
-        node_query_result_path = join(
-            output_dir, '{}-node-query-{}-result.ttl'.format(
-                filename_prefix, node_query_idx))
-        query_result_path_list.append(node_query_result_path)
-
-        query_cmd_list.append(
-            'echo "query {0}"; tdbquery --loc {1} --query {0} > {2}; '.format(
-                node_query_path, db_path_list[node_query_idx],
-                node_query_result_path))
-
-    num_db = len(db_path_list)
-    num_stmt_query = len(stmt_query_list)
-
-    for stmt_query_idx, stmt_query in enumerate(stmt_query_list):
-        stmt_query_path = join(output_dir, '{}-stmt-query-{}.rq'.format(
-            filename_prefix, stmt_query_idx))
-        with open(stmt_query_path, 'w') as fout:
-            fout.write(stmt_query + '\n')
-
-        stmt_query_result_path = join(
-            output_dir, '{}-stmt-query-{}-result.ttl'.format(
-                filename_prefix, stmt_query_idx))
-        query_result_path_list.append(stmt_query_result_path)
-
-        db_idx = int(stmt_query_idx / num_stmt_query * num_db)
-        query_cmd_list[db_idx] += \
-            'echo "query {0}"; tdbquery --loc {1} --query {0} > {2}; '.format(
-                stmt_query_path, db_path_list[db_idx], stmt_query_result_path)
-
-    num_just_query = len(just_query_list)
-
-    for just_query_idx, just_query in enumerate(just_query_list):
-        just_query_path = join(output_dir, '{}-just-query-{}.rq'.format(
-            filename_prefix, just_query_idx))
-        with open(just_query_path, 'w') as fout:
-            fout.write(just_query + '\n')
-
-        just_query_result_path = join(
-            output_dir, '{}-just-query-{}-result.ttl'.format(
-                filename_prefix, just_query_idx))
-        query_result_path_list.append(just_query_result_path)
-
-        db_idx = int(just_query_idx / num_just_query * num_db)
-        query_cmd_list[db_idx] += \
-            'echo "query {0}"; tdbquery --loc {1} --query {0} > {2}; '.format(
-                just_query_path, db_path_list[db_idx], just_query_result_path)
-
-    num_conf_query = len(conf_query_list)
-
-    for conf_query_idx, conf_query in enumerate(conf_query_list):
-        conf_query_path = join(output_dir, '{}-conf-query-{}.rq'.format(
-            filename_prefix, conf_query_idx))
-        with open(conf_query_path, 'w') as fout:
-            fout.write(conf_query + '\n')
-
-        conf_query_result_path = join(
-            output_dir, '{}-conf-query-{}-result.ttl'.format(
-                filename_prefix, conf_query_idx))
-        query_result_path_list.append(conf_query_result_path)
-
-        db_idx = int(conf_query_idx / num_conf_query * num_db)
-        query_cmd_list[db_idx] += \
-            'echo "query {0}"; tdbquery --loc {1} --query {0} > {2}; '.format(
-                conf_query_path, db_path_list[db_idx], conf_query_result_path)
+    for query_type, query_list in [('node', node_query_list),
+                                   ('stmt', stmt_query_list),
+                                   ('just', just_query_list),
+                                   ('conf', conf_query_list)]:
+        for query_idx, query in enumerate(query_list):
+            query_path = join(output_dir, '{}-{}-query-{}.rq'.format(
+                filename_prefix, query_type, query_idx))
+            with open(query_path, 'w') as fout:
+                fout.write(query + '\n')
+
+            query_result_path = join(
+                output_dir, '{}-{}-query-{}-result.ttl'.format(
+                    filename_prefix, query_type, query_idx))
+            query_task_list.append((query_path, query_result_path))
 
     if not dry_run:
         print('Executing queries ...')
-        process_list = [
-            subprocess.Popen(cmd, shell=True) for cmd in query_cmd_list]
+        query_reports = schedule_sparql_queries(
+            query_task_list, db_path_list, max_concurrency=max_concurrency,
+            max_retries=max_retries, timeout=query_timeout, cache=cache)
+
+        num_failed = sum(1 for report in query_reports if not report['success'])
+        if num_failed > 0:
+            print('Warning! {} of {} queries failed after retries'.format(
+                num_failed, len(query_reports)))
+
+        if cache is not None:
+            print('Query result cache: {}'.format(cache.stats()))
+
+        report_path = join(output_dir, '{}-report.json'.format(filename_prefix))
+        print('Writing query report to {} ...'.format(report_path))
+        with open(report_path, 'w') as fout:
+            json.dump(query_reports, fout, indent=2)
 
-        for process in process_list:
-            process.wait()
+        # only merge the results of queries that succeeded
+        query_result_path_list = [
+            report['result'] for report in query_reports if report['success']]
 
     if not dry_run:
         merged_result_path = join(output_dir, '{}-raw.ttl'.format(filename_prefix))
         print('Merging query outputs to {} ...'.format(merged_result_path))
 
-        with open(merged_result_path, 'w') as fout:
-            fout.write(header_prefixes + '\n')
-            for query_result_path in query_result_path_list:
-                with open(query_result_path, 'r') as fin:
-                    for line in fin.readlines():
-                        if not line.startswith('@prefix'):
-                            fout.write(line)
+        num_triples = merge_sparql_results(
+            query_result_path_list, merged_result_path, header_prefixes,
+            sort_by_subject=sort_merged_result)
+        print('Wrote {} distinct triples'.format(num_triples))
 
     # merge_cmd = \
     #     'cp {0}/{1}-node-query-0-result.ttl ' \
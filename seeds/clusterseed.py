@@ -8,8 +8,14 @@
 import sys
 from collections import deque, defaultdict
 import datetime
+import time
+import resource
+import multiprocessing
+from multiprocessing.managers import BaseManager
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import math
 import itertools
+import heapq
 import functools
 import operator
 import scipy.stats
@@ -511,13 +517,92 @@ class OneClusterSeed:
         return strval in self.graph_obj.string_constants_of_graph
 
       
+#########################
+#########################
+# parallel seed expansion
+
+# data shared with worker processes for parallel seed expansion:
+# ClusterSeeds object, qvar signature counts, shared pruning statistics,
+# and the event by which the main process tells the workers that the memory budget is used up.
+# set before the worker processes are forked, so it does not need to be pickled
+_shared_seed_data = None
+
+# expand one shard of initial seeds in a worker process.
+# shard is a list of entry point combinations (facet index, qvar_filler, entry point weight),
+# from which the initial seeds are made one at a time
+def _expand_seeds_in_worker(shard):
+    clusterseeds_obj, qvar_signatures, pruning_statistics, memory_exceeded = _shared_seed_data
+    facets = clusterseeds_obj.soin_obj["facets"]
+
+    # the memory budget is for all processes together, so it is checked by the main process
+    clusterseeds_obj.memory_exceeded = memory_exceeded
+
+    initial_seeds = (clusterseeds_obj._initial_seed(facets[facet_idx], qvar_filler, entrypoint_weight)
+                         for facet_idx, qvar_filler, entrypoint_weight in shard)
+    hypotheses_done, found = clusterseeds_obj._expand_seeds(initial_seeds, qvar_signatures, pruning_statistics)
+    return ([ clusterseeds_obj._finished_seed_state(h) for h in hypotheses_done ], found, clusterseeds_obj.truncated)
+
+# pruning statistics shared by all worker processes, kept in a manager process:
+# counts of qvar signatures for the qs cutoff, and whether any worker
+# has found a hypothesis without failed queries
+class PruningStatistics:
+    def __init__(self, qs_cutoff):
+        self.qs_cutoff = qs_cutoff
+        self.qvar_signatures = { }
+        # signatures that have reached qs_cutoff, in the order in which they reached it
+        self.saturated_signatures = [ ]
+        self.found_hypothesis_without_failed_queries = False
+
+    # add a worker's counts, return the total counts for the same signatures,
+    # the signatures that have reached qs_cutoff since the worker last asked,
+    # the number of saturated signatures, and whether any worker has found a hypothesis without failed queries
+    def sync(self, qvar_signature_deltas, found_hypothesis_without_failed_queries, num_saturated_seen):
+        counts = { }
+        for q1, delta in qvar_signature_deltas.items():
+            count = self.qvar_signatures.get(q1, 0) + delta
+            self.qvar_signatures[ q1 ] = count
+            counts[ q1 ] = count
+            if self.qs_cutoff is not None and count >= self.qs_cutoff and count - delta < self.qs_cutoff:
+                self.saturated_signatures.append(q1)
+
+        if found_hypothesis_without_failed_queries:
+            self.found_hypothesis_without_failed_queries = True
+
+        return (counts, self.saturated_signatures[num_saturated_seen:], len(self.saturated_signatures), self.found_hypothesis_without_failed_queries)
+
+class PruningStatisticsManager(BaseManager):
+    pass
+
+PruningStatisticsManager.register("PruningStatistics", PruningStatistics)
+
+# memory used by the process with the given pid, in MB.
+# uses the proportional set size, so that memory that forked processes share
+# with their parent is not counted twice. Linux only: returns 0 if /proc is not available
+def _process_memory_mb(pid):
+    try:
+        with open("/proc/{}/smaps_rollup".format(pid)) as fin:
+            for line in fin:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        with open("/proc/{}/status".format(pid)) as fin:
+            for line in fin:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0
+
 #########################
 #########################
 # class that manages all cluster seeds
 class ClusterSeeds:
     # initialize with an AidaJson object and a statement of information need,
     # which is just a json object
-    def __init__(self, graph_obj, soin_obj, discard_failedqueries = False, earlycutoff = None, qs_cutoff = None):
+    def __init__(self, graph_obj, soin_obj, discard_failedqueries = False, earlycutoff = None, qs_cutoff = None, beam_width = None,
+                     time_budget = None, memory_budget = None, num_workers = 1):
         self.graph_obj = graph_obj
         self.soin_obj = soin_obj
 
@@ -530,6 +615,36 @@ class ClusterSeeds:
         # with the same fillers for QS_COUNT_CUTOFF query variables?
         self.QS_COUNT_CUTOFF = 3
         self.QS_CUTOFF = qs_cutoff
+        # beam search: if not None, expand hypotheses level by level,
+        # keeping only the best beam_width unfinished hypotheses of each facet at each level
+        self.beam_width = beam_width
+        # number of adjacent statements of each ERE, for connectedness
+        self.ere_degree = { }
+        # stop creating seeds after time_budget seconds, or when the process
+        # has used more than memory_budget MB. check every BUDGET_CHECK_INTERVAL hypotheses.
+        # if we stopped early, truncated says why ("time" or "memory"), otherwise it is None.
+        # with parallel workers, the main process checks both budgets every BUDGET_CHECK_SECONDS,
+        # and then stops shards from starting. the memory budget is for the main process and
+        # all workers together, so the main process tells the workers through
+        # the event memory_exceeded (which is None when not in a worker)
+        self.time_budget = time_budget
+        self.memory_budget = memory_budget
+        self.BUDGET_CHECK_INTERVAL = 100
+        self.BUDGET_CHECK_SECONDS = 1.0
+        self.memory_exceeded = None
+        self.budget_counter = 0
+        self.truncated = None
+        self.starttime = time.time()
+        # expand seeds in parallel in num_workers processes (not used in beam search),
+        # in shards of SHARD_SIZE entry point combinations, with at most SHARDS_PER_WORKER
+        # shards per worker submitted at a time
+        self.num_workers = num_workers
+        self.SHARD_SIZE = 20
+        self.SHARDS_PER_WORKER = 2
+        # in worker processes: how often to sync pruning statistics with the other workers,
+        # and how many saturated qvar signatures we have already heard about
+        self.SYNC_INTERVAL = 1000
+        self.num_saturated_seen = 0
 
 
         # parameters for ranking
@@ -565,17 +680,15 @@ class ClusterSeeds:
     # create initial cluster seeds.
     # this is called from __init__
     def _make_seeds(self):
-        # keep queue of hypotheses-in-making, list of finished hypotheses
-        hypotheses_todo = deque()
+        # list of finished hypotheses
         hypotheses_done = [ ]
 
         # have we found any hypothesis without failed queries yet?
         # if so, we can eliminate all hypotheses with failed queries
         previously_found_hypothesis_without_failed_queries = False
 
-        if self.earlycutoff is not None:
-            facet_cutoff = self.earlycutoff / len(self.soin_obj["facets"])
-
+        # signatures of query variables, for qs cutoff
+        qvar_signatures = { }
 
         ## # TESTING
         ## for epvar, epfillers in self.soin_obj["entrypoints"].items():
@@ -583,101 +696,121 @@ class ClusterSeeds:
         ##         print(epvar, epfiller, self.soin_obj["entrypointWeights"][epvar][index], self._entrypoint_filler_rolescore(epvar, epfiller, self.soin_obj["facets"][0]))
 
         ## input()
-            
-        ################
-        print("Initializing cluster seeds (if stalled, set earlycutoff)")
-        # initialize deque with one core hypothesis per facet
-        for facet in self.soin_obj["facets"]:
-            reranked_entrypoints = {}
-            reranked_entrypoint_weights = {}
-
-            for ep_var, ep_fillers in self.soin_obj['entrypoints'].items():
-                ep_weights = self.soin_obj['entrypointWeights'][ep_var]
-
-                print('Entry point: {}'.format(ep_var))
-
-                filler_weight_mapping = {}
-
-                fillers_filtered_both = []
-                fillers_filtered_role_score = []
-
-                for ep_filler, ep_weight in zip(ep_fillers, ep_weights):
-                    ep_role_score = self._entrypoint_filler_rolescore(ep_var, ep_filler, facet)
-                    filler_weight_mapping[ep_filler] = (ep_weight, ep_role_score)
-                    if ep_role_score > 0:
-                        fillers_filtered_role_score.append(ep_filler)
-                        if ep_weight > 50.0:
-                            fillers_filtered_both.append(ep_filler)
-
-                if len(fillers_filtered_both) > 0:
-                    print('\tKept {} fillers with both SoIN weight > 50 and role score > 0'.format(len(fillers_filtered_both)))
-                    reranked_entrypoints[ep_var] = fillers_filtered_both
-                    reranked_entrypoint_weights[ep_var] = [
-                        filler_weight_mapping[filler][0] * filler_weight_mapping[filler][1]
-                        for filler in fillers_filtered_both]
-                elif len(fillers_filtered_role_score) > 0:
-                    print('\tKept {} fillers with role score > 0'.format(len(fillers_filtered_role_score)))
-                    reranked_entrypoints[ep_var] = fillers_filtered_role_score
-                    reranked_entrypoint_weights[ep_var] = [
-                        filler_weight_mapping[filler][0] * filler_weight_mapping[filler][1]
-                        for filler in fillers_filtered_role_score]
-                else:
-                    print('\tKept all {} fillers (no filler has role score > 0)'.format(len(ep_fillers)))
-                    reranked_entrypoints[ep_var] = ep_fillers
-                    reranked_entrypoint_weights[ep_var] = ep_weights
-
-            index = 0
-            if self.earlycutoff is None:
-                for qvar_filler, entrypoint_weight in self._each_entry_point_combination(reranked_entrypoints, reranked_entrypoint_weights, facet):
-                    ## print("entry points")
-                    ## for q, f in qvar_filler.items():
-                    ##     print(q, f[-5:])
-                    ## print("====")
-                    # index += 1
-
-                    # if self.earlycutoff is not None and index >= facet_cutoff:
-                    #     # print("early cutoff on cluster seeds: breaking off at", index)
-                    #     break
-
-                    # start a new hypothesis
-                    core_hyp = OneClusterSeed(self.graph_obj, facet["queryConstraints"], self._pythonize_datetime(facet.get("temporal", {})), \
-                                                  AidaHypothesis(self.graph_obj), qvar_filler, entrypointweight = entrypoint_weight,
-                                                  entrypoints = list(qvar_filler.keys()))
-                    hypotheses_todo.append(core_hyp)
+
+        if self.beam_width is not None:
+            # beam search: expand the hypotheses of each facet level by level
+            for facet in self.soin_obj["facets"]:
+                print("Initializing cluster seeds for facet (if stalled, set earlycutoff)")
+                beam = list(itertools.islice(self._each_initial_seed(facet), self.beam_width))
+
+                print("Extending cluster seeds with beam width", self.beam_width)
+                while len(beam) > 0 and self.truncated is None:
+                    new_beam = [ ]
+                    for core_hyp in beam:
+                        # the budget only applies once we have some finished hypotheses
+                        if len(hypotheses_done) > 0 and self._out_of_budget():
+                            break
+
+                        if self._qs_cutoff_reached(core_hyp, qvar_signatures):
+                            continue
+
+                        if self.discard_failedqueries and previously_found_hypothesis_without_failed_queries and not(core_hyp.no_failed_core_constraints()):
+                            continue
+
+                        if core_hyp.done:
+                            hypotheses_done, previously_found_hypothesis_without_failed_queries = \
+                                self._add_done_hypothesis(core_hyp, hypotheses_done, previously_found_hypothesis_without_failed_queries)
+                            continue
+
+                        new_beam += core_hyp.extend()
+
+                    beam = self._prune_beam(new_beam)
+
+                if self.truncated is not None:
+                    break
+
+        else:
+            ################
+            print("Initializing and extending cluster seeds (if stalled, set earlycutoff; if too many, reduce rank_cutoff)")
+            if self.num_workers > 1:
+                # entry point combinations of all facets, from which the workers make the initial seeds
+                combinations = ((facet_idx, qvar_filler, entrypoint_weight)
+                                    for facet_idx, facet in enumerate(self.soin_obj["facets"])
+                                    for qvar_filler, entrypoint_weight in self._each_facet_entry_point_combination(facet))
+                hypotheses_done, previously_found_hypothesis_without_failed_queries = self._expand_seeds_parallel(combinations)
             else:
-                for qvar_filler, entrypoint_weight in self._each_entry_point_combination_w_early_cutoff(
-                        reranked_entrypoints, reranked_entrypoint_weights, facet, earlycutoff=self.earlycutoff):
-                    # start a new hypothesis
-                    core_hyp = OneClusterSeed(self.graph_obj, facet["queryConstraints"], self._pythonize_datetime(facet.get("temporal", {})), \
-                                                  AidaHypothesis(self.graph_obj), qvar_filler, entrypointweight = entrypoint_weight,
-                                                  entrypoints = list(qvar_filler.keys()))
-                    hypotheses_todo.append(core_hyp)
-
-        ################
-        print("Extending cluster seeds (if too many, reduce rank_cutoff)")
-        printindex = 0
-        # signatures of query variables, for qs cutoff
-        qvar_signatures = { }
-        
+                # initial seeds of all facets, one core hypothesis per entry point combination
+                initial_seeds = itertools.chain.from_iterable(self._each_initial_seed(facet) for facet in self.soin_obj["facets"])
+                hypotheses_done, previously_found_hypothesis_without_failed_queries = self._expand_seeds(initial_seeds, qvar_signatures)
+
+        if self.truncated is not None:
+            print("Warning: seed creation stopped early because the", self.truncated, "budget was exceeded,",
+                      "keeping", len(hypotheses_done), "finished hypotheses")
+
+        if not previously_found_hypothesis_without_failed_queries:
+            print("Warning: All hypotheses had at least one failed query.")
         
+        # at this point, all hypotheses are as big as they can be.
+        return hypotheses_done
+
+    # depth-first expansion of initial seeds until they are done.
+    # initial seeds are taken one at a time from the iterable initial_seeds,
+    # and each is expanded completely before the next one is taken.
+    # the time and memory budget only apply once there is a finished hypothesis,
+    # so that we always have some.
+    # returns the list of finished hypotheses, and whether any of them had no failed queries.
+    # in a worker process, pruning_statistics is shared with the other workers
+    # and synced every SYNC_INTERVAL hypotheses.
+    def _expand_seeds(self, initial_seeds, qvar_signatures, pruning_statistics = None):
+        initial_seeds = iter(initial_seeds)
+        # queue of hypotheses-in-making, list of finished hypotheses
+        hypotheses_todo = deque()
+        hypotheses_done = [ ]
+
+        # have we found any hypothesis without failed queries yet?
+        # if so, we can eliminate all hypotheses with failed queries
+        previously_found_hypothesis_without_failed_queries = False
+
+        # increments of qvar signature counts since the last sync
+        qvar_signature_deltas = None
+        if pruning_statistics is not None:
+            qvar_signature_deltas = { }
+            previously_found_hypothesis_without_failed_queries = self._sync_pruning_statistics(pruning_statistics, qvar_signatures, qvar_signature_deltas, False)
+
+        printindex = 0
+
         # extend all hypotheses in the deque until they are done
-        while len(hypotheses_todo) > 0:
+        while True:
+            if len(hypotheses_todo) == 0:
+                # the previous seed is done, take the next one
+                core_hyp = next(initial_seeds, None)
+                if core_hyp is None:
+                    break
+                hypotheses_todo.append(core_hyp)
+
             printindex += 1
             if printindex % 1000 == 0:
                 print("hypotheses done", len(hypotheses_done))
-                
+
+            if pruning_statistics is not None and printindex % self.SYNC_INTERVAL == 0:
+                found_by_any_worker = self._sync_pruning_statistics(pruning_statistics, qvar_signatures, qvar_signature_deltas,
+                                                                        previously_found_hypothesis_without_failed_queries)
+                if found_by_any_worker and not previously_found_hypothesis_without_failed_queries:
+                    # some other worker found a hypothesis without failed queries,
+                    # so all our previous "done" hypotheses can be removed, as they had failed queries
+                    if self.discard_failedqueries:
+                        hypotheses_done = [ ]
+                    previously_found_hypothesis_without_failed_queries = True
+
+            # the budget only applies once we have some finished hypotheses
+            if len(hypotheses_done) > 0 and self._out_of_budget():
+                break
+
             core_hyp = hypotheses_todo.popleft()
 
-            if self.QS_CUTOFF is not None:
-                qs = self._make_qvar_signature(core_hyp)
-                if qs is not None:
-                    if any(qvar_signatures.get(q1, 0) >= self.QS_CUTOFF for q1 in qs):
-                        # do not process this hypothesis further
-                        # print("skipping hypothesis", qs)
-                        continue
-                    else:
-                        for q1 in qs:
-                            qvar_signatures[ q1] = qvar_signatures.get(q1, 0) + 1
+            if self._qs_cutoff_reached(core_hyp, qvar_signatures, qvar_signature_deltas):
+                # do not process this hypothesis further
+                continue
 
             if self.discard_failedqueries:
                 # we are discarding hypotheses with failed queries
@@ -686,37 +819,11 @@ class ClusterSeeds:
                     # It has failed queries, and we have found at least one hypothesis without failed queries
                     # print("discarding hypothesis with failed queries")
                     continue
-                
+
             if core_hyp.done:
                 # hypothesis finished.
-                # any statements in this one?
-                if not core_hyp.has_statements():
-                    # if not, don't record it
-                    # print("empty hypothesis")
-                    continue
-
-                if self.discard_failedqueries and core_hyp.no_failed_core_constraints():
-                    # yes, no failed queries!
-                    # is this the first one we find? then remove all previous "done" hypotheses,
-                    # as they had failed queries
-                    if not previously_found_hypothesis_without_failed_queries:
-                        # print("found a hypothesis without failed queries, discarding", len(hypotheses_done))
-                        hypotheses_done = [ ]
-
-                if core_hyp.no_failed_core_constraints():
-                    previously_found_hypothesis_without_failed_queries = True
-
-
-                # mark this hypothesis as done
-                hypotheses_done.append(core_hyp)
-                # print("HIER", len(core_hyp.unfillable), core_hyp.lweight)# , [(q, v[-5:]) for q, v in core_hyp.qvar_filler.items()])
-                # input()
-
-                ## for q, v in core_hyp.qvar_filler.items():
-                ##     print("qvar", q, v[-5:])
-                ## print([s[-5:] for s in core_hyp.hypothesis.stmts])
-                ## print("----")
-                        
+                hypotheses_done, previously_found_hypothesis_without_failed_queries = \
+                    self._add_done_hypothesis(core_hyp, hypotheses_done, previously_found_hypothesis_without_failed_queries)
                 continue
 
             new_hypotheses = core_hyp.extend()
@@ -726,11 +833,282 @@ class ClusterSeeds:
             hypotheses_todo.extendleft(new_hypotheses)
             # hypotheses_todo.extend(new_hypotheses)
 
-        if not previously_found_hypothesis_without_failed_queries:
-            print("Warning: All hypotheses had at least one failed query.")
+        if pruning_statistics is not None:
+            self._sync_pruning_statistics(pruning_statistics, qvar_signatures, qvar_signature_deltas,
+                                              previously_found_hypothesis_without_failed_queries)
+
+        return hypotheses_done, previously_found_hypothesis_without_failed_queries
+
+    # parallel depth-first expansion:
+    # the entry point combinations are taken from the lazy generator combinations
+    # in shards of SHARD_SIZE, which are expanded in num_workers worker processes.
+    # the workers make the initial seeds themselves, and at most SHARDS_PER_WORKER shards
+    # per worker are waiting at a time, so the initial seeds are never all in memory at once.
+    # the workers are forked, so they share the graph without pickling.
+    # qvar signature counts and whether a hypothesis without failed queries has been found
+    # are kept in a manager process, and each worker syncs with it every SYNC_INTERVAL hypotheses,
+    # so pruning is not quite as tight as in the sequential expansion.
+    # finished hypotheses are merged in the order of their shards.
+    def _expand_seeds_parallel(self, combinations):
+        global _shared_seed_data
+
+        context = multiprocessing.get_context("fork")
+
+        pruning_manager = None
+        pruning_statistics = None
+        if self.QS_CUTOFF is not None or self.discard_failedqueries:
+            pruning_manager = PruningStatisticsManager(ctx = context)
+            pruning_manager.start()
+            pruning_statistics = pruning_manager.PruningStatistics(self.QS_CUTOFF)
+
+        # results of the shards, by shard index
+        shard_results = { }
+        previously_found_hypothesis_without_failed_queries = False
+
+        memory_exceeded = context.Event()
+        _shared_seed_data = (self, { }, pruning_statistics, memory_exceeded)
+        try:
+            with ProcessPoolExecutor(max_workers = self.num_workers, mp_context = context) as executor:
+                # mapping from pending futures to their shard index
+                shard_of_future = { }
+                more_combinations = True
+                while True:
+                    # several shards per worker, so that workers that finish early can take on more.
+                    # no new shards once the budget is used up
+                    while more_combinations and self.truncated is None and len(shard_of_future) < self.num_workers * self.SHARDS_PER_WORKER:
+                        shard = list(itertools.islice(combinations, self.SHARD_SIZE))
+                        if len(shard) == 0:
+                            more_combinations = False
+                            break
+                        shard_of_future[ executor.submit(_expand_seeds_in_worker, shard) ] = len(shard_results) + len(shard_of_future)
+
+                    if len(shard_of_future) == 0:
+                        break
+
+                    # wait for the workers, checking the time and the memory that all processes use together
+                    done, _ = wait(shard_of_future.keys(), timeout = self.BUDGET_CHECK_SECONDS, return_when = FIRST_COMPLETED)
+                    for future in done:
+                        shard_idx = shard_of_future.pop(future)
+                        # shards that were cancelled before they started are not expanded at all
+                        shard_results[ shard_idx ] = None if future.cancelled() else future.result()
+                    if self.truncated is not None or (len(shard_of_future) == 0 and not more_combinations):
+                        continue
+
+                    if self.time_budget is not None and time.time() - self.starttime > self.time_budget:
+                        # the workers check the time themselves
+                        self.truncated = "time"
+                    elif self._parallel_memory_exceeded():
+                        self.truncated = "memory"
+                        memory_exceeded.set()
+
+                    if self.truncated is not None:
+                        for future in shard_of_future:
+                            future.cancel()
+
+            hypotheses_done = [ ]
+            for shard_idx in sorted(shard_results.keys()):
+                if shard_results[ shard_idx ] is None:
+                    continue
+                shard_done, shard_found, shard_truncated = shard_results[ shard_idx ]
+                hypotheses_done += [ self._finished_seed_from_state(state) for state in shard_done ]
+                if shard_found:
+                    previously_found_hypothesis_without_failed_queries = True
+                if shard_truncated is not None and self.truncated is None:
+                    self.truncated = shard_truncated
+        finally:
+            _shared_seed_data = None
+            if pruning_manager is not None:
+                pruning_manager.shutdown()
+
+        if self.discard_failedqueries and previously_found_hypothesis_without_failed_queries:
+            # some shards may have finished hypotheses with failed queries
+            # before any worker found one without
+            hypotheses_done = [ h for h in hypotheses_done if h.no_failed_core_constraints() ]
+
+        return hypotheses_done, previously_found_hypothesis_without_failed_queries
+
+    # send our qvar signature counts since the last sync, and whether we found a hypothesis
+    # without failed queries, to the shared pruning statistics.
+    # updates qvar_signatures with the counts of all workers for our signatures,
+    # and with all signatures that any worker has seen QS_CUTOFF times.
+    # returns whether any worker has found a hypothesis without failed queries
+    def _sync_pruning_statistics(self, pruning_statistics, qvar_signatures, qvar_signature_deltas, found_hypothesis_without_failed_queries):
+        counts, saturated, self.num_saturated_seen, found_by_any_worker = \
+            pruning_statistics.sync(qvar_signature_deltas, found_hypothesis_without_failed_queries, self.num_saturated_seen)
+
+        qvar_signatures.update(counts)
+        for q1 in saturated:
+            qvar_signatures[ q1 ] = max(qvar_signatures.get(q1, 0), self.QS_CUTOFF)
+        qvar_signature_deltas.clear()
+
+        return found_by_any_worker
+
+    # in parallel expansion: has the main process together with all its children,
+    # that is, worker processes and the manager process, used more than memory_budget MB?
+    def _parallel_memory_exceeded(self):
+        if self.memory_budget is None:
+            return False
+
+        pids = [ multiprocessing.current_process().pid ] + [ p.pid for p in multiprocessing.active_children() ]
+        return sum(_process_memory_mb(pid) for pid in pids) > self.memory_budget
+
+    # finished hypotheses are passed back from worker processes without the graph
+    def _finished_seed_state(self, h):
+        return (h.core_constraints, h.temporal_constraints, h.qvar_filler, h.lweight, h.unfillable, h.entrypoints, h.entrypointweight,
+                    h.hypothesis.stmts, h.hypothesis.stmt_weights, h.hypothesis.core_stmts, h.hypothesis.lweight)
+
+    def _finished_seed_from_state(self, state):
+        core_constraints, temporal_constraints, qvar_filler, lweight, unfillable, entrypoints, entrypointweight, \
+            stmts, stmt_weights, core_stmts, hypothesis_lweight = state
+
+        hypothesis = AidaHypothesis(self.graph_obj, stmts = stmts, stmt_weights = stmt_weights, core_stmts = core_stmts, lweight = hypothesis_lweight)
+        h = OneClusterSeed(self.graph_obj, core_constraints, temporal_constraints, hypothesis, qvar_filler, lweight = lweight,
+                               unfilled = set(), unfillable = unfillable, entrypoints = entrypoints, entrypointweight = entrypointweight)
+        h.done = True
+        return h
+
+    # returns true if seed creation has exceeded its time or memory budget,
+    # and records which budget it was in self.truncated.
+    # the budget is only checked every BUDGET_CHECK_INTERVAL calls.
+    def _out_of_budget(self):
+        if self.truncated is not None:
+            return True
+        if self.time_budget is None and self.memory_budget is None:
+            return False
+
+        self.budget_counter += 1
+        if self.budget_counter % self.BUDGET_CHECK_INTERVAL != 0:
+            return False
+
+        if self.time_budget is not None and time.time() - self.starttime > self.time_budget:
+            self.truncated = "time"
+        elif self.memory_exceeded is not None:
+            # in a worker process: the main process checks the memory budget
+            if self.memory_exceeded.is_set():
+                self.truncated = "memory"
+        # ru_maxrss is in kilobytes on Linux
+        elif self.memory_budget is not None and resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 > self.memory_budget:
+            self.truncated = "memory"
+
+        return self.truncated is not None
+
+    # initial cluster seeds for a facet:
+    # one core hypothesis per combination of entry point fillers, best entry point weight first
+    def _each_initial_seed(self, facet):
+        for qvar_filler, entrypoint_weight in self._each_facet_entry_point_combination(facet):
+            yield self._initial_seed(facet, qvar_filler, entrypoint_weight)
+
+    # a new core hypothesis for a facet, with the given entry point fillers
+    def _initial_seed(self, facet, qvar_filler, entrypoint_weight):
+        return OneClusterSeed(self.graph_obj, facet["queryConstraints"], self._pythonize_datetime(facet.get("temporal", {})), \
+                                  AidaHypothesis(self.graph_obj), qvar_filler, entrypointweight = entrypoint_weight,
+                                  entrypoints = list(qvar_filler.keys()))
+
+    # combinations of entry point fillers for a facet, as pairs (qvar_filler, entry point weight),
+    # best entry point weight first
+    def _each_facet_entry_point_combination(self, facet):
+        reranked_entrypoints = {}
+        reranked_entrypoint_weights = {}
+
+        for ep_var, ep_fillers in self.soin_obj['entrypoints'].items():
+            ep_weights = self.soin_obj['entrypointWeights'][ep_var]
+
+            print('Entry point: {}'.format(ep_var))
+
+            filler_weight_mapping = {}
+
+            fillers_filtered_both = []
+            fillers_filtered_role_score = []
+
+            for ep_filler, ep_weight in zip(ep_fillers, ep_weights):
+                ep_role_score = self._entrypoint_filler_rolescore(ep_var, ep_filler, facet)
+                filler_weight_mapping[ep_filler] = (ep_weight, ep_role_score)
+                if ep_role_score > 0:
+                    fillers_filtered_role_score.append(ep_filler)
+                    if ep_weight > 50.0:
+                        fillers_filtered_both.append(ep_filler)
+
+            if len(fillers_filtered_both) > 0:
+                print('\tKept {} fillers with both SoIN weight > 50 and role score > 0'.format(len(fillers_filtered_both)))
+                reranked_entrypoints[ep_var] = fillers_filtered_both
+                reranked_entrypoint_weights[ep_var] = [
+                    filler_weight_mapping[filler][0] * filler_weight_mapping[filler][1]
+                    for filler in fillers_filtered_both]
+            elif len(fillers_filtered_role_score) > 0:
+                print('\tKept {} fillers with role score > 0'.format(len(fillers_filtered_role_score)))
+                reranked_entrypoints[ep_var] = fillers_filtered_role_score
+                reranked_entrypoint_weights[ep_var] = [
+                    filler_weight_mapping[filler][0] * filler_weight_mapping[filler][1]
+                    for filler in fillers_filtered_role_score]
+            else:
+                print('\tKept all {} fillers (no filler has role score > 0)'.format(len(ep_fillers)))
+                reranked_entrypoints[ep_var] = ep_fillers
+                reranked_entrypoint_weights[ep_var] = ep_weights
+
+        if self.earlycutoff is None:
+            combinations = self._each_entry_point_combination(reranked_entrypoints, reranked_entrypoint_weights, facet)
+        else:
+            combinations = self._each_entry_point_combination_w_early_cutoff(
+                reranked_entrypoints, reranked_entrypoint_weights, facet, earlycutoff=self.earlycutoff)
+
+        yield from combinations
+
+    # qs cutoff: returns true if there are already QS_CUTOFF other hypotheses
+    # that have the same fillers as this one for QS_COUNT_CUTOFF query variables.
+    # otherwise, count this hypothesis in qvar_signatures, and in qvar_signature_deltas if given
+    def _qs_cutoff_reached(self, core_hyp, qvar_signatures, qvar_signature_deltas = None):
+        if self.QS_CUTOFF is None:
+            return False
         
-        # at this point, all hypotheses are as big as they can be.
-        return hypotheses_done
+        qs = self._make_qvar_signature(core_hyp)
+        if qs is None:
+            return False
+        
+        if any(qvar_signatures.get(q1, 0) >= self.QS_CUTOFF for q1 in qs):
+            # print("skipping hypothesis", qs)
+            return True
+
+        for q1 in qs:
+            qvar_signatures[ q1] = qvar_signatures.get(q1, 0) + 1
+            if qvar_signature_deltas is not None:
+                qvar_signature_deltas[ q1] = qvar_signature_deltas.get(q1, 0) + 1
+        return False
+
+    # record a finished hypothesis.
+    # returns the new list of finished hypotheses, and whether we have found
+    # a hypothesis without failed queries yet
+    def _add_done_hypothesis(self, core_hyp, hypotheses_done, previously_found_hypothesis_without_failed_queries):
+        # any statements in this one?
+        if not core_hyp.has_statements():
+            # if not, don't record it
+            # print("empty hypothesis")
+            return hypotheses_done, previously_found_hypothesis_without_failed_queries
+
+        if self.discard_failedqueries and core_hyp.no_failed_core_constraints():
+            # yes, no failed queries!
+            # is this the first one we find? then remove all previous "done" hypotheses,
+            # as they had failed queries
+            if not previously_found_hypothesis_without_failed_queries:
+                # print("found a hypothesis without failed queries, discarding", len(hypotheses_done))
+                hypotheses_done = [ ]
+
+        if core_hyp.no_failed_core_constraints():
+            previously_found_hypothesis_without_failed_queries = True
+
+        # mark this hypothesis as done
+        hypotheses_done.append(core_hyp)
+
+        return hypotheses_done, previously_found_hypothesis_without_failed_queries
+
+    # beam search: keep all finished hypotheses, and the best beam_width unfinished ones
+    # by entry point weight, then log weight, then connectedness
+    def _prune_beam(self, hypotheses):
+        done = [h for h in hypotheses if h.done]
+        todo = [h for h in hypotheses if not h.done]
+        if len(todo) > self.beam_width:
+            todo = heapq.nlargest(self.beam_width, todo, key = lambda h: (h.entrypointweight, h.lweight, self._connectedness(h)))
+
+        return done + todo
 
     def _make_qvar_signature(self, h):
         ##
@@ -763,6 +1141,16 @@ class ClusterSeeds:
         # variables we are filling: all entry points that appear in the query constraints of this facet
         entrypoint_variables = sorted(e for e in entrypoints.keys() if e in facet_variables)
 
+        if any(w < 0 for v in entrypoint_variables for w in entrypoint_weights[v]):
+            # with negative filler weights, the product is not monotonic in the filler weights,
+            # so we cannot enumerate best-first. materialize all combinations and sort them.
+            yield from self._each_entry_point_combination_sorted(entrypoint_variables, entrypoints, entrypoint_weights)
+        else:
+            yield from self._each_best_entry_point_combination(entrypoint_variables, entrypoints, entrypoint_weights)
+
+    # exhaustive version: materialize the Cartesian product of all entry point fillers,
+    # then sort by weight
+    def _each_entry_point_combination_sorted(self, entrypoint_variables, entrypoints, entrypoint_weights):
         # itertools.product does Cartesian product of n sets
         # here we do a product of entry point filler indices, so we can access each filler as well as its weight
         filler_index_tuples = [ ]
@@ -775,26 +1163,76 @@ class ClusterSeeds:
             qvar_fillers = dict((v, entrypoints[v][i]) for v, i in zip(entrypoint_variables, filler_indices))
 
             # reject if any two variables are mapped to the same ERE
-            if any (qvar_fillers[v1] == qvar_fillers[v2] for v1 in entrypoint_variables for v2 in entrypoint_variables if v1 != v2):
+            if len(set(qvar_fillers.values())) < len(qvar_fillers):
                 continue
             
             filler_index_tuples.append( qvar_fillers)
             # weight:
-            # filler weights are in the range of [0, 100]
-            # multiply weights/100 of the fillers,
-            # then take the log to be in log-probability space
+            # multiply weights of the fillers
             weight = 1
             for v, i in zip(entrypoint_variables, filler_indices):
                 weight *= entrypoint_weights[v][i]
             weights.append(weight)
-            # print("HIER", qvar_fillers, weight)
-            #input()
-            # weights.append( math.log(functools.reduce(operator.mul, (entrypoint_weights[v][i]/100.0 for v, i in zip(entrypoint_variables, filler_indices)))))
 
         for qvar_filler, weight in sorted(zip(filler_index_tuples, weights), key = lambda pair:pair[1], reverse = True):
-            # print("HIER2wt", weight)
             yield (qvar_filler, weight)
 
+    # best-first version: lazily enumerate the Cartesian product of entry point fillers
+    # in order of descending weight, without materializing it.
+    # filler weights need to be non-negative.
+    #
+    # The fillers of each variable are sorted by weight, and a combination is a tuple of
+    # positions in these sorted lists. Starting from the combination of all best fillers,
+    # we keep a heap of candidate combinations. The successors of a combination each move
+    # one variable to its next-best filler, which can only lower the weight.
+    # To generate each combination only once, a successor may only move variables
+    # at or after the one that was moved last.
+    #
+    # All combinations with the same weight are collected before they are yielded,
+    # in the same order as in itertools.product.
+    def _each_best_entry_point_combination(self, entrypoint_variables, entrypoints, entrypoint_weights):
+        if any(len(entrypoints[v]) == 0 for v in entrypoint_variables):
+            return
+
+        # for each variable, filler indices sorted by weight, highest first
+        sorted_indices = [sorted(range(len(entrypoints[v])), key = lambda i, v=v: entrypoint_weights[v][i], reverse = True) for v in entrypoint_variables]
+
+        def heap_entry(positions, last_moved):
+            weight = 1
+            for vix, p in enumerate(positions):
+                weight *= entrypoint_weights[entrypoint_variables[vix]][sorted_indices[vix][p]]
+            return (-weight, positions, last_moved)
+
+        def push_successors(positions, last_moved):
+            for vix in range(last_moved, len(positions)):
+                if positions[vix] + 1 < len(sorted_indices[vix]):
+                    successor = positions[:vix] + (positions[vix] + 1,) + positions[vix+1:]
+                    heapq.heappush(heap, heap_entry(successor, vix))
+
+        heap = [ heap_entry((0,) * len(entrypoint_variables), 0) ]
+
+        while len(heap) > 0:
+            # pop all combinations with the next highest weight
+            negweight, positions, last_moved = heapq.heappop(heap)
+            push_successors(positions, last_moved)
+            same_weight = [ positions ]
+            while len(heap) > 0 and heap[0][0] == negweight:
+                _, positions, last_moved = heapq.heappop(heap)
+                push_successors(positions, last_moved)
+                same_weight.append(positions)
+
+            filler_index_tuples = sorted(tuple(sorted_indices[vix][p] for vix, p in enumerate(positions)) for positions in same_weight)
+            for filler_indices in filler_index_tuples:
+                qvar_fillers = dict((v, entrypoints[v][i]) for v, i in zip(entrypoint_variables, filler_indices))
+                # reject if any two variables are mapped to the same ERE
+                if len(set(qvar_fillers.values())) < len(qvar_fillers):
+                    continue
+
+                yield (qvar_fillers, -negweight)
+
+    # entry point combinations with early cutoff:
+    # enumerate combinations best-first, and stop after the best earlycutoff ones.
+    # combinations that tie with the last one kept are kept, too.
     def _each_entry_point_combination_w_early_cutoff(self, entrypoints, entrypoint_weights, facet, earlycutoff):
         # variables occurring in this facet: query constraints have the form [subj, pred, obj] where subj, obj are variables.
         # collect those
@@ -802,238 +1240,25 @@ class ClusterSeeds:
         # variables we are filling: all entry points that appear in the query constraints of this facet
         entrypoint_variables = sorted(e for e in entrypoints.keys() if e in facet_variables)
 
-        ep_weight_filler_mapping = {}
+        positive_weights = { }
         for ep_var in entrypoint_variables:
-            ep_weight_filler_mapping[ep_var] = defaultdict(list)
-            ep_fillers = entrypoints[ep_var]
             ep_weights = entrypoint_weights[ep_var]
             # Make sure all weights are positive (in case of using role weighting in SoIN matching,
             # there might be negative weights for entry points, which might mess up rankings)
-            if min(ep_weights) < 0.1:
+            if len(ep_weights) > 0 and min(ep_weights) < 0.1:
                 ep_weights = [w - min(ep_weights) + 0.1 for w in ep_weights]
-            for ep_filler, ep_weight in zip(ep_fillers, ep_weights):
-                ep_weight_filler_mapping[ep_var][ep_weight].append(ep_filler)
-
-        def ep_weights_to_ep_fillers(ep_weights):
-            ep_vars = []
-            fillers_list = []
-            for ep_var, weight in ep_weights.items():
-                ep_vars.append(ep_var)
-                fillers_list.append(ep_weight_filler_mapping[ep_var][weight])
-            ep_fillers_list = []
-            for fillers in itertools.product(*fillers_list):
-                # Filter cases where there are duplicate node ids for different entry points
-                if len(set(fillers)) == len(fillers):
-                    ep_fillers_list.append(
-                        {ep_var: filler for ep_var, filler in zip(ep_vars, fillers)})
-            return ep_fillers_list
-
-        fillers_list = []
-        weight_list = []
-
-        # Group 1 (all highest)
-        group_1_ep_weights = {}
-        group_1_weight_prod = 1.0
-        for ep_var, weight_filler_mapping in ep_weight_filler_mapping.items():
-            var_weight = sorted(weight_filler_mapping.keys(), reverse=True)[0]
-            group_1_ep_weights[ep_var] = var_weight
-            group_1_weight_prod *= var_weight
-
-        group_1_ep_fillers = ep_weights_to_ep_fillers(group_1_ep_weights)
-
-        print('Found {} filler combinations with weight {} (group #1)'.format(
-            len(group_1_ep_fillers), group_1_weight_prod))
-
-        fillers_list.extend(group_1_ep_fillers)
-        weight_list.extend([group_1_weight_prod] * len(group_1_ep_fillers))
-
-        # Group 2 (all-but-one highest & one second-highest)
-        if len(fillers_list) < earlycutoff:
-            group_2_ep_weights_list = []
-            group_2_weight_prod_list = []
-
-            # For each entry point, select its second-highest weighted fillers
-            for idx in range(len(ep_weight_filler_mapping)):
-                ep_weights = {}
-                weight_prod = 1.0
-                for ep_var_idx, (ep_var, weight_filler_mapping) in enumerate(
-                        ep_weight_filler_mapping.items()):
-                    if ep_var_idx == idx:
-                        if len(weight_filler_mapping) < 2:
-                            continue
-                        var_weight = sorted(weight_filler_mapping.keys(), reverse=True)[1]
-                    else:
-                        var_weight = sorted(weight_filler_mapping.keys(), reverse=True)[0]
-
-                    ep_weights[ep_var] = var_weight
-                    weight_prod *= var_weight
-
-                if len(ep_weights) == len(ep_weight_filler_mapping):
-                    group_2_ep_weights_list.append(ep_weights)
-                    group_2_weight_prod_list.append(weight_prod)
-
-            for ep_weights, weight_prod in sorted(
-                    zip(group_2_ep_weights_list, group_2_weight_prod_list),
-                    key=itemgetter(1), reverse=True):
-                ep_fillers = ep_weights_to_ep_fillers(ep_weights)
-
-                print('Found {} filler combinations with weight {} (group #2)'.format(
-                    len(ep_fillers), weight_prod))
+            positive_weights[ep_var] = ep_weights
 
-                fillers_list.extend(ep_fillers)
-                weight_list.extend([weight_prod] * len(ep_fillers))
-
-                if len(fillers_list) >= earlycutoff:
-                    break
-
-        # Group 3 (all-but-one highest & one third-highest,
-        # or all-but-two highest & two second-highest)
-        if len(fillers_list) < earlycutoff:
-            group_3_ep_weights_list = []
-            group_3_weight_prod_list = []
-
-            # For each entry point, select its third-highest weighted fillers
-            for idx in range(len(ep_weight_filler_mapping)):
-                ep_weights = {}
-                weight_prod = 1.0
-                for ep_var_idx, (ep_var, weight_filler_mapping) in enumerate(
-                        ep_weight_filler_mapping.items()):
-                    if ep_var_idx == idx:
-                        if len(weight_filler_mapping) < 3:
-                            continue
-                        var_weight = sorted(weight_filler_mapping.keys(), reverse=True)[2]
-                    else:
-                        var_weight = sorted(weight_filler_mapping.keys(), reverse=True)[0]
-
-                    ep_weights[ep_var] = var_weight
-                    weight_prod *= var_weight
-
-                if len(ep_weights) == len(ep_weight_filler_mapping):
-                    group_3_ep_weights_list.append(ep_weights)
-                    group_3_weight_prod_list.append(weight_prod)
-
-            # For each combination of 2 entry points, select their second-highest weighted fillers
-            for idx_1, idx_2 in itertools.combinations(range(len(ep_weight_filler_mapping)), 2):
-                ep_weights = {}
-                weight_prod = 1.0
-                for ep_var_idx, (ep_var, weight_filler_mapping) in enumerate(
-                        ep_weight_filler_mapping.items()):
-                    if ep_var_idx == idx_1 or ep_var_idx == idx_2:
-                        if len(weight_filler_mapping) < 2:
-                            continue
-                        var_weight = sorted(weight_filler_mapping.keys(), reverse=True)[1]
-                    else:
-                        var_weight = sorted(weight_filler_mapping.keys(), reverse=True)[0]
-
-                    ep_weights[ep_var] = var_weight
-                    weight_prod *= var_weight
-
-                if len(ep_weights) == len(ep_weight_filler_mapping):
-                    group_3_ep_weights_list.append(ep_weights)
-                    group_3_weight_prod_list.append(weight_prod)
-
-            for ep_weights, weight_prod in sorted(
-                    zip(group_3_ep_weights_list, group_3_weight_prod_list),
-                    key=itemgetter(1), reverse=True):
-                ep_fillers = ep_weights_to_ep_fillers(ep_weights)
-
-                print('Found {} filler combinations with weight {} (group #3)'.format(
-                    len(ep_fillers), weight_prod))
-
-                fillers_list.extend(ep_fillers)
-                weight_list.extend([weight_prod] * len(ep_fillers))
-
-                if len(fillers_list) >= earlycutoff:
-                    break
-
-        # Group 4 (all-but-one highest & one forth-highest,
-        # or all-but-two highest & one second-highest & one third-highest,
-        # or all-but-three highest & three second-highest)
-        if len(fillers_list) < earlycutoff:
-            group_4_ep_weights_list = []
-            group_4_weight_prod_list = []
-
-            # For each entry point, select its forth-highest weighted fillers
-            for idx in range(len(ep_weight_filler_mapping)):
-                ep_weights = {}
-                weight_prod = 1.0
-                for ep_var_idx, (ep_var, weight_filler_mapping) in enumerate(
-                        ep_weight_filler_mapping.items()):
-                    if ep_var_idx == idx:
-                        if len(weight_filler_mapping) < 4:
-                            continue
-                        var_weight = sorted(weight_filler_mapping.keys(), reverse=True)[3]
-                    else:
-                        var_weight = sorted(weight_filler_mapping.keys(), reverse=True)[0]
-
-                    ep_weights[ep_var] = var_weight
-                    weight_prod *= var_weight
-
-                if len(ep_weights) == len(ep_weight_filler_mapping):
-                    group_4_ep_weights_list.append(ep_weights)
-                    group_4_weight_prod_list.append(weight_prod)
-
-            # For each permutation of 2 entry points, select the third-highest weighted fillers for one of them
-            # and the second-highest weighted fillers for the other
-            for idx_1, idx_2 in itertools.permutations(range(len(ep_weight_filler_mapping)), 2):
-                ep_weights = {}
-                weight_prod = 1.0
-                for ep_var_idx, (ep_var, weight_filler_mapping) in enumerate(
-                        ep_weight_filler_mapping.items()):
-                    if ep_var_idx == idx_1:
-                        if len(weight_filler_mapping) < 3:
-                            continue
-                        var_weight = sorted(weight_filler_mapping.keys(), reverse=True)[2]
-                    elif ep_var_idx == idx_2:
-                        if len(weight_filler_mapping) < 2:
-                            continue
-                        var_weight = sorted(weight_filler_mapping.keys(), reverse=True)[1]
-                    else:
-                        var_weight = sorted(weight_filler_mapping.keys(), reverse=True)[0]
-
-                    ep_weights[ep_var] = var_weight
-                    weight_prod *= var_weight
-
-                if len(ep_weights) == len(ep_weight_filler_mapping):
-                    group_4_ep_weights_list.append(ep_weights)
-                    group_4_weight_prod_list.append(weight_prod)
-
-            # For each combination of 3 entry points, select their second-highest weighted fillers
-            for idx_1, idx_2, idx_3 in itertools.combinations(range(len(ep_weight_filler_mapping)), 3):
-                ep_weights = {}
-                weight_prod = 1.0
-                for ep_var_idx, (ep_var, weight_filler_mapping) in enumerate(
-                        ep_weight_filler_mapping.items()):
-                    if ep_var_idx == idx_1 or ep_var_idx == idx_2 or ep_var_idx == idx_3:
-                        if len(weight_filler_mapping) < 2:
-                            continue
-                        var_weight = sorted(weight_filler_mapping.keys(), reverse=True)[1]
-                    else:
-                        var_weight = sorted(weight_filler_mapping.keys(), reverse=True)[0]
-
-                    ep_weights[ep_var] = var_weight
-                    weight_prod *= var_weight
-
-                if len(ep_weights) == len(ep_weight_filler_mapping):
-                    group_4_ep_weights_list.append(ep_weights)
-                    group_4_weight_prod_list.append(weight_prod)
-
-            for ep_weights, weight_prod in sorted(
-                    zip(group_4_ep_weights_list, group_4_weight_prod_list),
-                    key=itemgetter(1), reverse=True):
-                ep_fillers = ep_weights_to_ep_fillers(ep_weights)
-
-                print('Found {} filler combinations with weight {} (group #3)'.format(
-                    len(ep_fillers), weight_prod))
-
-                fillers_list.extend(ep_fillers)
-                weight_list.extend([weight_prod] * len(ep_fillers))
-
-                if len(fillers_list) >= earlycutoff:
-                    break
+        count = 0
+        last_weight = None
+        for fillers, weight in self._each_best_entry_point_combination(entrypoint_variables, entrypoints, positive_weights):
+            if count >= earlycutoff and weight < last_weight:
+                print('Early cutoff after {} filler combinations with weight >= {}'.format(count, last_weight))
+                break
 
-        for fillers, weight in zip(fillers_list, weight_list):
-            yield(fillers, weight)
+            count += 1
+            last_weight = weight
+            yield (fillers, weight)
 
     def _entrypoint_filler_rolescore(self, ep_var, ep_filler, facet):
         score = 0
@@ -1109,21 +1334,25 @@ class ClusterSeeds:
         return self._rerank_hypotheses_novelty(sorted_hypotheses)
     
     def _sort_hypotheses_connectedness(self, hypotheses):
-        weights = [ ]
-
-        for hypothesis in hypotheses:
-            outdeg = 0
-            # for each ERE of this hypothesis
-            for erelabel in hypothesis.hypothesis.eres():
-                # find statements IDs of statements adjacent to the EREs of this hypothesis
-                for stmtlabel in self.graph_obj.each_ere_adjacent_stmt_anyrel(erelabel):
-                    outdeg += 1
-            weights.append( outdeg)
+        weights = [ self._connectedness(hypothesis) for hypothesis in hypotheses ]
 
         # print("connectedness weights", weights)
         return [pair[1] for pair in sorted(enumerate(hypotheses), key = lambda pair:weights[pair[0]], reverse = True)]
 
 
+    # connectedness of a hypothesis: sum of degrees of its EREs.
+    # this rewards both within-cluster and around-cluster connectedness
+    def _connectedness(self, hypothesis):
+        outdeg = 0
+        # for each ERE of this hypothesis
+        for erelabel in hypothesis.hypothesis.eres():
+            if erelabel not in self.ere_degree:
+                # count statements adjacent to this ERE
+                self.ere_degree[erelabel] = sum(1 for stmtlabel in self.graph_obj.each_ere_adjacent_stmt_anyrel(erelabel))
+            outdeg += self.ere_degree[erelabel]
+
+        return outdeg
+
     def _rerank_hypotheses_novelty(self, hypotheses):
         if len(hypotheses) == 0:
             return hypotheses
@@ -29,6 +29,21 @@
 #   that coincide with this one in 3 query variable fillers
 #   We do need this in the evaluation! Otherwise combinatory explosion happens.
 #   I've standard-set this to 100.
+#
+# -b, --beam_width <arg>: instead of exhaustively expanding all cluster seeds, expand the seeds of each facet
+#   level by level, keeping only the best <arg> partial hypotheses at each level (by entry point weight,
+#   then log weight, then connectedness). Use this if seed creation takes too long or uses too much memory.
+#
+# -t, --time_budget <arg>: stop creating seeds after <arg> seconds, and go on with the seeds that are finished by then.
+# -m, --memory_budget <arg>: stop creating seeds when the script has used more than <arg> MB of memory,
+#   and go on with the seeds that are finished by then.
+#   With --workers, the memory budget is for the main process and all worker processes together (Linux only).
+#   Use these during evaluation so that we get results in time. If seed creation was stopped early,
+#   the output has "truncated": true, and "truncatedBy" says which budget was exceeded.
+#
+# -w, --workers <arg>: expand cluster seeds in <arg> parallel worker processes. The worker processes
+#   share counts for --rank_cutoff and --discard_failed_queries only periodically, so they may keep a few more
+#   hypotheses than a single process would. Cannot be combined with --beam_width.
 
 import sys
 import json
@@ -58,7 +73,8 @@ def shortestname(label, graph_obj):
 ##
 # function that actually does the work
 def work(soin_filename, graph_filename = None, graph_dir = None, out_filename = None, maxnumseeds = None, log = False,
-             discard_failedqueries = False, earlycutoff = False, qs_cutoff = None):
+             discard_failedqueries = False, earlycutoff = False, qs_cutoff = None, beam_width = None,
+             time_budget = None, memory_budget = None, num_workers = 1):
 
     with open(soin_filename, 'r') as fin:
         soin_obj = json.load(fin)
@@ -85,7 +101,9 @@ def work(soin_filename, graph_filename = None, graph_dir = None, out_filename =
     ###########
     # create cluster seeds
 
-    clusterseed_obj = ClusterSeeds(graph_obj, soin_obj, discard_failedqueries = discard_failedqueries, earlycutoff = earlycutoff, qs_cutoff = qs_cutoff)
+    clusterseed_obj = ClusterSeeds(graph_obj, soin_obj, discard_failedqueries = discard_failedqueries, earlycutoff = earlycutoff, qs_cutoff = qs_cutoff,
+                                       beam_width = beam_width, time_budget = time_budget, memory_budget = memory_budget,
+                                       num_workers = num_workers)
 
     # and expand on them
     print("Expansion of seeds")
@@ -108,6 +126,10 @@ def work(soin_filename, graph_filename = None, graph_dir = None, out_filename =
         # add graph filename and queries
         json_seeds["graph"] = os.path.basename(graph_filename)
         json_seeds["queries"] = soin_obj["queries"]
+        # record whether seed creation was stopped early
+        json_seeds["truncated"] = clusterseed_obj.truncated is not None
+        if clusterseed_obj.truncated is not None:
+            json_seeds["truncatedBy"] = clusterseed_obj.truncated
         json.dump(json_seeds, fout, indent = 1)
 
 
@@ -154,6 +176,13 @@ parser.add_option("-c", "--early_cutoff", action = "store", dest = "earlycutoff"
 parser.add_option("-l", "--log", action = "store_true", dest = "log", default = False, help = "write log files to query directory")
 # rank-based cutoff
 parser.add_option("-r", "--rank_cutoff", action = "store", dest = "qs_cutoff", type = "int", default = 100, help = "discard hypotheses early if there are n others that have the same fillers for 3 of their query variables")
+# beam search
+parser.add_option("-b", "--beam_width", action = "store", dest = "beam_width", type = "int", default = None, help = "beam search: keep only the best n partial hypotheses per facet at each level")
+# time and memory budget
+parser.add_option("-t", "--time_budget", action = "store", dest = "time_budget", type = "float", default = None, help = "stop creating seeds after n seconds")
+parser.add_option("-m", "--memory_budget", action = "store", dest = "memory_budget", type = "int", default = None, help = "stop creating seeds when using more than n MB of memory")
+# parallel seed expansion
+parser.add_option("-w", "--workers", action = "store", dest = "num_workers", type = "int", default = 1, help = "expand seeds in n parallel worker processes")
 
 
 (options, args) = parser.parse_args()
@@ -162,6 +191,9 @@ if len(args) != 3:
      parser.print_help()
      sys.exit(1)
 
+if options.num_workers > 1 and options.beam_width is not None:
+     parser.error("--workers cannot be combined with --beam_width")
+
 soin_name = args[0]
 graph_name = args[1]
 out_name = args[2]
@@ -175,9 +207,13 @@ if options.isdir:
             print("SoIN", entry)
             out_filename = os.path.join(out_name, "seeds_" + entry)
             work(soin_filename, graph_dir = graph_name, out_filename= out_filename, maxnumseeds = options.maxnumseeds, log = options.log,
-                     discard_failedqueries = options.discard_failedqueries, earlycutoff = options.earlycutoff, qs_cutoff = options.qs_cutoff)
+                     discard_failedqueries = options.discard_failedqueries, earlycutoff = options.earlycutoff, qs_cutoff = options.qs_cutoff,
+                     beam_width = options.beam_width, time_budget = options.time_budget, memory_budget = options.memory_budget,
+                     num_workers = options.num_workers)
 else:
     # work on a single query
     print("SoIN", soin_name)
     work(soin_name, graph_filename = graph_name, out_filename = out_name, maxnumseeds = options.maxnumseeds, log = options.log,
-             discard_failedqueries = options.discard_failedqueries, earlycutoff = options.earlycutoff, qs_cutoff = options.qs_cutoff)
+             discard_failedqueries = options.discard_failedqueries, earlycutoff = options.earlycutoff, qs_cutoff = options.qs_cutoff,
+             beam_width = options.beam_width, time_budget = options.time_budget, memory_budget = options.memory_budget,
+             num_workers = options.num_workers)
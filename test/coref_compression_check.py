@@ -0,0 +1,88 @@
+##
+# check for coref compression with compress_coref_new.py and recover_coref_new.py:
+# compress a small synthetic graph in which the prototype of a cluster
+# is not a member of any cluster, and check that the compressed ERE keeps the
+# prototype's type, name, time and statements, that the log lists the prototype
+# as a member, and that recovery maps a hypothesis with the prototype's
+# statements back to the original statements.
+#
+# call without arguments.
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from os.path import dirname, realpath, join
+src_path = dirname(dirname(realpath(__file__)))
+
+# cluster C1 with prototype P, which is not a ClusterMembership member of any
+# cluster, and members A and B. cluster C2 with prototype Q, which is its only member.
+def make_graph():
+    the_graph = {
+        "P": {"type": "Entity", "index": 0, "adjacent": ["stmt-P-type", "stmt-X-P"], "name": ["Paula"],
+              "ldcTime": [{"start": [], "end": []}]},
+        "A": {"type": "Entity", "index": 1, "adjacent": ["stmt-A-type"], "name": ["Anna"]},
+        "B": {"type": "Entity", "index": 2, "adjacent": ["stmt-B-type"]},
+        "Q": {"type": "Event", "index": 3, "adjacent": ["stmt-Q-type", "stmt-X-P"]},
+        "C1": {"type": "SameAsCluster", "prototype": "P"},
+        "C2": {"type": "SameAsCluster", "prototype": "Q"},
+        "cm-A": {"type": "ClusterMembership", "cluster": "C1", "clusterMember": "A"},
+        "cm-B": {"type": "ClusterMembership", "cluster": "C1", "clusterMember": "B"},
+        "cm-Q": {"type": "ClusterMembership", "cluster": "C2", "clusterMember": "Q"},
+    }
+    for stmt_idx, (stmt, subj, pred, obj) in enumerate([
+            ("stmt-P-type", "P", "type", "PER"),
+            ("stmt-A-type", "A", "type", "PER"),
+            ("stmt-B-type", "B", "type", "PER"),
+            ("stmt-Q-type", "Q", "type", "Conflict.Attack"),
+            ("stmt-X-P", "Q", "Conflict.Attack_Attacker", "P")]):
+        the_graph[stmt] = {"type": "Statement", "index": stmt_idx, "subject": subj, "predicate": pred, "object": obj}
+
+    return {"theGraph": the_graph, "ere": ["P", "A", "B", "Q"],
+            "statements": [label for label, node in the_graph.items() if node["type"] == "Statement"]}
+
+def run(script, *args):
+    subprocess.run([sys.executable, join(src_path, "pipeline", script)] + list(args),
+                   check = True, stdout = subprocess.DEVNULL)
+
+with tempfile.TemporaryDirectory() as work_dir:
+    graph_path = join(work_dir, "graph.json")
+    compressed_path = join(work_dir, "compressed.json")
+    log_path = join(work_dir, "log.json")
+    with open(graph_path, "w") as fout:
+        json.dump(make_graph(), fout)
+
+    run(join("prepare_input", "compress_coref_new.py"), graph_path, compressed_path, log_path)
+    with open(compressed_path) as fin:
+        compressed_graph = json.load(fin)["theGraph"]
+    with open(log_path) as fin:
+        log = json.load(fin)
+
+    # P has the lowest ERE index among the prototypes of its component
+    new_ere = compressed_graph["P"]
+    assert new_ere["type"] == "Entity", new_ere
+    assert set(new_ere["name"]) == {"Paula", "Anna"}, new_ere
+    assert len(new_ere.get("ldcTime", [])) == 1, new_ere
+    new_adjacent = set(new_ere["adjacent"])
+    for old_stmt in ["stmt-P-type", "stmt-X-P", "stmt-A-type"]:
+        assert log["old_stmt_to_new_stmts"][old_stmt][0] in new_adjacent, old_stmt
+    assert sorted(log["prototype_to_members"]["P"]) == ["A", "B", "P"], log["prototype_to_members"]
+    assert log["member_to_prototypes"]["P"] == ["P"], log["member_to_prototypes"]
+
+    # recover a hypothesis with the statements of P
+    new_stmts = sorted(set(log["old_stmt_to_new_stmts"][old_stmt][0] for old_stmt in ["stmt-P-type", "stmt-X-P"]))
+    hypotheses_path = join(work_dir, "hypotheses.json")
+    recovered_path = join(work_dir, "recovered.json")
+    with open(hypotheses_path, "w") as fout:
+        json.dump({"probs": [1.0], "support": [{"statements": new_stmts, "statementWeights": [0.0] * len(new_stmts),
+                                                "failedQueries": [], "queryStatements": []}]}, fout)
+    run(join("postprocessing", "recover_coref_new.py"), hypotheses_path, log_path, graph_path, compressed_path, recovered_path)
+    with open(recovered_path) as fin:
+        recovered = json.load(fin)["support"][0]
+
+    # the type statements of P, A and B are merged into one compressed statement
+    assert {"stmt-P-type", "stmt-X-P"} <= set(recovered["statements"]), recovered["statements"]
+    assert ["P", "C1"] in recovered["clusterMemberships"], recovered["clusterMemberships"]
+    print("ok")
@@ -0,0 +1,68 @@
+##
+# benchmark for EREUnify:
+# unify millions of EREs into coreference groups, in dictionary mode
+# with string labels and in compact mode with integer labels,
+# and report time taken and peak memory.
+#
+# call with the number of EREs (default 2000000) and the average
+# number of EREs per coreference group (default 5) as arguments,
+# and optionally "compact" to only run compact mode.
+
+import sys
+import time
+import random
+import resource
+
+from os.path import dirname, realpath
+src_path = dirname(dirname(realpath(__file__)))
+sys.path.insert(0, src_path)
+
+from aif import EREUnify
+
+num_eres = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+group_size = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+only_compact = "compact" in sys.argv[3:]
+
+num_groups = max(1, num_eres // group_size)
+
+# each ERE is unified with a random group.
+# every tenth ERE is also unified with a second group, which merges the two groups.
+rng = random.Random(0)
+assignments = [ (rng.randrange(num_groups), rng.randrange(num_groups) if ere % 10 == 0 else None) for ere in range(num_eres) ]
+
+def run(compact):
+    if compact:
+        # integer labels: EREs are 0 .. num_eres-1, groups come after them
+        ere_label = lambda ere: ere
+        group_label = lambda group: num_eres + group
+    else:
+        ere_label = lambda ere: "ERE-" + str(ere)
+        group_label = lambda group: "Cluster-" + str(group)
+
+    unify_obj = EREUnify(compact = compact)
+
+    starttime = time.time()
+    for ere, (group, second_group) in enumerate(assignments):
+        unify_obj.unify_ere_coref(ere_label(ere), group_label(group))
+        if second_group is not None:
+            unify_obj.unify_ere_coref(ere_label(ere), group_label(second_group))
+    unify_time = time.time() - starttime
+
+    starttime = time.time()
+    for ere in range(num_eres):
+        unify_obj.get_unifier(ere_label(ere))
+    lookup_time = time.time() - starttime
+
+    starttime = time.time()
+    num_clusters = len(unify_obj.get_clusters())
+    cluster_time = time.time() - starttime
+
+    print("{} mode: {} EREs in {} clusters".format("compact" if compact else "dictionary", num_eres, num_clusters))
+    print("\tunify: {:.2f}s, get_unifier: {:.2f}s, get_clusters: {:.2f}s".format(unify_time, lookup_time, cluster_time))
+    # ru_maxrss is in kilobytes on Linux
+    print("\tpeak memory so far: {:.0f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+# run compact mode first, as peak memory is cumulative
+run(compact = True)
+if not only_compact:
+    run(compact = False)
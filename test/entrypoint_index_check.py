@@ -0,0 +1,155 @@
+##
+# check for the entrypoint index of process_soin.py:
+# run process_soin.py with and without --no_ep_index on a small synthetic KB and SOINs,
+# and check that both give the same entrypoints and entrypoint weights,
+# with and without role information and for several entrypoint caps.
+#
+# call without arguments.
+
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+
+from os.path import dirname, realpath, join
+src_path = dirname(dirname(realpath(__file__)))
+
+NUM_ERES = 200
+NUM_DOCS = 10
+NUM_SOINS = 20
+
+ENTITY_TYPES = ["PER", "ORG", "GPE.Country", "LOC", "PER.Combatant.Sniper", "ORG.Government"]
+EVENT_TYPES = ["Conflict.Attack", "Conflict.Attack.FireArmAttack", "Contact.Meet"]
+ROLES = ["Conflict.Attack_Attacker", "Conflict.Attack_Target", "Contact.Meet_Participant"]
+NAMES = ["Bob", "Robert", "Alice", "Kiev", "Kyiv", "Moscow", "NATO", "Zoë"]
+
+HEADER = """@prefix rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#> .
+@prefix aida: <https://tac.nist.gov/tracks/SM-KBP/2019/ontologies/InterchangeOntology#> .
+@prefix ldcOnt: <https://tac.nist.gov/tracks/SM-KBP/2019/ontologies/LDCOntology#> .
+@prefix ldc: <https://tac.nist.gov/tracks/SM-KBP/2019/ontologies/LdcAnnotations#> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+"""
+
+# a text or image justification in one of the documents
+def make_justification(rand):
+    doc = "D{}".format(rand.randrange(NUM_DOCS))
+    if rand.random() < 0.7:
+        start = rand.randint(0, 1000)
+        return '[ a aida:TextJustification ; aida:source "{}" ; aida:startOffset "{}"^^xsd:int ; ' \
+               'aida:endOffsetInclusive "{}"^^xsd:int ]'.format(doc, start, start + rand.randint(1, 40))
+    x, y = rand.randint(0, 500), rand.randint(0, 500)
+    return '[ a aida:ImageJustification ; aida:source "{}" ; aida:boundingBox [ a aida:BoundingBox ; ' \
+           'aida:boundingBoxUpperLeftX "{}"^^xsd:int ; aida:boundingBoxUpperLeftY "{}"^^xsd:int ; ' \
+           'aida:boundingBoxLowerRightX "{}"^^xsd:int ; aida:boundingBoxLowerRightY "{}"^^xsd:int ] ]'.format(
+               doc, x, y, x + rand.randint(1, 200), y + rand.randint(1, 200))
+
+# synthetic KB: every fourth ERE is an event, EREs have one or two typing statements,
+# some entities have names and KB links, events have role statements,
+# and most EREs are in a cluster whose prototype is another ERE
+def make_kb(rand):
+    lines = [HEADER]
+    for ere_idx in range(NUM_ERES):
+        is_event = ere_idx % 4 == 3
+        ere = "ldc:E{}".format(ere_idx)
+        ere_triples = "{} a aida:{}".format(ere, "Event" if is_event else "Entity")
+        if not is_event and rand.random() < 0.7:
+            ere_triples += ' ; aida:hasName "{}"'.format(rand.choice(NAMES))
+        if not is_event and rand.random() < 0.5:
+            ere_triples += ' ; aida:link [ a aida:LinkAssertion ; aida:linkTarget "KB:{}" ]'.format(rand.randrange(NUM_ERES // 3))
+        lines.append(ere_triples + " .")
+
+        for _ in range(rand.randint(1, 2)):
+            ere_type = rand.choice(EVENT_TYPES if is_event else ENTITY_TYPES)
+            lines.append("[] a rdf:Statement ; rdf:subject {} ; rdf:predicate rdf:type ; rdf:object ldcOnt:{} ; "
+                         "aida:justifiedBy {} .".format(ere, ere_type, make_justification(rand)))
+
+    for _ in range(NUM_ERES // 2):
+        event = "ldc:E{}".format(4 * rand.randrange(NUM_ERES // 4) + 3)
+        lines.append("[] a rdf:Statement ; rdf:subject {} ; rdf:predicate ldcOnt:{} ; rdf:object ldc:E{} ; "
+                     "aida:justifiedBy {} .".format(event, rand.choice(ROLES), rand.randrange(NUM_ERES), make_justification(rand)))
+
+    num_clusters = NUM_ERES * 2 // 3
+    for cluster_idx in range(num_clusters):
+        lines.append("ldc:C{} a aida:SameAsCluster ; aida:prototype ldc:E{} .".format(cluster_idx, cluster_idx))
+    for ere_idx in range(NUM_ERES):
+        if rand.random() < 0.9:
+            lines.append("[ a aida:ClusterMembership ; aida:cluster ldc:C{} ; aida:clusterMember ldc:E{} ] .".format(
+                min(ere_idx, num_clusters - 1) if rand.random() < 0.7 else rand.randrange(num_clusters), ere_idx))
+
+    return "\n".join(lines) + "\n"
+
+def make_descriptor(rand):
+    doc = "D{}".format(rand.randrange(NUM_DOCS))
+    kind = rand.randrange(4)
+    if kind == 0:
+        start = rand.randint(0, 1000)
+        return "<text_descriptor><doceid>{}</doceid><start>{}</start><end>{}</end></text_descriptor>".format(
+            doc, start, start + rand.randint(1, 60))
+    if kind == 1:
+        return "<string_descriptor><name_string>{}</name_string></string_descriptor>".format(rand.choice(NAMES + ["Nobody"]))
+    if kind == 2:
+        x, y = rand.randint(0, 500), rand.randint(0, 500)
+        return "<image_descriptor><doceid>{}</doceid><topleft>{},{}</topleft><bottomright>{},{}</bottomright></image_descriptor>".format(
+            doc, x, y, x + rand.randint(1, 200), y + rand.randint(1, 200))
+    return "<kb_descriptor><kbid>KB:{}</kbid></kb_descriptor>".format(rand.randrange(NUM_ERES // 3))
+
+# synthetic SOIN: one frame with an event ?e and a role edge to each entrypoint variable
+def make_soin(rand, soin_idx):
+    num_entrypoints = rand.randint(2, 4)
+    edges = ""
+    entrypoints = ""
+    for ep_idx in range(num_entrypoints):
+        edges += "<edge id=\"E{}\"><subject>?e</subject><predicate>{}</predicate><object>?v{}</object></edge>".format(
+            ep_idx, rand.choice(ROLES), ep_idx)
+        typed_descriptors = "".join("<typed_descriptor><enttype>{}</enttype>{}</typed_descriptor>".format(
+            rand.choice(ENTITY_TYPES + EVENT_TYPES), make_descriptor(rand)) for _ in range(rand.randint(1, 3)))
+        entrypoints += "<entrypoint><node>?v{}</node><typed_descriptors>{}</typed_descriptors></entrypoint>".format(
+            ep_idx, typed_descriptors)
+
+    return "<information_need id=\"R{0:03d}\"><frames><frame id=\"F1\"><edges>{1}</edges></frame></frames>" \
+           "<entrypoints>{2}</entrypoints></information_need>".format(soin_idx, edges, entrypoints)
+
+def run(work_dir, out_dir, options):
+    subprocess.run([sys.executable, join(src_path, "pipeline", "soin_processing", "process_soin.py"),
+                        join(work_dir, "soins"), join(work_dir, "kb"), out_dir,
+                        "--dup_kb", join(work_dir, "dup_kb.json"), "--no_cluster_mappings_cache"] + options,
+                   check = True, stdout = subprocess.DEVNULL)
+
+    outputs = { }
+    for filename in sorted(os.listdir(out_dir)):
+        with open(join(out_dir, filename)) as fin:
+            outputs[filename] = json.load(fin)
+    assert len(outputs) == NUM_SOINS, "process_soin.py did not write an output for every SOIN"
+    return outputs
+
+rand = random.Random(42)
+with tempfile.TemporaryDirectory() as work_dir:
+    os.makedirs(join(work_dir, "kb"))
+    with open(join(work_dir, "kb", "kb.ttl"), "w") as fout:
+        fout.write(make_kb(rand))
+
+    # KB descriptors need a duplicate KB ID mapping
+    with open(join(work_dir, "dup_kb.json"), "w") as fout:
+        json.dump({"KB:1": "KB:2"}, fout)
+
+    os.makedirs(join(work_dir, "soins"))
+    for soin_idx in range(NUM_SOINS):
+        with open(join(work_dir, "soins", "R{:03d}.xml".format(soin_idx)), "w") as fout:
+            fout.write(make_soin(rand, soin_idx))
+
+    num_differences = 0
+    for ep_cap in [1, 5, 50]:
+        for role_options in [[ ], ["--roles"]]:
+            options = ["--ep-cap", str(ep_cap)] + role_options
+            with_index = run(work_dir, join(work_dir, "out-index-{}-{}".format(ep_cap, len(role_options))), options)
+            without_index = run(work_dir, join(work_dir, "out-noindex-{}-{}".format(ep_cap, len(role_options))), options + ["--no_ep_index"])
+
+            for filename, output in with_index.items():
+                if output != without_index[filename]:
+                    num_differences += 1
+                    print("difference with options", " ".join(options), "in", filename)
+
+    assert num_differences == 0, "entrypoint resolution with and without the index differs"
+    print("ok")
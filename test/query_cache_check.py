@@ -0,0 +1,99 @@
+##
+# check for the SPARQL query result cache of query_hypotheses.py:
+# run query_hypotheses.py twice, in two processes with different string hash seeds,
+# on a small synthetic graph and hypothesis, and check that the second run
+# gets all its query results from the cache written by the first.
+# then reload the database with a KB of the same size, and check that
+# a third run gets none of its query results from the cache.
+#
+# tdbquery is replaced by a stand-in script that prints a fixed triple,
+# so this does not need a TDB database.
+#
+# call without arguments.
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from os.path import dirname, realpath, join
+src_path = dirname(dirname(realpath(__file__)))
+
+LDC = "https://tac.nist.gov/tracks/SM-KBP/2019/ontologies/LdcAnnotations#"
+LDC_ONT = "https://tac.nist.gov/tracks/SM-KBP/2019/ontologies/LDCOntology#"
+
+# synthetic graph: entities E0 .. E9, one SameAsCluster per entity
+# plus one cluster with all of them, and role statements between them
+def make_graph():
+    the_graph = { }
+    all_cluster = LDC + "C-all"
+    the_graph[all_cluster] = {"type": "SameAsCluster", "prototype": LDC + "E0"}
+
+    for ere_idx in range(10):
+        ere = LDC + "E{}".format(ere_idx)
+        cluster = LDC + "C{}".format(ere_idx)
+        the_graph[ere] = {"type": "Entity"}
+        the_graph[cluster] = {"type": "SameAsCluster", "prototype": ere}
+        for cm_idx, cm_cluster in enumerate([cluster, all_cluster]):
+            the_graph["cm-{}-{}".format(ere_idx, cm_idx)] = {
+                "type": "ClusterMembership", "cluster": cm_cluster, "clusterMember": ere}
+        the_graph["type-{}".format(ere_idx)] = {
+            "type": "Statement", "subject": ere, "predicate": "type", "object": LDC_ONT + "PER"}
+        the_graph["role-{}".format(ere_idx)] = {
+            "type": "Statement", "subject": ere, "predicate": "Conflict.Attack_Attacker",
+            "object": LDC + "E{}".format((ere_idx + 1) % 10)}
+
+    return {"theGraph": the_graph}
+
+def run(work_dir, out_dir, hash_seed):
+    env = dict(os.environ)
+    env["PYTHONHASHSEED"] = str(hash_seed)
+    env["PATH"] = join(work_dir, "bin") + os.pathsep + env["PATH"]
+    subprocess.run([sys.executable, join(src_path, "pipeline", "postprocessing", "query_hypotheses.py"),
+                        join(work_dir, "graph.json"), join(work_dir, "hypotheses.json"), join(work_dir, "db"), out_dir,
+                        "--query_just", "--query_conf", "--cache_dir", join(work_dir, "cache")],
+                       env = env, check = True, stdout = subprocess.DEVNULL)
+
+    with open(join(out_dir, "hypothesis-001-report.json")) as fin:
+        return json.load(fin)
+
+with tempfile.TemporaryDirectory() as work_dir:
+    graph_json = make_graph()
+    with open(join(work_dir, "graph.json"), "w") as fout:
+        json.dump(graph_json, fout)
+
+    statements = sorted(label for label, node in graph_json["theGraph"].items() if node["type"] == "Statement")
+    with open(join(work_dir, "hypotheses.json"), "w") as fout:
+        json.dump({"probs": [1.0], "support": [{"statements": statements}]}, fout)
+
+    # two database copies, with a file each so that they have a fingerprint
+    for copy_idx in range(2):
+        os.makedirs(join(work_dir, "db", "copy{}".format(copy_idx)))
+        with open(join(work_dir, "db", "copy{}".format(copy_idx), "nodes.dat"), "w") as fout:
+            fout.write("kb")
+
+    os.makedirs(join(work_dir, "bin"))
+    tdbquery_path = join(work_dir, "bin", "tdbquery")
+    with open(tdbquery_path, "w") as fout:
+        fout.write("#!/bin/sh\necho '<http://example.org/s> <http://example.org/p> <http://example.org/o> .'\n")
+    os.chmod(tdbquery_path, 0o755)
+
+    first_report = run(work_dir, join(work_dir, "out1"), 1)
+    second_report = run(work_dir, join(work_dir, "out2"), 2)
+
+    num_cached = sum(1 for report in second_report if report["cached"])
+    print("first run: {} queries, {} cached".format(len(first_report), sum(1 for report in first_report if report["cached"])))
+    print("second run: {} queries, {} cached".format(len(second_report), num_cached))
+    assert num_cached == len(second_report) == len(first_report), "second run did not get all query results from the cache"
+
+    # a different KB, with database files of the same sizes
+    for copy_idx in range(2):
+        with open(join(work_dir, "db", "copy{}".format(copy_idx), "nodes.dat"), "w") as fout:
+            fout.write("KB")
+
+    third_report = run(work_dir, join(work_dir, "out3"), 1)
+    num_cached = sum(1 for report in third_report if report["cached"])
+    print("after reloading: {} queries, {} cached".format(len(third_report), num_cached))
+    assert num_cached == 0, "query results of the old KB were taken from the cache"
+    print("ok")